@@ -3,6 +3,7 @@ import {HttpClient, HttpEvent, HttpParams, HttpRequest} from "@angular/common/ht
 import {Observable} from "rxjs/internal/Observable";
 import {
   AutoTest,
+  AutoTestBatch,
   AutoTestConfig,
   Course,
   ErrorMessage,
@@ -385,7 +386,7 @@ export class AdminService {
 
   runAutoTests(config_id: number, user_id: number = null, team_id: number = null,
                last_submissions_only: boolean = false,
-               skip_successful: boolean = false):Observable<AutoTest[]> {
+               skip_successful: boolean = false):Observable<AutoTestBatch> {
     let params = new HttpParams();
     if (user_id !== null)
       params = params.append('user_id', user_id.toString());
@@ -395,7 +396,11 @@ export class AdminService {
       params = params.append('last_submissions_only', "true");
     if(skip_successful)
       params = params.append('skip_successful', "true");
-    return this.http.get<AutoTest[]>(`${this.api}/auto-test-configs/${config_id}/run`, {params: params})
+    return this.http.get<AutoTestBatch>(`${this.api}/auto-test-configs/${config_id}/run`, {params: params})
+  }
+
+  getAutoTestBatch(config_id: number, batch_id: string):Observable<AutoTestBatch> {
+    return this.http.get<AutoTestBatch>(`${this.api}/auto-test-configs/${config_id}/batches/${batch_id}`)
   }
 
   setFinalMarks(task_id: number, form: SetFinalMarksRequest): Observable<FinalMarks> {
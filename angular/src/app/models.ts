@@ -293,6 +293,15 @@ export class AutoTest {
   pending_tests_ahead?: number;
 }
 
+export class AutoTestBatch {
+  batch_id: string;
+  config_id: number;
+  total: number;
+
+  finished?: number;
+  states?: { [state: string]: number };
+}
+
 export class AutoTestOutputFile {
   id: number;
   auto_test_id: number;
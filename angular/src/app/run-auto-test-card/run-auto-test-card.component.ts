@@ -1,6 +1,6 @@
-import {Component, EventEmitter, Input, OnInit, Output} from '@angular/core';
+import {Component, EventEmitter, Input, OnDestroy, OnInit, Output} from '@angular/core';
 import {finalize} from "rxjs/operators";
-import {AutoTestConfig, ErrorMessage, SuccessMessage, Task, Team, User} from "../models";
+import {AutoTestBatch, AutoTestConfig, ErrorMessage, SuccessMessage, Task, Team, User} from "../models";
 import {AccountService} from "../account.service";
 import {AdminService} from "../admin.service";
 
@@ -9,7 +9,7 @@ import {AdminService} from "../admin.service";
   templateUrl: './run-auto-test-card.component.html',
   styleUrls: ['./run-auto-test-card.component.less']
 })
-export class RunAutoTestCardComponent implements OnInit {
+export class RunAutoTestCardComponent implements OnInit, OnDestroy {
   @Input() task: Task;
   @Input() user: User;
   @Input() team: Team;
@@ -25,6 +25,10 @@ export class RunAutoTestCardComponent implements OnInit {
   modalError: ErrorMessage;
   modelSuccess: SuccessMessage;
 
+  batch: AutoTestBatch;
+  batchUpdateInterval: number = 5000;  // 5s
+  batchUpdateHandler: number;
+
   constructor(
     private accountService: AccountService,
     private adminService: AdminService) {
@@ -39,6 +43,10 @@ export class RunAutoTestCardComponent implements OnInit {
     )
   }
 
+  ngOnDestroy(): void {
+    this.stopTrackingBatch();
+  }
+
   runAutoTest() {
     let config = this.activeConfig;  // make a local copy
     if (config == null)
@@ -63,11 +71,39 @@ export class RunAutoTestCardComponent implements OnInit {
     api.pipe(
       finalize(() => this.requestingRunAutoTest = false)
     ).subscribe(
-      test => {
-        this.modelSuccess = {msg: `Started auto test "${config.name}" on ${test.length} submissions`}
+      batch => {
+        this.modelSuccess = {msg: `Started auto test "${config.name}" on ${batch.total} submissions`};
+        this.trackBatch(batch);
       },
       error => this.modalError = error.error
     )
   }
 
+  private trackBatch(batch: AutoTestBatch) {
+    this.stopTrackingBatch();
+    this.batch = batch;
+    if (!batch.total)
+      return;
+    this.batchUpdateHandler = setInterval(() => {
+      this.adminService.getAutoTestBatch(batch.config_id, batch.batch_id).subscribe(
+        progress => {
+          this.batch = progress;
+          if (progress.finished >= progress.total)
+            this.stopTrackingBatch();
+        },
+        error => {
+          this.stopTrackingBatch();
+          this.modalError = error.error;
+        }
+      )
+    }, this.batchUpdateInterval);
+  }
+
+  private stopTrackingBatch() {
+    if (this.batchUpdateHandler) {
+      clearInterval(this.batchUpdateHandler);
+      this.batchUpdateHandler = null;
+    }
+  }
+
 }
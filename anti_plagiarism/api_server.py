@@ -1,14 +1,19 @@
+import atexit
+import itertools
 import json
 import logging
-from io import StringIO
-from threading import Lock
+import resource
+from queue import PriorityQueue
+from threading import Thread, Lock
 from typing import List, Tuple, Dict
 
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, Response
 
-from anti_plagiarism.code_analysis import CodeFileInfo, CodeSegment, CodeOccurrence
+from anti_plagiarism.code_analysis import CodeFileInfo, CodeSegment, CodeOccurrence, get_similarity_clusters
+from anti_plagiarism.engines import is_supported_file
 from anti_plagiarism.store import Store
-from models import Task
+from anti_plagiarism.store_cache import create_store, create_store_cache
+from models import Task, FileRequirement
 from server import app
 from services.submission import SubmissionService, SubmissionServiceError
 from services.task import TaskService, TaskServiceError
@@ -31,6 +36,9 @@ GRADE_SAME_CODE = 6
 # SAME_FILE means the two collided files have identical content (same MD5).
 GRADE_SAME_FILE = 7
 
+# The summary of a submission covers at most this many duplicates (the largest ones).
+SUMMARY_MAX_DUPLICATES = 100
+
 GRADE_MESSAGES = {GRADE_NO_EVIDENCE: 'No Evidence',
                   GRADE_WEAK_EVIDENCE: 'Weak Evidence',
                   GRADE_MODERATE_EVIDENCE: 'Moderate Evidence',
@@ -40,8 +48,48 @@ GRADE_MESSAGES = {GRADE_NO_EVIDENCE: 'No Evidence',
                   GRADE_SAME_CODE: 'Same Code',
                   GRADE_SAME_FILE: 'Same File'}
 
-_stores_map = {}
-_global_lock = Lock()
+_ap_config = app.config.get('ANTI_PLAGIARISM') or {}
+
+_store_cache = create_store_cache(_ap_config)
+atexit.register(_store_cache.save_snapshots)  # so that a restart does not rebuild the indices
+
+# Requirements to index in the background, as (priority, sequence, requirement id). The new files of the requirements
+# that are being submitted to are indexed before the stores are pre-warmed, e.g. near the deadlines.
+INDEX_PRIORITY_NEW_FILES = 0
+INDEX_PRIORITY_PREWARM = 1
+_index_queue = PriorityQueue()
+_index_queue_sequence = itertools.count()  # keeps the order of the requirements of the same priority
+_index_worker_thread = None
+_index_worker_lock = Lock()
+
+
+def _get_store(requirement: FileRequirement) -> Store:
+    return _store_cache.get(requirement.id, lambda: create_store(requirement, _ap_config, app.config['DATA_FOLDER'],
+                                                                 _ap_config.get('build_workers', 1)))
+
+
+def _index_worker():
+    while True:
+        priority, _, requirement_id = _index_queue.get()
+        try:
+            if priority != INDEX_PRIORITY_PREWARM:
+                # only keep the cached stores up to date, a store that is not cached would be built from scratch and
+                # might evict the stores in use, while its new files are indexed anyway when it is built
+                store = _store_cache.peek(requirement_id)
+                if store is not None:
+                    with app.test_request_context():
+                        store.update()
+                    _store_cache.trim()
+                continue
+            with app.test_request_context():
+                requirement = TaskService.get_file_requirement(requirement_id)
+                if requirement is None or not is_supported_file(requirement.name):
+                    continue
+                logger.info('Pre-warming store for requirement %d' % requirement_id)
+                _get_store(requirement).update()
+                _store_cache.trim()
+        except Exception:
+            logger.exception('Failed to index new files for requirement %d' % requirement_id)
 
 
 @ap_server.route('/')
@@ -51,6 +99,11 @@ def index_page():
 
 @ap_server.route('/api/check')
 def check():
+    """
+    Check a submission. The response is streamed: a JSON summary in the first line, then the text report. The
+    summary always covers the largest SUMMARY_MAX_DUPLICATES duplicates, whichever page is requested, while the report
+    can be paged by the optional offset/limit (default: 100) arguments.
+    """
     try:
         submission_id = request.args.get('sid')
         if submission_id is None:
@@ -63,6 +116,12 @@ def check():
         template_file_id = request.args.get('tid')
         if template_file_id is not None:
             template_file_id = int(template_file_id)
+        offset = int(request.args.get('offset', 0))
+        if offset < 0:
+            return jsonify(msg='offset must not be negative'), 400
+        limit = int(request.args.get('limit', 100))
+        if limit < 0:
+            return jsonify(msg='limit must not be negative'), 400
 
         with app.test_request_context():
             submission = SubmissionService.get(submission_id)
@@ -77,7 +136,7 @@ def check():
                     return jsonify(msg='template file not found'), 404
             else:
                 template_file = None
-            if not requirement.name.endswith('.py'):
+            if not is_supported_file(requirement.name):
                 return jsonify(msg='file type not supported'), 400
             if requirement.task_id != submission.task_id:
                 return jsonify(msg='submission and requirement are not in the same task'), 400
@@ -99,35 +158,207 @@ def check():
             else:
                 uid = submission.submitter_id
 
-            with _global_lock:
-                store = _stores_map.get(requirement.id)
-                if store is None:
-                    # Currently, only allow one store in memory. TODO: use a queue to manage in-memory stores
-                    _stores_map.clear()
-                    _stores_map[requirement.id] = store = Store(requirement.id, task.is_team_task,
-                                                                app.config['DATA_FOLDER'])
-
+            store = _get_store(requirement)
             store.add_file(submission_id, uid, file)
+            _store_cache.trim()
             file_info = store.get_file_info(submission_id)
             if file_info is None:  # failed to process file, e.g. syntax/io error
                 return jsonify(conclusion='Skipped', reason='File syntax or IO error')
 
+            # enough results for both the summary and the requested page of the report
+            duplicates_limit = max(SUMMARY_MAX_DUPLICATES, offset + limit)
             if template_file:
-                duplicates = store.get_duplicates(submission_id, uid, template_path=template_file.file_path,
+                duplicates = store.get_duplicates(submission_id, uid, limit=duplicates_limit,
+                                                  template_path=template_file.file_path,
                                                   template_md5=template_file.md5)
             else:
-                duplicates = store.get_duplicates(submission_id, uid)
-
-            summary = build_summary(store, task, uid=uid, info=file_info, duplicates=duplicates)
-            with StringIO() as buffer:
-                buffer.write(json.dumps(summary))  # dump a JSON summary in the first line
-                buffer.write('\n')
-                store.pretty_print_results(duplicates, file=buffer)  # then the full report follows
-                return buffer.getvalue(), {'Content-Type': 'text/plain'}
+                duplicates = store.get_duplicates(submission_id, uid, limit=duplicates_limit)
+
+            with store.timings.measure('build_summary', requirement_id=requirement.id, sid=submission_id):
+                summary = build_summary(store, task, uid=uid, info=file_info,
+                                        duplicates=duplicates[:SUMMARY_MAX_DUPLICATES])
+
+        def generate():
+            yield json.dumps(summary) + '\n'  # dump a JSON summary in the first line
+            yield from store.iter_pretty_print_results(duplicates, offset, limit)  # then a page of the report
+
+        return Response(generate(), content_type='text/plain')
     except (TaskServiceError, TeamServiceError, SubmissionServiceError) as e:
         return jsonify(msg=e.msg, detail=e.detail), 400
 
 
+@ap_server.route('/api/check-batch', methods=['POST'])
+def check_batch():
+    """
+    Check many submissions of a requirement at once. The JSON body is either {"submission_ids": [...]} or
+    {"latest": true} for the latest submission (that includes the file) of every user/team. One JSON summary is
+    streamed per line for each submission, in the same format as the first line of /api/check with the extra
+    "submission_id" field.
+    """
+    try:
+        requirement_id = request.args.get('rid')
+        if requirement_id is None:
+            return jsonify(msg='requirement id is required'), 400
+        requirement_id = int(requirement_id)
+        template_file_id = request.args.get('tid')
+        if template_file_id is not None:
+            template_file_id = int(template_file_id)
+        params = request.get_json(silent=True) or {}
+        submission_ids = params.get('submission_ids')
+        latest = params.get('latest', False)
+        if submission_ids is None and not latest:
+            return jsonify(msg='submission ids or latest is required'), 400
+        if submission_ids is not None and (type(submission_ids) is not list
+                                           or any(type(sid) is not int for sid in submission_ids)):
+            return jsonify(msg='submission ids must be a list of integers'), 400
+
+        with app.test_request_context():
+            requirement = TaskService.get_file_requirement(requirement_id)
+            if requirement is None:
+                return jsonify(msg='requirement not found'), 404
+            if template_file_id is not None:
+                template_file = TaskService.get_material(template_file_id)
+                if template_file is None:
+                    return jsonify(msg='template file not found'), 404
+            else:
+                template_file = None
+            if not is_supported_file(requirement.name):
+                return jsonify(msg='file type not supported'), 400
+
+            task = requirement.task
+            # load the files of all the submissions in one query, treat a team as a single 'user' in this module
+            if task.is_team_task:
+                file_tuples = SubmissionService.get_team_files(requirement.id)
+            else:
+                file_tuples = SubmissionService.get_files(requirement.id)
+            file_map = {sid: (sid, uid, file) for sid, uid, file in file_tuples}
+            if submission_ids is None:  # pick the latest submission of each user/team
+                latest_sids = {}
+                for sid, uid, _ in file_tuples:
+                    if sid > latest_sids.get(uid, 0):
+                        latest_sids[uid] = sid
+                submission_ids = sorted(latest_sids.values())
+
+            store = _get_store(requirement)
+            store.add_files([file_map[sid] for sid in submission_ids if sid in file_map])
+            _store_cache.trim()
+            template_path = template_file.file_path if template_file else None
+            template_md5 = template_file.md5 if template_file else None
+
+        def generate():
+            sid_uids = [file_map[sid][:2] for sid in submission_ids if sid in file_map]
+            results = store.iter_duplicates(sid_uids, limit=SUMMARY_MAX_DUPLICATES, template_path=template_path,
+                                            template_md5=template_md5)
+            for sid in submission_ids:
+                if sid not in file_map:
+                    summary = dict(conclusion='Skipped', reason='File not submitted')
+                else:
+                    _, uid, duplicates = next(results)
+                    file_info = store.get_file_info(sid)
+                    if file_info is None:  # failed to process file, e.g. syntax/io error
+                        summary = dict(conclusion='Skipped', reason='File syntax or IO error')
+                    else:
+                        with store.timings.measure('build_summary', requirement_id=store.requirement_id, sid=sid):
+                            summary = build_summary(store, task, uid=uid, info=file_info, duplicates=duplicates)
+                summary['submission_id'] = sid
+                yield json.dumps(summary) + '\n'
+
+        return Response(generate(), content_type='application/x-ndjson')
+    except (TaskServiceError, TeamServiceError, SubmissionServiceError) as e:
+        return jsonify(msg=e.msg, detail=e.detail), 400
+
+
+@ap_server.route('/api/similarities')
+def similarities():
+    """
+    Analyse the whole requirement: rank the pairs of users/teams by the similarity of their code and group the
+    users/teams into clusters by the pairs with similarity >= threshold.
+    """
+    try:
+        requirement_id = request.args.get('rid')
+        if requirement_id is None:
+            return jsonify(msg='requirement id is required'), 400
+        requirement_id = int(requirement_id)
+        template_file_id = request.args.get('tid')
+        if template_file_id is not None:
+            template_file_id = int(template_file_id)
+        threshold = float(request.args.get('threshold', 0.5))
+        limit = int(request.args.get('limit', 100))
+        max_occ_users = request.args.get('max_occ_users')
+        if max_occ_users is not None:
+            max_occ_users = int(max_occ_users)
+
+        with app.test_request_context():
+            requirement = TaskService.get_file_requirement(requirement_id)
+            if requirement is None:
+                return jsonify(msg='requirement not found'), 404
+            if template_file_id is not None:
+                template_file = TaskService.get_material(template_file_id)
+                if template_file is None:
+                    return jsonify(msg='template file not found'), 404
+            else:
+                template_file = None
+            if not is_supported_file(requirement.name):
+                return jsonify(msg='file type not supported'), 400
+
+            is_team_task = requirement.task.is_team_task
+            store = _get_store(requirement)
+            if template_file:
+                pairs = store.get_similarities(template_path=template_file.file_path, template_md5=template_file.md5,
+                                               max_occ_users=max_occ_users)
+            else:
+                pairs = store.get_similarities(max_occ_users=max_occ_users)
+            _store_cache.trim()
+
+        ids_field = 'team_ids' if is_team_task else 'user_ids'
+        clusters = get_similarity_clusters(pairs, threshold)
+        return jsonify(total_pairs=len(pairs),
+                       pairs=[{ids_field: [uid, other_uid], 'shared': shared,
+                               'similarity': round(similarity * 100) / 100}
+                              for uid, other_uid, shared, similarity in pairs[:limit]],
+                       threshold=threshold,
+                       clusters=clusters)
+    except (TaskServiceError, TeamServiceError, SubmissionServiceError) as e:
+        return jsonify(msg=e.msg, detail=e.detail), 400
+
+
+@ap_server.route('/api/index', methods=['POST'])
+def index_new_files():
+    """
+    Index the new files of a requirement in the background, if its store is cached. If the optional "prewarm" argument
+    is true, the store of the requirement is built (if not cached) at a low priority instead, so that the first checks
+    after a deadline hit a warm index.
+    """
+    requirement_id = request.args.get('rid')
+    if requirement_id is None:
+        return jsonify(msg='requirement id is required'), 400
+    requirement_id = int(requirement_id)
+    prewarm = request.args.get('prewarm') == 'true'
+
+    global _index_worker_thread
+    with _index_worker_lock:
+        if _index_worker_thread is None:  # start the worker lazily
+            _index_worker_thread = Thread(target=_index_worker, name='index_worker', daemon=True)
+            _index_worker_thread.start()
+    priority = INDEX_PRIORITY_PREWARM if prewarm else INDEX_PRIORITY_NEW_FILES
+    _index_queue.put((priority, next(_index_queue_sequence), requirement_id))  # index the files in the background
+    return jsonify(queued=_index_queue.qsize()), 202
+
+
+@ap_server.route('/api/stats')
+def stats():
+    """
+    Get the statistics of the cached stores, sorted by their estimated memory usage (descending), to size the host and
+    to find the requirements that use the most memory or time.
+    """
+    store_stats = _store_cache.get_store_stats()
+    store_stats.sort(key=lambda s: s['index']['estimated_memory'] if s['index'] else 0, reverse=True)
+    return jsonify(cache=_store_cache.get_stats(),
+                   index_queue=_index_queue.qsize(),
+                   peak_memory=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,  # ru_maxrss is in KB
+                   stores=store_stats)
+
+
 def build_summary(store: Store, task: Task, uid: int, info: CodeFileInfo,
                   duplicates: List[Tuple[CodeSegment, Dict[int, List[CodeOccurrence]]]]):
     duplicate_user_set = set()
@@ -164,6 +395,8 @@ def build_summary(store: Store, task: Task, uid: int, info: CodeFileInfo,
                     entry['user_id'] = _uid
                 if _info:
                     entry['md5'] = _info.md5
+                if store.is_historical_file(occ.file_id):  # submitted in a previous term
+                    entry['historical'] = True
 
                 file_grade = coverage_grade
                 if _info:
@@ -0,0 +1,394 @@
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import sys
+import tempfile
+import threading
+import time
+from typing import List, Tuple
+
+import requests
+
+from anti_plagiarism.code_analysis import CodeSegmentIndex
+
+logger = logging.getLogger(__name__)
+
+
+def generate_statement_list_code(num_statements: int, seed: int = 0) -> str:
+    """
+    Generate a function with a long flat body, which is the worst case for indexing partial lists.
+    """
+    rand = random.Random(seed)
+    lines = ['def f(a, b, c):']
+    for i in range(num_statements - 1):
+        lines.append('    x%d = a[%d] + b.c%d(c * %d) - len(a) // %d' %
+                     (i, rand.randrange(10), rand.randrange(10), rand.randrange(100), rand.randrange(1, 10)))
+    lines.append('    return a')
+    return '\n'.join(lines) + '\n'
+
+
+def benchmark_partial_lists(list_lengths=(25, 50, 100), repeat: int = 3) -> list:
+    """
+    Measure the time for indexing a single file with a list of statements of each of the given lengths. The time
+    ratio between two lengths shows how the indexing cost of partial lists grows with the list length.
+    """
+    results = []
+    for compact_keys in (False, True):
+        for list_length in list_lengths:
+            code = generate_statement_list_code(list_length)
+            best_time = None
+            index = None
+            for _ in range(repeat):
+                index = CodeSegmentIndex(compact_keys=compact_keys)
+                start_time = time.perf_counter()
+                index.process_code(1, 1, code)
+                elapsed = time.perf_counter() - start_time
+                if best_time is None or elapsed < best_time:
+                    best_time = elapsed
+            stats = index.get_stats()
+            results.append(dict(compact_keys=compact_keys, list_length=list_length, time=best_time,
+                                segments=stats['segments'], occurrences=stats['occurrences']))
+    return results
+
+
+def _percentile(sorted_values: list, percent: float) -> float:
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * percent / 100))]
+
+
+_NAMES = ['data', 'result', 'total', 'count', 'items', 'value', 'index', 'line', 'word', 'key', 'node', 'size']
+
+
+def _generate_expression(rand: random.Random, depth: int = 0) -> str:
+    if depth >= 2 or rand.random() < 0.3:
+        return rand.choice([rand.choice(_NAMES), str(rand.randrange(100)), '%s[%d]' % (rand.choice(_NAMES),
+                                                                                    rand.randrange(10))])
+    if rand.random() < 0.25:
+        return '%s(%s)' % (rand.choice(['len', 'max', 'min', 'sum', 'sorted', 'abs']),
+                           _generate_expression(rand, depth + 1))
+    return '(%s %s %s)' % (_generate_expression(rand, depth + 1), rand.choice(['+', '-', '*', '//', '%']),
+                           _generate_expression(rand, depth + 1))
+
+
+def _generate_block(rand: random.Random, indent: int, depth: int, max_depth: int, num_statements: int) -> List[str]:
+    pad = '    ' * indent
+    lines = []
+    for _ in range(num_statements):
+        kind = rand.randrange(6) if depth < max_depth else 0
+        if kind <= 1:
+            lines.append('%s%s = %s' % (pad, rand.choice(_NAMES), _generate_expression(rand)))
+            continue
+        condition = '%s %s %s' % (_generate_expression(rand), rand.choice(['<', '>', '==', '!=']),
+                                  _generate_expression(rand))
+        if kind == 2:
+            lines.append('%sif %s:' % (pad, condition))
+        elif kind == 3:
+            lines.append('%sfor %s in range(%s):' % (pad, rand.choice(_NAMES), _generate_expression(rand)))
+        elif kind == 4:
+            lines.append('%swhile %s:' % (pad, condition))
+        else:
+            lines.append('%stry:' % pad)
+        lines.extend(_generate_block(rand, indent + 1, depth + 1, max_depth, rand.randint(1, 3)))
+        if kind == 5:
+            lines.append('%sexcept ValueError:' % pad)
+            lines.append('%s    pass' % pad)
+    return lines
+
+
+def generate_submission_code(seed: int, num_functions: int = 8, num_statements: int = 6, max_depth: int = 3) -> \
+        List[str]:
+    """
+    Generate the functions of a synthetic submission, with the given number of top-level statements per function and
+    the given max nesting depth of the blocks.
+    """
+    rand = random.Random(seed)
+    functions = []
+    for i in range(num_functions):
+        lines = ['def f%d_%d(data, key):' % (seed, i)]
+        lines.extend(_generate_block(rand, 1, 0, max_depth, num_statements))
+        lines.append('    return data')
+        functions.append('\n'.join(lines) + '\n')
+    return functions
+
+
+def generate_corpus(folder: str, num_files: int, copy_rate: float, num_functions: int = 8, num_statements: int = 6,
+                    max_depth: int = 3, seed: int = 0) -> List[Tuple[int, int, str]]:
+    """
+    Write a synthetic corpus of submissions to the folder and return their (user id, file id, path) tuples.
+
+    A `copy_rate` fraction of the files copy a random part (half to all) of the functions of an earlier file, shuffled
+    and mixed with their own functions and comments, and the rest are original.
+    """
+    rand = random.Random(seed)
+    submissions = []
+    files = []
+    for i in range(num_files):
+        functions = generate_submission_code(seed * 1000003 + i, num_functions, num_statements, max_depth)
+        if submissions and rand.random() < copy_rate:
+            source = rand.choice(submissions)
+            copied = rand.sample(source, rand.randint(max(1, len(source) // 2), len(source)))
+            functions = copied + functions[len(copied):]
+            rand.shuffle(functions)
+        submissions.append(functions)
+        path = os.path.join(folder, 's%d.py' % i)
+        with open(path, 'w') as f:
+            f.write('# submission %d\n\n' % i)
+            f.write('\n\n'.join(functions))
+        files.append((i, i, path))  # a file per user
+    return files
+
+
+def _get_peak_rss_mb() -> float:
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':  # in bytes on macOS, in kilobytes on Linux
+        return peak_rss / 1024 / 1024
+    return peak_rss / 1024
+
+
+def _run_index_scenario(files: List[Tuple[int, int, str]], workers: int, compact_keys: bool, num_queries: int,
+                        num_removals: int, seed: int) -> dict:
+    rand = random.Random(seed)
+    index = CodeSegmentIndex(compact_keys=compact_keys)
+    start_time = time.perf_counter()
+    errors = sum(1 for _, _, _, error in index.process_files(((uid, fid, path, None) for uid, fid, path in files),
+                                                             workers=workers) if error is not None)
+    build_time = time.perf_counter() - start_time
+    stats = index.get_stats()
+
+    query_files = [rand.choice(files) for _ in range(num_queries)]
+    latencies = []
+    result_count = 0
+    for uid, fid, _ in query_files:  # the same query as a check of a submission in the store
+        start_time = time.perf_counter()
+        result_count += len(index.get_duplicates(sort_by='total_nodes', include_user_id=uid, include_user_file_id=fid,
+                                                 limit=100))
+        latencies.append(time.perf_counter() - start_time)
+    latencies.sort()
+
+    start_time = time.perf_counter()
+    index.get_duplicates(sort_by='total_nodes', limit=100)
+    top_time = time.perf_counter() - start_time
+
+    removal_times = []
+    for uid, fid, _ in rand.sample(files, min(num_removals, len(files))):
+        start_time = time.perf_counter()
+        index.remove_code(uid, fid)
+        removal_times.append(time.perf_counter() - start_time)
+    removal_times.sort()
+
+    return dict(build_time=build_time, build_files_per_second=len(files) / build_time if build_time else 0.0,
+                errors=errors, segments=stats['segments'], occurrences=stats['occurrences'],
+                estimated_memory_mb=stats['estimated_memory'] / 1024 / 1024, peak_rss_mb=_get_peak_rss_mb(),
+                query_p50=_percentile(latencies, 50), query_p90=_percentile(latencies, 90),
+                query_p99=_percentile(latencies, 99), query_max=latencies[-1] if latencies else 0.0,
+                query_results=result_count / len(latencies) if latencies else 0.0, top_duplicates_time=top_time,
+                remove_mean=sum(removal_times) / len(removal_times) if removal_times else 0.0,
+                remove_p99=_percentile(removal_times, 99))
+
+
+def _run_index_scenario_in_child(connection, *args):
+    try:
+        connection.send(_run_index_scenario(*args))
+    except Exception as e:
+        connection.send(e)
+    finally:
+        connection.close()
+
+
+def benchmark_corpus(file_counts=(200,), copy_rates=(0.3,), num_functions: int = 8, num_statements: int = 6,
+                     max_depth: int = 3, workers_list=(1,), compact_keys_list=(True,), num_queries: int = 200,
+                     num_removals: int = 50, seed: int = 0) -> List[dict]:
+    """
+    Build an index of a synthetic corpus for each combination of the parameters, and measure the build throughput, the
+    peak RSS, the latency percentiles of `get_duplicates` for a file and the cost of `remove_code`.
+
+    Each scenario runs in a new process, so that its peak RSS is not affected by the previous scenarios.
+    """
+    results = []
+    context = multiprocessing.get_context('spawn')
+    for num_files in file_counts:
+        for copy_rate in copy_rates:
+            with tempfile.TemporaryDirectory(prefix='ap_benchmark_') as folder:
+                files = generate_corpus(folder, num_files, copy_rate, num_functions, num_statements, max_depth, seed)
+                for workers in workers_list:
+                    for compact_keys in compact_keys_list:
+                        scenario = dict(files=num_files, copy_rate=copy_rate, functions=num_functions,
+                                        statements=num_statements, depth=max_depth, workers=workers,
+                                        compact_keys=compact_keys)
+                        parent_connection, child_connection = context.Pipe(duplex=False)
+                        process = context.Process(target=_run_index_scenario_in_child,
+                                                  args=(child_connection, files, workers, compact_keys, num_queries,
+                                                        num_removals, seed))
+                        process.start()
+                        child_connection.close()
+                        result = parent_connection.recv()
+                        process.join()
+                        if isinstance(result, Exception):
+                            raise result
+                        logger.info('%s: %.1f files/s, peak rss %.1fMB, query p50 %.4fs p99 %.4fs, remove %.4fs' %
+                                    (get_scenario_key(scenario), result['build_files_per_second'],
+                                     result['peak_rss_mb'], result['query_p50'], result['query_p99'],
+                                     result['remove_mean']))
+                        results.append(dict(scenario=scenario, metrics=result))
+    return results
+
+
+def get_scenario_key(scenario: dict) -> str:
+    return ','.join('%s=%s' % (k, scenario[k]) for k in sorted(scenario))
+
+
+# gated metrics -> whether a higher value is better
+GATED_METRICS = {'build_files_per_second': True, 'peak_rss_mb': False, 'query_p50': False, 'query_p99': False,
+                 'remove_mean': False}
+
+
+def compare_with_baseline(results: List[dict], baseline: dict, max_regression: float) -> List[dict]:
+    """
+    Compare the gated metrics of the scenarios with the same scenarios in a baseline report, and return the metrics
+    that regressed by more than `max_regression` (a fraction of the baseline value).
+    """
+    baseline_metrics = {get_scenario_key(r['scenario']): r['metrics'] for r in baseline.get('results', [])}
+    regressions = []
+    for r in results:
+        key = get_scenario_key(r['scenario'])
+        base = baseline_metrics.get(key)
+        if base is None:
+            logger.warning('No baseline for scenario %s' % key)
+            continue
+        for metric, higher_is_better in GATED_METRICS.items():
+            value, base_value = r['metrics'].get(metric), base.get(metric)
+            if value is None or not base_value:
+                continue
+            change = (value - base_value) / base_value
+            regression = -change if higher_is_better else change
+            if regression > max_regression:
+                regressions.append(dict(scenario=key, metric=metric, baseline=base_value, value=value,
+                                        regression=regression))
+    return regressions
+
+
+def stress_api_server(server_url: str, requirement_id: int, submission_ids: List[int], threads: int = 8,
+                      requests_per_thread: int = 20, template_file_id: int = None) -> dict:
+    """
+    Send /api/check requests for random submissions from many threads at once, and measure the throughput and the
+    latency percentiles of the anti-plagiarism api server under concurrent load.
+    """
+    latencies = []
+    status_counts = {}
+    result_lock = threading.Lock()
+
+    def _worker(seed):
+        rand = random.Random(seed)
+        session = requests.Session()
+        for _ in range(requests_per_thread):
+            params = dict(sid=rand.choice(submission_ids), rid=requirement_id)
+            if template_file_id is not None:
+                params['tid'] = template_file_id
+            start_time = time.perf_counter()
+            try:
+                status = session.get('%s/api/check' % server_url, params=params).status_code
+            except requests.RequestException:
+                status = None
+            elapsed = time.perf_counter() - start_time
+            with result_lock:
+                latencies.append(elapsed)
+                status_counts[status] = status_counts.get(status, 0) + 1
+
+    workers = [threading.Thread(target=_worker, args=(i,)) for i in range(threads)]
+    start_time = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    total_time = time.perf_counter() - start_time
+
+    latencies.sort()
+    return dict(threads=threads, requests=len(latencies), time=total_time,
+                throughput=len(latencies) / total_time if total_time else 0.0,
+                latency_p50=_percentile(latencies, 50), latency_p90=_percentile(latencies, 90),
+                latency_p99=_percentile(latencies, 99), latency_max=latencies[-1] if latencies else 0.0,
+                status_counts={str(status): count for status, count in status_counts.items()})
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks for the anti-plagiarism code segment index')
+    subparsers = parser.add_subparsers(dest='command')
+    partial_lists_parser = subparsers.add_parser('partial-lists', help='indexing cost of long statement lists, where '
+                                                 'the dump keys keep the O(n^3) cost in the list length')
+    partial_lists_parser.add_argument('--list-lengths', type=int, nargs='+', default=[25, 50, 100])
+    partial_lists_parser.add_argument('--repeat', type=int, default=3)
+    corpus_parser = subparsers.add_parser('corpus', help='build, query and remove costs on synthetic corpora')
+    corpus_parser.add_argument('--files', type=int, nargs='+', default=[200], help='numbers of files')
+    corpus_parser.add_argument('--copy-rates', type=float, nargs='+', default=[0.3],
+                               help='fractions of the files that copy from another file')
+    corpus_parser.add_argument('--functions', type=int, default=8, help='functions per file')
+    corpus_parser.add_argument('--statements', type=int, default=6, help='top-level statements per function')
+    corpus_parser.add_argument('--depth', type=int, default=3, help='max nesting depth of the blocks')
+    corpus_parser.add_argument('--workers', type=int, nargs='+', default=[1])
+    corpus_parser.add_argument('--keys', choices=['compact', 'dump', 'both'], default='compact',
+                               help='segment keys, the dump keys (for debugging) keep the O(n^3) cost of the partial '
+                                    'lists of n statements, so do not use them on large corpora')
+    corpus_parser.add_argument('--queries', type=int, default=200, help='get_duplicates queries per scenario')
+    corpus_parser.add_argument('--removals', type=int, default=50, help='remove_code calls per scenario')
+    corpus_parser.add_argument('--seed', type=int, default=0)
+    corpus_parser.add_argument('--output', help='write the JSON report to this file')
+    corpus_parser.add_argument('--baseline', help='JSON report of a previous run to compare with')
+    corpus_parser.add_argument('--max-regression', type=float, default=0.2,
+                               help='fail if a gated metric is worse than the baseline by more than this fraction')
+    stress_parser = subparsers.add_parser('stress', help='concurrent /api/check requests against a running server')
+    stress_parser.add_argument('--url', default='http://localhost:6322')
+    stress_parser.add_argument('--rid', type=int, required=True, help='requirement id')
+    stress_parser.add_argument('--sids', type=int, nargs='+', required=True, help='submission ids to check')
+    stress_parser.add_argument('--tid', type=int, help='template file id')
+    stress_parser.add_argument('--threads', type=int, nargs='+', default=[1, 4, 16])
+    stress_parser.add_argument('--requests', type=int, default=20, help='requests per thread')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    if args.command == 'corpus':
+        compact_keys_list = {'compact': [True], 'dump': [False], 'both': [False, True]}[args.keys]
+        results = benchmark_corpus(args.files, args.copy_rates, args.functions, args.statements, args.depth,
+                                   args.workers, compact_keys_list, args.queries, args.removals, args.seed)
+        report = dict(python=platform.python_version(), platform=platform.platform(), cpus=os.cpu_count(),
+                      time=time.strftime('%Y-%m-%dT%H:%M:%S'), results=results)
+        regressions = []
+        if args.baseline:
+            with open(args.baseline) as f:
+                regressions = compare_with_baseline(results, json.load(f), args.max_regression)
+            for r in regressions:
+                logger.error('Regression in %s: %s %.4g -> %.4g (%.0f%% worse)' %
+                             (r['scenario'], r['metric'], r['baseline'], r['value'], r['regression'] * 100))
+            report['regressions'] = regressions
+        if args.output:
+            with open(args.output, 'w') as f:
+                json.dump(report, f, indent=2)
+        else:
+            print(json.dumps(report, indent=2))
+        if regressions:
+            sys.exit(1)
+        return
+
+    if args.command == 'stress':
+        results = []
+        for threads in args.threads:
+            r = stress_api_server(args.url, args.rid, args.sids, threads, args.requests, args.tid)
+            logger.info('threads=%-3d requests=%-5d throughput=%.1f/s p50=%.3fs p90=%.3fs p99=%.3fs' %
+                        (r['threads'], r['requests'], r['throughput'], r['latency_p50'], r['latency_p90'],
+                         r['latency_p99']))
+            results.append(r)
+    else:
+        results = benchmark_partial_lists(getattr(args, 'list_lengths', [25, 50, 100]), getattr(args, 'repeat', 3))
+        for r in results:
+            logger.info('compact_keys=%-5s list_length=%-4d time=%.4fs segments=%d' %
+                        (r['compact_keys'], r['list_length'], r['time'], r['segments']))
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,42 +1,76 @@
+import argparse
 import ast
+import hashlib
 import logging
+import multiprocessing
 import os
 import sys
-from typing import Optional, Tuple, Dict, List
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional, Tuple, Dict, List, Iterable, Iterator, AbstractSet
 
 import astunparse
 import magic
 
+try:
+    import numpy as np
+except ImportError:  # optional, only used to speed up the computation of all-pairs similarities
+    np = None
+
 from utils.upload import md5sum
 
 logger = logging.getLogger(__name__)
 
+# By default, the all-pairs similarities ignore the segments that occur in more than this fraction of the users (but at
+# least SIMILARITY_MIN_MAX_OCC_USERS), which are mostly boilerplate and would expand into a quadratic number of pairs
+SIMILARITY_MAX_OCC_USERS_RATIO = 0.1
+SIMILARITY_MIN_MAX_OCC_USERS = 10
+
+# The errors of a file that is skipped instead of aborting the whole batch: invalid code, code nested too deeply for the
+# recursion limit of the parser, or a file too large to parse
+FILE_ERRORS = (SyntaxError, IOError, RecursionError, MemoryError)
+
 
 class CodeSegment:
-    def __init__(self, dump: str, node, height: int, total_nodes: int):
-        self.dump = dump
+    __slots__ = ('key', 'node', 'height', 'total_nodes', 'code_lines', 'code_length', 'num_users', 'occurrences')
 
-        # for convenience only
+    def __init__(self, key, node, height: int, total_nodes: int, code_lines: int = 0, code_length: int = 0):
+        # either the full dump of the AST (str) or a 128-bit structural hash of the AST (bytes) in compact key mode
+        self.key = key
+
+        # for convenience only, may be None in compact key mode
         self.node = node
         self.height = height
         self.total_nodes = total_nodes
 
+        # number of lines and length (in bytes) of the source code spanned by the segment (in its first occurrence)
+        self.code_lines = code_lines
+        self.code_length = code_length
+
+        # Occurrences of the segment in the index, packed as (user_id, file_id, lineno, col_offset) quadruples in a
+        # flat int array (-1 for a missing position), and the number of distinct users in them. Only maintained for the
+        # segments in an index, see CodeSegmentIndex.get_occurrences for the unpacked occurrences.
+        self.num_users = 0
+        self.occurrences = None
+
     def __repr__(self):
-        return repr(self.dump)
+        return repr(self.key)
 
     def __eq__(self, other):
         if not isinstance(other, CodeSegment):
             return False
-        return self.dump == other.dump
+        return self.key == other.key
 
     def __hash__(self):
-        return self.dump.__hash__()
+        return self.key.__hash__()
 
     def to_dict(self) -> dict:
-        return dict(code=astunparse.unparse(self.node), height=self.height, total_nodes=self.total_nodes)
+        return dict(code=_unparse_code(self.node), height=self.height, total_nodes=self.total_nodes)
 
 
 class CodeOccurrence:
+    __slots__ = ('user_id', 'file_id', 'lineno', 'col_offset')
+
     def __init__(self, user_id, file_id, lineno: Optional[int], col_offset: Optional[int]):
         self.user_id = user_id
         self.file_id = file_id
@@ -52,129 +86,416 @@ class CodeOccurrence:
 
 
 class CodeFileInfo:
+    __slots__ = ('md5', 'ast_height', 'ast_total_nodes')
+
     def __init__(self, md5: str, ast_height: int, ast_total_nodes: int):
         self.md5 = md5
         self.ast_height = ast_height
         self.ast_total_nodes = ast_total_nodes
 
 
+# Polynomial rolling hash (modulo the Mersenne prime 2^127 - 1) over the item hashes of partial lists
+_ROLLING_HASH_MODULUS = (1 << 127) - 1
+_ROLLING_HASH_BASE = 0x2b54ad43eeac7baf55180e02cf587c61
+
+
+def _hash_key(data: bytes) -> bytes:
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+
+_encoding_detector = None
+
+
+def _detect_encoding(buffer: bytes) -> str:
+    global _encoding_detector
+    if _encoding_detector is None:  # reuse the detector, which is expensive to create
+        _encoding_detector = magic.Magic(mime_encoding=True)
+    return _encoding_detector.from_buffer(buffer)
+
+
+_CONTAINER_TYPES = (ast.AST, list)
+_node_class_info_cache = {}
+
+
+def _get_node_class_info(node_class) -> Tuple[bytes, bool, bool, bool]:
+    """
+    The encoded name of the AST node class and whether it has the `lineno`, `col_offset` and end position attributes,
+    cached per class.
+    """
+    node_class_info = _node_class_info_cache.get(node_class)
+    if node_class_info is None:
+        attributes = node_class._attributes
+        _node_class_info_cache[node_class] = node_class_info = (node_class.__name__.encode(),
+                                                                'lineno' in attributes, 'col_offset' in attributes,
+                                                                'end_lineno' in attributes)
+    return node_class_info
+
+
 class CodeSegmentIndex:
-    def __init__(self, min_index_height: int = 5, max_split_list_length: int = 100):
+    """
+    Index of duplicated code segments (AST sub-trees and partial statement lists).
+
+    By default, a segment is keyed by the full dump of its AST and keeps a reference to the AST node. In compact key
+    mode, a segment is keyed by a 128-bit structural hash built bottom-up from the hashes of its children, and the AST
+    node is not kept in memory. Instead, the code of each file is kept and the node of a segment is recovered by
+    re-parsing the code only when it is needed, e.g. for the segments in the results.
+
+    The keys of the partial lists (of up to max_split_list_length statements) are rolling hashes in compact key mode,
+    so each one costs O(1), and their nodes are not sliced out of the list. In the default mode, each key is a new
+    string that extends the previous one and each node is a new slice of the list, so both cost O(n) in the length of
+    the list and a list costs O(n^3) in total. The default mode is meant for debugging and small inputs and should not
+    be used on large corpora, while the stores always use compact keys (see `engines.create_index`).
+    """
+
+    # Rough memory cost (in bytes) of a segment entry and an occurrence entry, excluding the size of the segment key.
+    # Only used for estimating the memory usage of an index.
+    _segment_memory_overhead = 1024
+    _compact_segment_memory_overhead = 280
+    _occurrence_memory_overhead = 24
+
+    def __init__(self, min_index_height: int = 5, max_split_list_length: int = 100, compact_keys: bool = False):
         self._min_index_height = min_index_height
         self._max_split_list_length = max_split_list_length
-        self._index = {}
+        self._compact_keys = compact_keys
+        self._index = {}  # segment key -> segment (with its occurrences)
         self._file_info_map = {}
+        self._file_code_map = {}  # to recover the AST nodes (in compact key mode) and count the code lines of the files
+        self._file_segment_map = {}  # reverse postings: file id -> keys of the segments that occur in the file
+        self._md5_file_map = {}  # md5 -> (user id, file id) of a processed file with this content
+        self._num_occurrences = 0
+        self._total_key_size = 0
+        self._total_code_size = 0  # kept up to date, so that the stats can be read while the index is being updated
+
+    def _set_code(self, file_id, code: Optional[str]):
+        old_code = self._file_code_map.pop(file_id, None)
+        if old_code is not None:
+            self._total_code_size -= len(old_code)
+        if code is not None:
+            self._file_code_map[file_id] = code
+            self._total_code_size += len(code)
+
+    def _put(self, segment: CodeSegment, user_id: int, file_id: int, lineno: Optional[int],
+             col_offset: Optional[int]):
+        indexed_segment = self._index.get(segment.key)
+        if indexed_segment is None:
+            self._index[segment.key] = indexed_segment = segment
+            segment.num_users = 0
+            segment.occurrences = array('i')
+            self._total_key_size += len(segment.key)
+        occurrences = indexed_segment.occurrences
+        # the occurrences of a file are added at once, so checking the last occurrence is usually enough
+        if not occurrences or (occurrences[-4] != user_id and user_id not in occurrences[0::4]):
+            indexed_segment.num_users += 1
+        occurrences.extend((user_id, file_id, -1 if lineno is None else lineno,
+                            -1 if col_offset is None else col_offset))
+        self._num_occurrences += 1
+        file_segments = self._file_segment_map.get(file_id)
+        if file_segments is None:
+            self._file_segment_map[file_id] = file_segments = []
+        file_segments.append(indexed_segment.key)
 
-    def _put(self, segment: CodeSegment, occurrence: CodeOccurrence):
-        occ_users = self._index.get(segment)
-        if occ_users is None:
-            self._index[segment] = occ_users = {}
-        occ_user_items = occ_users.get(occurrence.user_id)
-        if occ_user_items is None:
-            occ_users[occurrence.user_id] = occ_user_items = []
-        occ_user_items.append(occurrence)
+    @staticmethod
+    def get_occurrences(segment: CodeSegment) -> Dict[int, List[CodeOccurrence]]:
+        """
+        Unpack the occurrences of an indexed segment, grouped by users.
+        """
+        occ_users = {}
+        occurrences = segment.occurrences
+        for i in range(0, len(occurrences), 4):
+            user_id, file_id, lineno, col_offset = occurrences[i:i + 4]
+            user_occurrences = occ_users.get(user_id)
+            if user_occurrences is None:
+                occ_users[user_id] = user_occurrences = []
+            user_occurrences.append(CodeOccurrence(user_id, file_id, None if lineno < 0 else lineno,
+                                                   None if col_offset < 0 else col_offset))
+        return occ_users
+
+    @staticmethod
+    def _occurs_in(segment: CodeSegment, user_id: int, file_id: int = None) -> bool:
+        # assume a file id belongs to a single user, so only the first occurrence in the file is checked
+        occurrences = segment.occurrences
+        if file_id is None:
+            return user_id in occurrences[0::4]
+        file_ids = occurrences[1::4]
+        if file_id not in file_ids:
+            return False
+        return occurrences[file_ids.index(file_id) * 4] == user_id
 
     def process_code(self, user_id, file_id, code: str):
-        def _iterate_node(node):
-            height = 1
-            total_nodes = 1
-            lineno = None
-            col_offset = None
-            if isinstance(node, ast.AST):
-                fields = []
-                for field_name, field_value in ast.iter_fields(node):
-                    node_dump, node_height, node_total_nodes, node_lineno, node_col_offset = _iterate_node(field_value)
-                    fields.append((field_name, node_dump))
-                    height = max(height, node_height + 1)
-                    total_nodes += node_total_nodes
-                dump = '%s(%s)' % (node.__class__.__name__, ', '.join(dump for _, dump in fields))
-
-                lineno, col_offset = _extract_node_position(node)
-
-                if height >= self._min_index_height:
-                    self._put(CodeSegment(dump, node, height, total_nodes),
-                              CodeOccurrence(user_id, file_id, lineno, col_offset))
-            elif isinstance(node, list):
-                item_dumps = []
-                item_heights = []
-                item_total_nodes = []
-                item_positions = []
-                for x in node:
-                    node_dump, node_height, node_total_nodes, node_lineno, node_col_offset = _iterate_node(x)
-                    item_dumps.append(node_dump)
-                    item_positions.append((node_lineno, node_col_offset))
-                    height = max(height, node_height + 1)
-                    item_heights.append(node_height)
-                    item_total_nodes.append(node_total_nodes)
-                    total_nodes += node_total_nodes
-                dump = '[%s]' % ', '.join(item_dumps)
-
-                num_items = len(node)
-                if num_items:  # use the position info of the first item
-                    lineno, col_offset = item_positions[0]
-
-                if height >= self._min_index_height:
-                    self._put(CodeSegment(dump, node, height, total_nodes),
-                              CodeOccurrence(user_id, file_id, lineno, col_offset))
-
-                # also index partial lists if list length is not too big
-                if num_items <= self._max_split_list_length:
-                    for start_idx in range(num_items):
-                        for end_idx in range(start_idx + 2, num_items + 1):  # at least two items
-                            partial_list_height = max(item_heights[start_idx:end_idx])
-                            if partial_list_height >= self._min_index_height:
-                                partial_list = node[start_idx:end_idx]
-                                partial_list_dump = ', '.join(item_dumps[start_idx: end_idx])
-                                partial_list_total_nodes = sum(item_total_nodes[start_idx:end_idx])
-                                partial_list_lineno, partial_list_col_offset = item_positions[start_idx]
-                                segment = CodeSegment(partial_list_dump, partial_list, partial_list_height,
-                                                      partial_list_total_nodes)
-                                occurrence = CodeOccurrence(user_id, file_id, partial_list_lineno,
-                                                            partial_list_col_offset)
-                                self._put(segment, occurrence)
-            else:
-                dump = repr(node)
-                # no position info available, use default None for lineno and col_offset
-                if height >= self._min_index_height:
-                    self._put(CodeSegment(dump, node, height, total_nodes),
-                              CodeOccurrence(user_id, file_id, lineno, col_offset))
-
-            return dump, height, total_nodes, lineno, col_offset
-
-        def _extract_node_position(node):
-            lineno = None
-            col_offset = None
-            if node._attributes:
-                for attr_name in node._attributes:
-                    if attr_name == 'lineno':
-                        lineno = getattr(node, attr_name)
-                    elif attr_name == 'col_offset':
-                        col_offset = getattr(node, attr_name)
-            return lineno, col_offset
+        def _on_segment(key, node, height, total_nodes, lineno, col_offset, code_lines, code_length):
+            if compact_keys:
+                node = None  # do not keep the AST in memory
+            self._put(CodeSegment(key, node, height, total_nodes, code_lines, code_length), user_id, file_id, lineno,
+                      col_offset)
+
+        compact_keys = self._compact_keys
+        self._set_code(file_id, code)
+        return self._iterate_code(code, _on_segment, with_nodes=not compact_keys)
+
+    def _iterate_code(self, code: str, on_segment, with_nodes: bool = True):
+        """
+        Parse the code and call `on_segment(key, node, height, total_nodes, lineno, col_offset, code_lines,
+        code_length)` for every segment that should be indexed. If `with_nodes` is False, the node of the partial lists
+        is None instead of a new slice of the list, for the callers that do not keep the nodes.
+
+        The number of lines and the length of the code of a segment are measured on the source span of the segment,
+        which is computed bottom-up from the positions of the nodes, so that the code does not need to be un-parsed.
+
+        Returns the key, height, total nodes, position and source span of the root node.
+        """
+
+        def _iterate_tree(root):
+            # Post-order traversal with an explicit stack (no recursion limit on deeply nested code). The key, height,
+            # total nodes and position of each node are computed bottom-up from the results of its children. Each
+            # stack entry has the list that its result should be written to, and the index in that list. Only AST nodes
+            # and lists are pushed to the stack, the results of leaf values are computed when their parent is expanded.
+            root_results = [None]
+            stack = [(root, None, root_results, 0)]
+            while stack:
+                node, child_results, parent_child_results, child_idx = stack.pop()
+                if child_results is None:  # first visit, expand the children
+                    if node.__class__ is list:
+                        children = node
+                    else:
+                        try:
+                            children = [getattr(node, field_name) for field_name in node._fields]
+                        except AttributeError:  # missing optional fields
+                            children = [value for _, value in ast.iter_fields(node)]
+                    child_results = [None] * len(children)
+                    stack.append((node, child_results, parent_child_results, child_idx))
+                    stack_size = len(stack)
+                    for idx in range(len(children) - 1, -1, -1):
+                        child = children[idx]
+                        if isinstance(child, _CONTAINER_TYPES):
+                            child_result = constant_node_results.get(child.__class__)
+                            if child_result is None:
+                                stack.append((child, None, child_results, idx))
+                            else:  # e.g. Load(), Store()
+                                child_results[idx] = child_result
+                        else:  # leaf value, no position info available
+                            key = repr(child)
+                            if compact_keys:
+                                value_repr = key
+                                key = leaf_hash_keys.get(value_repr)
+                                if key is None:  # leaf values (names, None, etc.) repeat a lot, only hash them once
+                                    leaf_hash_keys[value_repr] = key = _hash_key(
+                                        value_repr.encode(errors='backslashreplace'))
+                            if min_index_height <= 1:
+                                on_segment(key, child, 1, 1, None, None, 0, 0)
+                            child_results[idx] = (key, 1, 1, None, None, None)
+                    if len(stack) > stack_size:  # visit again after the children have been processed
+                        continue
+                    stack.pop()  # all the children are leaf values, no need to visit again
+
+                # all the children have been processed
+                num_children = len(child_results)
+                height = 1
+                total_nodes = 1
+                span_start = span_end = None
+                for _, child_height, child_total_nodes, _, _, child_span in child_results:
+                    if child_height >= height:
+                        height = child_height + 1
+                    total_nodes += child_total_nodes
+                    if child_span is not None:
+                        child_span_start, child_span_end = child_span
+                        if span_start is None or child_span_start < span_start:
+                            span_start = child_span_start
+                        if span_end is None or child_span_end > span_end:
+                            span_end = child_span_end
+
+                if node.__class__ is list:
+                    item_keys = [r[0] for r in child_results]
+                    if compact_keys:
+                        key = _hash_key(b'[%s]' % b''.join(item_keys))
+                    else:
+                        key = '[%s]' % ', '.join(item_keys)
+                    if num_children:  # use the position info of the first item
+                        _, _, _, lineno, col_offset, _ = child_results[0]
+                    else:
+                        lineno = col_offset = None
+                    span = (span_start, span_end) if span_start is not None else None
+
+                    if height >= min_index_height:
+                        on_segment(key, node, height, total_nodes, lineno, col_offset, *_get_code_metrics(span))
+
+                    # also index partial lists (of at least two items) if list length is not too big
+                    if 2 <= num_children <= max_split_list_length:
+                        _iterate_partial_lists(node, item_keys, child_results)
+                else:  # AST node
+                    node_class = node.__class__
+                    node_class_info = _node_class_info_cache.get(node_class)
+                    if node_class_info is None:
+                        node_class_info = _get_node_class_info(node_class)
+                    node_class_name, has_lineno, has_col_offset, has_end_position = node_class_info
+                    field_keys = [r[0] for r in child_results]
+                    if compact_keys:
+                        key = _hash_key(b'%s(%s)' % (node_class_name, b''.join(field_keys)))
+                    else:
+                        key = '%s(%s)' % (node_class.__name__, ', '.join(field_keys))
+
+                    lineno = node.lineno if has_lineno else None
+                    col_offset = node.col_offset if has_col_offset else None
+                    if lineno is not None and col_offset is not None:  # extend the span with the node itself
+                        node_start = (lineno, col_offset)
+                        if has_end_position and node.end_lineno is not None:
+                            node_end = (node.end_lineno, node.end_col_offset)
+                        else:  # end positions are not available before Python 3.8
+                            node_end = node_start
+                        if span_start is None or node_start < span_start:
+                            span_start = node_start
+                        if span_end is None or node_end > span_end:
+                            span_end = node_end
+                    span = (span_start, span_end) if span_start is not None else None
+
+                    if height >= min_index_height:
+                        on_segment(key, node, height, total_nodes, lineno, col_offset, *_get_code_metrics(span))
+                    elif not num_children and span is None:
+                        # AST nodes without fields or positions (e.g. Load(), Store()) always have the same result
+                        constant_node_results[node_class] = (key, height, total_nodes, lineno, col_offset, span)
+                parent_child_results[child_idx] = (key, height, total_nodes, lineno, col_offset, span)
+            return root_results[0]
+
+        def _get_code_metrics(span):
+            if span is None:
+                return 0, 0
+            (start_lineno, start_col_offset), (end_lineno, end_col_offset) = span
+            code_length = (line_offsets[end_lineno - 1] + end_col_offset) - (line_offsets[start_lineno - 1] +
+                                                                             start_col_offset)
+            return end_lineno - start_lineno + 1, code_length
+
+        def _iterate_partial_lists(node, item_keys, item_results):
+            # The height, total nodes, span and key of partial lists are maintained incrementally while extending the
+            # end of the list, so that each partial list costs O(1) in compact key mode (rolling hash) instead of O(n).
+            num_items = len(node)
+            item_heights = [r[1] for r in item_results]
+            if compact_keys:
+                prefix_hashes = [0]
+                for item_key in item_keys:
+                    prefix_hashes.append((prefix_hashes[-1] * _ROLLING_HASH_BASE + int.from_bytes(item_key, 'big'))
+                                         % _ROLLING_HASH_MODULUS)
+            suffix_max_height = 0
+            suffix_max_heights = [0] * num_items
+            for idx in range(num_items - 1, -1, -1):
+                suffix_max_height = max(suffix_max_height, item_heights[idx])
+                suffix_max_heights[idx] = suffix_max_height
+
+            for start_idx in range(num_items - 1):
+                if suffix_max_heights[start_idx] < min_index_height:  # no partial list from here is high enough
+                    break
+                _, partial_list_height, partial_list_total_nodes, partial_list_lineno, partial_list_col_offset, \
+                    partial_list_span = item_results[start_idx]
+                partial_list_key = None
+                for end_idx in range(start_idx + 2, num_items + 1):  # at least two items
+                    _, item_height, item_total_nodes, _, _, item_span = item_results[end_idx - 1]
+                    if item_height > partial_list_height:
+                        partial_list_height = item_height
+                    partial_list_total_nodes += item_total_nodes
+                    if item_span is not None:  # items are in order, so the span can only be extended at the end
+                        if partial_list_span is None:
+                            partial_list_span = item_span
+                        elif item_span[1] > partial_list_span[1]:
+                            partial_list_span = (partial_list_span[0], item_span[1])
+                    if partial_list_height < min_index_height:
+                        continue
+                    if compact_keys:
+                        partial_list_key = ((prefix_hashes[end_idx] - prefix_hashes[start_idx] *
+                                             rolling_hash_powers[end_idx - start_idx])
+                                            % _ROLLING_HASH_MODULUS).to_bytes(16, 'big')
+                    elif partial_list_key is None:  # the first partial list that is high enough
+                        partial_list_key = ', '.join(item_keys[start_idx:end_idx])
+                    else:
+                        partial_list_key = '%s, %s' % (partial_list_key, item_keys[end_idx - 1])
+                    on_segment(partial_list_key, node[start_idx:end_idx] if with_nodes else None, partial_list_height,
+                               partial_list_total_nodes, partial_list_lineno, partial_list_col_offset,
+                               *_get_code_metrics(partial_list_span))
 
+        compact_keys = self._compact_keys
+        min_index_height = self._min_index_height
+        max_split_list_length = self._max_split_list_length
+        if compact_keys:
+            rolling_hash_powers = [1]
+            for _ in range(max_split_list_length):
+                rolling_hash_powers.append(rolling_hash_powers[-1] * _ROLLING_HASH_BASE % _ROLLING_HASH_MODULUS)
+        leaf_hash_keys = {}
+        constant_node_results = {}
+        line_offsets = [0]  # offsets (in bytes) of the lines, note col_offset is also in bytes
+        for line in code.encode(errors='surrogateescape').splitlines(keepends=True):
+            line_offsets.append(line_offsets[-1] + len(line))
         root = ast.parse(code)
-        return _iterate_node(root)
+        return _iterate_tree(root)
+
+    def _find_node(self, segment: CodeSegment, occ_users: Dict[int, List[CodeOccurrence]], file_nodes_cache: dict):
+        """
+        Get the AST node of a segment. If the segment has no node (compact key mode or merged from worker processes),
+        the node is recovered by re-parsing the code of the first occurrence that is still available. The mappings
+        from keys to nodes of the re-parsed files are kept in the given cache dict.
+        """
+        if segment.node is not None:
+            return segment.node
+        for user_occurrences in occ_users.values():
+            for occ in user_occurrences:
+                file_nodes = file_nodes_cache.get(occ.file_id)
+                if file_nodes is None:
+                    code = self._file_code_map.get(occ.file_id)
+                    if code is None:
+                        continue
+                    file_nodes = {}
+
+                    def _on_segment(key, node, *args):
+                        file_nodes.setdefault(key, node)
+
+                    self._iterate_code(code, _on_segment)
+                    file_nodes_cache[occ.file_id] = file_nodes
+                node = file_nodes.get(segment.key)
+                if node is not None:
+                    return node
+        return None
+
+    def resolve_results(self, results: List[Tuple[CodeSegment, Dict[int, List[CodeOccurrence]]]]) \
+            -> List[Tuple[CodeSegment, Dict[int, List[CodeOccurrence]]]]:
+        """
+        Make sure the segments in the results have their AST nodes, which is required for printing or serializing the
+        results. Segments without nodes (compact key mode) are replaced by copies with the recovered nodes, so that the
+        nodes are not kept in the index.
+        """
+        file_nodes_cache = {}
+        return [self._resolve_result(result, file_nodes_cache) for result in results]
+
+    def _resolve_result(self, result: Tuple[CodeSegment, Dict[int, List[CodeOccurrence]]], file_nodes_cache: dict) \
+            -> Tuple[CodeSegment, Dict[int, List[CodeOccurrence]]]:
+        segment, occ_users = result
+        if segment.node is None:
+            node = self._find_node(segment, occ_users, file_nodes_cache)
+            segment = CodeSegment(segment.key, node, segment.height, segment.total_nodes, segment.code_lines,
+                                  segment.code_length)
+        return segment, occ_users
 
     def remove_code(self, user_id, file_id):
-        segments_to_delete = []
-        for k, v in self._index.items():
-            user_occurrences = v.get(user_id)
-            if user_occurrences:
-                i = 0
-                while i < len(user_occurrences):
-                    occ = user_occurrences[i]
-                    if occ.file_id == file_id:
-                        user_occurrences.pop(i)
-                    else:
-                        i += 1
-                if len(user_occurrences) == 0:  # empty occ list
-                    del v[user_id]
-            if len(v) == 0:  # empty occ users
-                segments_to_delete.append(k)
-        for k in segments_to_delete:
-            del self._index[k]
+        file_info = self._file_info_map.get(file_id)
+        if file_info is not None and self._md5_file_map.get(file_info.md5) == (user_id, file_id):
+            del self._md5_file_map[file_info.md5]
 
-    def process_file(self, user_id, file_id, file_path: str, file_md5: str = None) -> CodeFileInfo:
+        # only visit the segments that occur in this file
+        file_segments = self._file_segment_map.pop(file_id, ())
+        for k in dict.fromkeys(file_segments):  # de-duplicate, a segment may occur multiple times in a file
+            segment = self._index.get(k)
+            if segment is None:
+                continue
+            occurrences = segment.occurrences
+            remaining_occurrences = array('i')
+            for i in range(0, len(occurrences), 4):
+                if occurrences[i + 1] != file_id or occurrences[i] != user_id:
+                    remaining_occurrences.extend(occurrences[i:i + 4])
+            self._num_occurrences -= (len(occurrences) - len(remaining_occurrences)) // 4
+            if remaining_occurrences:
+                segment.occurrences = remaining_occurrences
+                segment.num_users = len(set(remaining_occurrences[0::4]))
+            else:  # no occurrences left
+                del self._index[k]
+                self._total_key_size -= len(k)
+        self._set_code(file_id, None)
+
+    def _check_processed_file(self, user_id, file_id, file_md5: Optional[str]) -> Optional[CodeFileInfo]:
         file_info = self._file_info_map.get(file_id)
         if file_info is not None:
             if file_info.md5 == file_md5:
@@ -185,27 +506,244 @@ class CodeSegmentIndex:
                 logger.info('Removing index for old file: uid=%s, fid/sid=%s, old_md5=%s, new_md5=%s'
                             % (user_id, file_id, file_info.md5, file_md5))
                 self.remove_code(user_id, file_id)
+        return None
 
+    @staticmethod
+    def _read_code(user_id, file_id, file_path: str) -> str:
         with open(file_path, 'rb') as f:
             buffer = f.read()
-        encoding = magic.Magic(mime_encoding=True).from_buffer(buffer)
+        encoding = _detect_encoding(buffer)
         if encoding == 'binary':
             raise IOError('binary file detected: uid=%s, fid/sid=%s, path=%s' % (user_id, file_id, file_path))
         try:
-            code = buffer.decode(encoding)
+            return buffer.decode(encoding)
         except (ValueError, LookupError):
             raise IOError('failed to decode file with %s encoding: uid=%s, fid/sid=%s, path=%s'
                           % (encoding, user_id, file_id, file_path))
+
+    def process_file(self, user_id, file_id, file_path: str, file_md5: str = None) -> CodeFileInfo:
+        file_info = self._check_processed_file(user_id, file_id, file_md5)
+        if file_info is not None:
+            return file_info
+
         if not file_md5:  # if no md5 given, compute it now
             file_md5 = md5sum(file_path)
-        _, ast_height, ast_total_nodes, _, _ = self.process_code(user_id, file_id, code)
+        file_info = self._copy_identical_file(user_id, file_id, file_md5)
+        if file_info is not None:
+            return file_info
+
+        code = self._read_code(user_id, file_id, file_path)
+        _, ast_height, ast_total_nodes, _, _, _ = self.process_code(user_id, file_id, code)
         file_info = CodeFileInfo(md5=file_md5, ast_height=ast_height, ast_total_nodes=ast_total_nodes)
         self._file_info_map[file_id] = file_info
+        self._md5_file_map[file_md5] = (user_id, file_id)
+        return file_info
+
+    def _copy_identical_file(self, user_id, file_id, file_md5: str) -> Optional[CodeFileInfo]:
+        """
+        If a file with the same content (md5) has been processed, add occurrences for this file at the same positions
+        of the same segments without parsing it again.
+        """
+        source = self._md5_file_map.get(file_md5)
+        if source is None:
+            return None
+        source_user_id, source_file_id = source
+        logger.debug('Copying index from identical file: uid=%s, fid/sid=%s, source_uid=%s, source_fid/sid=%s, md5=%s'
+                     % (user_id, file_id, source_user_id, source_file_id, file_md5))
+        for k in dict.fromkeys(self._file_segment_map.get(source_file_id, ())):
+            segment = self._index.get(k)
+            if segment is None:
+                continue
+            occurrences = segment.occurrences
+            source_positions = [(occurrences[i + 2], occurrences[i + 3]) for i in range(0, len(occurrences), 4)
+                                if occurrences[i + 1] == source_file_id and occurrences[i] == source_user_id]
+            for lineno, col_offset in source_positions:
+                self._put(segment, user_id, file_id, lineno, col_offset)
+        code = self._file_code_map.get(source_file_id)
+        if code is not None:
+            self._set_code(file_id, code)
+        source_file_info = self._file_info_map[source_file_id]
+        file_info = CodeFileInfo(md5=file_md5, ast_height=source_file_info.ast_height,
+                                 ast_total_nodes=source_file_info.ast_total_nodes)
+        self._file_info_map[file_id] = file_info
+        return file_info
+
+    def process_files(self, files: Iterable[Tuple[int, int, str, Optional[str]]], workers: int = 1) \
+            -> Iterable[Tuple[int, int, Optional[CodeFileInfo], Optional[Exception]]]:
+        """
+        Process `(user_id, file_id, file_path, file_md5)` tuples and yield `(user_id, file_id, file_info, error)` for
+        each file in the given order, where `error` is the error (see FILE_ERRORS) raised when processing the file.
+
+        If `workers` is greater than 1, the files are parsed by a pool of worker processes, each of which returns a
+        compact list of segments per file, and the segments are merged into this index by the calling process.
+        Otherwise, the files are processed one after another in the calling process.
+        """
+        if workers is None:
+            workers = os.cpu_count() or 1
+        if workers <= 1:
+            for user_id, file_id, file_path, file_md5 in files:
+                try:
+                    yield user_id, file_id, self.process_file(user_id, file_id, file_path, file_md5), None
+                except FILE_ERRORS as e:
+                    yield user_id, file_id, None, e
+            return
+
+        # Only send the first file of each content (md5) that is not in the index yet to the workers, the others are
+        # copied from the processed identical files.
+        tasks = []
+        args = []
+        dispatched_md5s = set()
+        for user_id, file_id, file_path, file_md5 in files:
+            file_info = self._check_processed_file(user_id, file_id, file_md5)
+            dispatched = False
+            if file_info is None and (not file_md5 or (file_md5 not in self._md5_file_map and
+                                                       file_md5 not in dispatched_md5s)):
+                args.append((user_id, file_id, file_path, file_md5, self._min_index_height,
+                             self._max_split_list_length, self._compact_keys))
+                if file_md5:
+                    dispatched_md5s.add(file_md5)
+                dispatched = True
+            tasks.append((user_id, file_id, file_path, file_md5, file_info, dispatched))
+        if not args:
+            workers = 1  # no need to start the worker processes
+
+        md5_errors = {}
+        chunk_size = max(1, len(args) // (workers * 4))  # a few shards per worker for load balancing
+        with ProcessPoolExecutor(max_workers=workers, mp_context=_get_process_pool_context()) as executor:
+            extracted_files = executor.map(_extract_file_segments, args, chunksize=chunk_size)
+            for user_id, file_id, file_path, file_md5, file_info, dispatched in tasks:
+                if file_info is not None:  # already processed
+                    yield user_id, file_id, file_info, None
+                elif dispatched:
+                    extracted = next(extracted_files)
+                    if isinstance(extracted, Exception):
+                        if file_md5:
+                            md5_errors[file_md5] = extracted
+                        yield user_id, file_id, None, extracted
+                    else:
+                        yield user_id, file_id, self._add_file_segments(user_id, file_id, *extracted), None
+                elif file_md5 in md5_errors:  # identical to a file that failed
+                    yield user_id, file_id, None, md5_errors[file_md5]
+                else:
+                    try:  # identical to a processed file
+                        yield user_id, file_id, self.process_file(user_id, file_id, file_path, file_md5), None
+                    except FILE_ERRORS as e:
+                        yield user_id, file_id, None, e
+
+    def extract_file(self, user_id, file_id, file_path: str, file_md5: str = None) \
+            -> Tuple[str, str, List[Tuple], int, int]:
+        """
+        Read and parse a file without changing the index, e.g. while other threads are querying the index. The result
+        can be added to the index by `add_extracted_file` later.
+        """
+        return self._extract_file(user_id, file_id, file_path, file_md5)
+
+    def extract_files(self, files: Iterable[Tuple[int, int, str, Optional[str]]], workers: int = 1) \
+            -> Iterator[Tuple[int, int, Optional[Tuple[str, str, List[Tuple], int, int]], Optional[Exception]]]:
+        """
+        Read and parse many files without changing the index (see `extract_file`), by a pool of worker processes if
+        `workers` is greater than 1, and yield `(user_id, file_id, extracted, error)` for each file in the given order.
+        `extracted` is None without an error if the file is already indexed, or if its content is identical to a file
+        in the index or to an earlier file of the batch, in which case it should be added by `process_file` instead.
+        """
+        if workers is None:
+            workers = os.cpu_count() or 1
+        tasks = []
+        args = []
+        dispatched_md5s = set()
+        for user_id, file_id, file_path, file_md5 in files:
+            file_info = self._file_info_map.get(file_id)
+            dispatched = (file_info is None or file_info.md5 != file_md5) and \
+                (not file_md5 or (file_md5 not in self._md5_file_map and file_md5 not in dispatched_md5s))
+            if dispatched:
+                args.append((user_id, file_id, file_path, file_md5, self._min_index_height,
+                             self._max_split_list_length, self._compact_keys))
+                if file_md5:
+                    dispatched_md5s.add(file_md5)
+            tasks.append((user_id, file_id, dispatched))
+
+        if workers <= 1 or len(args) <= 1:
+            yield from self._iterate_extracted_files(tasks, map(_extract_file_segments, args))
+            return
+        chunk_size = max(1, len(args) // (workers * 4))  # a few shards per worker for load balancing
+        with ProcessPoolExecutor(max_workers=workers, mp_context=_get_process_pool_context()) as executor:
+            yield from self._iterate_extracted_files(
+                tasks, executor.map(_extract_file_segments, args, chunksize=chunk_size))
+
+    @staticmethod
+    def _iterate_extracted_files(tasks: List[Tuple[int, int, bool]], extracted_files: Iterator) \
+            -> Iterator[Tuple[int, int, Optional[Tuple[str, str, List[Tuple], int, int]], Optional[Exception]]]:
+        for user_id, file_id, dispatched in tasks:
+            extracted = next(extracted_files) if dispatched else None
+            if isinstance(extracted, Exception):
+                yield user_id, file_id, None, extracted
+            else:
+                yield user_id, file_id, extracted, None
+
+    def add_extracted_file(self, user_id, file_id, extracted: Tuple[str, str, List[Tuple], int, int]) -> CodeFileInfo:
+        file_info = self._check_processed_file(user_id, file_id, extracted[1])
+        if file_info is not None:
+            return file_info
+        return self._add_file_segments(user_id, file_id, *extracted)
+
+    def extract_segment_keys(self, file_path: str) -> frozenset:
+        """
+        Get the keys of all the segments in a file without changing the index, e.g. to exclude the segments of a
+        template from the results of `get_duplicates`.
+        """
+        _, _, segments, _, _ = self._extract_file(None, None, file_path, None)
+        return frozenset(segment[0] for segment in segments)
+
+    def has_identical_file(self, file_md5: str) -> bool:
+        return file_md5 in self._md5_file_map
+
+    def _extract_file(self, user_id, file_id, file_path: str, file_md5: Optional[str]) \
+            -> Tuple[str, str, List[Tuple], int, int]:
+        code = self._read_code(user_id, file_id, file_path)
+        if not file_md5:  # if no md5 given, compute it now
+            file_md5 = md5sum(file_path)
+        segments = []
+
+        def _on_segment(key, node, height, total_nodes, lineno, col_offset, code_lines, code_length):
+            segments.append((key, height, total_nodes, lineno, col_offset, code_lines, code_length))
+
+        _, ast_height, ast_total_nodes, _, _, _ = self._iterate_code(code, _on_segment, with_nodes=False)
+        return code, file_md5, segments, ast_height, ast_total_nodes
+
+    def _add_file_segments(self, user_id, file_id, code: str, file_md5: str, segments: List[Tuple],
+                           ast_height: int, ast_total_nodes: int) -> CodeFileInfo:
+        # AST nodes are not available for extracted segments, keep the code to recover them when needed
+        self._set_code(file_id, code)
+        for key, height, total_nodes, lineno, col_offset, code_lines, code_length in segments:
+            self._put(CodeSegment(key, None, height, total_nodes, code_lines, code_length), user_id, file_id, lineno,
+                      col_offset)
+        file_info = CodeFileInfo(md5=file_md5, ast_height=ast_height, ast_total_nodes=ast_total_nodes)
+        self._file_info_map[file_id] = file_info
+        self._md5_file_map[file_md5] = (user_id, file_id)
         return file_info
 
     def get_file_info(self, file_id) -> CodeFileInfo:
         return self._file_info_map.get(file_id)
 
+    def discard_code(self):
+        """
+        Drop the code kept for recovering the AST nodes, e.g. for a read-only index that is only queried together with
+        another index (see `other_index` of `get_duplicates`), whose files provide the nodes instead.
+        """
+        self._file_code_map = {}
+        self._total_code_size = 0
+
+    def get_stats(self) -> dict:
+        num_segments = len(self._index)
+        if self._compact_keys:
+            segment_memory_overhead = self._compact_segment_memory_overhead
+        else:
+            segment_memory_overhead = self._segment_memory_overhead
+        memory = self._total_key_size + num_segments * segment_memory_overhead + \
+            self._num_occurrences * self._occurrence_memory_overhead + self._total_code_size
+        return dict(files=len(self._file_info_map), segments=num_segments, occurrences=self._num_occurrences,
+                    estimated_memory=memory)
+
     def get_duplicates(self, min_occ_users: int = 2, max_occ_users: int = None,
                        min_total_nodes: int = None, max_total_nodes: int = None,
                        min_height: int = None, max_height: int = None,
@@ -213,10 +751,23 @@ class CodeSegmentIndex:
                        include_user_id: int = None, include_user_file_id: int = None,
                        exclude_user_id: int = None, exclude_user_file_id: int = None,
                        min_code_length: int = None, max_code_length: int = None,
-                       min_code_lines: int = 2, max_code_lines: int = None) \
+                       min_code_lines: int = 2, max_code_lines: int = None,
+                       exclude_segment_keys: AbstractSet = None, limit: int = None,
+                       other_index: 'CodeSegmentIndex' = None) \
             -> List[Tuple[CodeSegment, Dict[int, List[CodeOccurrence]]]]:
+        """
+        Get the duplicated segments that match the filters, sorted by `sort_by` (descending). Only the occurrences of
+        the top `limit` results (or all the results if limit is None) are unpacked.
+
+        If `other_index` is given (e.g. a historical corpus), the occurrences of the segments in that index are counted
+        and returned as well, as if the two indices were merged. The other index is only read.
+        """
+        other_segments = other_index._index if other_index is not None else None
         results = []
-        for k, v in self._index.items():
+        for k in self._iterate_candidates(include_user_id, include_user_file_id):
+            other = other_segments.get(k.key) if other_segments is not None else None
+            if exclude_segment_keys is not None and k.key in exclude_segment_keys:
+                continue
             if min_height is not None and k.height < min_height:
                 continue
             if max_height is not None and k.height > max_height:
@@ -225,61 +776,139 @@ class CodeSegmentIndex:
                 continue
             if max_total_nodes is not None and k.total_nodes > max_total_nodes:
                 continue
-            occ_users = len(v)
+            if other is None:
+                occ_users = k.num_users
+            else:  # a user may occur in both indices, e.g. re-enrolled in a later term
+                occ_users = len(set(k.occurrences[0::4]).union(other.occurrences[0::4]))
             if min_occ_users is not None and occ_users < min_occ_users:
                 continue
             if max_occ_users is not None and occ_users > max_occ_users:
                 continue
 
             if include_user_id is not None:
-                user_occurrences = v.get(include_user_id)
-                if user_occurrences is None:
-                    continue
-                if include_user_file_id is not None and not any(occ.file_id == include_user_file_id
-                                                                for occ in user_occurrences):
+                if not self._occurs_in(k, include_user_id, include_user_file_id):
                     continue
             else:
                 if include_user_file_id is not None:
                     logger.warning('parameter "include_user_file_id" is ignored when "include_user_id" is not provided')
 
             if exclude_user_id is not None:
-                user_occurrences = v.get(exclude_user_id)
-                if user_occurrences is not None:
-                    if exclude_user_file_id is None:
-                        continue
-                    if any(occ.file_id == exclude_user_file_id for occ in user_occurrences):
-                        continue
+                if self._occurs_in(k, exclude_user_id, exclude_user_file_id) or \
+                        (other is not None and self._occurs_in(other, exclude_user_id, exclude_user_file_id)):
+                    continue
             else:
                 if exclude_user_file_id is not None:
                     logger.warning('parameter "exclude_file_id" is ignored when "exclude_user_id" is not provided')
 
-            if min_code_length is not None or max_code_length is not None \
-                    or min_code_lines is not None or max_code_lines is not None:  # need to un-parse the AST
-                # The un-parsed code should have the same execution sequence as the original code but the textual format
-                # may be quite different.
-                try:
-                    code = astunparse.unparse(k.node)
-                except AttributeError as e:
-                    logger.warning('Un-parse AST failed: %s' % str(e))
-                    continue
-                # the un-parse function produce may produce an empty starting line and an empty ending line
-                code = code.strip()
-                code_length = len(code)
-                if min_code_length is not None and code_length < min_code_length:
-                    continue
-                if max_code_length is not None and code_length > max_code_length:
-                    continue
-                if min_code_lines is not None or max_code_lines is not None:  # need to count the number of lines
-                    # We are using the number of lines of the un-parsed code, which does not necessarily has the same
-                    # number of lines as the original code.
-                    num_lines = len(code.split('\n'))
-                    if min_code_lines is not None and num_lines < min_code_lines:
-                        continue
-                    if max_code_lines is not None and num_lines > max_code_lines:
-                        continue
+            # The code metrics are measured on the source code of the first occurrence of the segment, including
+            # comments and blank lines inside the segment.
+            if min_code_length is not None and k.code_length < min_code_length:
+                continue
+            if max_code_length is not None and k.code_length > max_code_length:
+                continue
+            if min_code_lines is not None and k.code_lines < min_code_lines:
+                continue
+            if max_code_lines is not None and k.code_lines > max_code_lines:
+                continue
 
-            results.append((k, v))
+            results.append((k, other))
         results.sort(key=lambda x: getattr(x[0], sort_by), reverse=True)
+        if limit is not None:
+            results = results[:limit]
+        unpacked_results = []
+        for k, other in results:
+            occ_users = self.get_occurrences(k)
+            if other is not None:
+                for uid, user_occurrences in self.get_occurrences(other).items():
+                    occ_users.setdefault(uid, []).extend(user_occurrences)
+            unpacked_results.append((k, occ_users))
+        return unpacked_results
+
+    def _iterate_candidates(self, include_user_id, include_user_file_id) -> Iterable[CodeSegment]:
+        if include_user_id is not None and include_user_file_id is not None:
+            # Only the segments that occur in the included file can be in the results, so look them up from the
+            # postings of that file instead of scanning the whole index.
+            index = self._index
+            for k in dict.fromkeys(self._file_segment_map.get(include_user_file_id, ())):
+                segment = index.get(k)
+                if segment is not None:
+                    yield segment
+        else:
+            yield from self._index.values()
+
+    def get_user_similarities(self, min_code_lines: int = 2, max_occ_users: int = None, exclude_user_id: int = None,
+                              exclude_segment_keys: AbstractSet = None) -> List[Tuple[int, int, int, float]]:
+        """
+        Compute the similarity of every pair of users that share code in one pass over the index.
+
+        Returns (user_id, other_user_id, shared_lines, similarity) tuples sorted by similarity (descending). The lines
+        covered by all the segments that a pair shares are accumulated per file, and similarity is the largest fraction
+        of the code lines (neither blank nor comment) of a file of either user that is covered, shared_lines being the
+        covered code lines of that file. The segments that occur in the files of exclude_user_id, in
+        exclude_segment_keys (e.g. the template) or in more than max_occ_users users (e.g. boilerplate code, by default
+        see `get_default_max_occ_users`) are ignored.
+
+        The work grows with the sum over the segments of the squared number of their users, which max_occ_users bounds.
+        With NumPy the (pair, segment) entries are accumulated in sparse arrays, otherwise in python loops.
+        """
+        candidates = []
+        candidate_user_ids = set()
+        for k in self._index.values():
+            if k.num_users < 2:
+                continue
+            if min_code_lines is not None and k.code_lines < min_code_lines:
+                continue
+            if exclude_user_id is not None and self._occurs_in(k, exclude_user_id):
+                continue
+            if exclude_segment_keys is not None and k.key in exclude_segment_keys:
+                continue
+            candidates.append(k)
+            candidate_user_ids.update(k.occurrences[0::4])
+        if max_occ_users is None:
+            max_occ_users = get_default_max_occ_users(len(candidate_user_ids))
+
+        user_indices = {}  # user id -> dense index
+        user_ids = []
+        segment_users = []  # sorted dense user indices, per segment
+        segment_lines = []  # dense user index -> (file_id, first line, last line) of the occurrences, per segment
+        file_last_lines = {}  # file id -> last line of the occurrences in the file
+        for k in candidates:
+            if k.num_users > max_occ_users:
+                continue
+            user_lines = {}
+            last_line_offset = max(k.code_lines, 1) - 1
+            occurrences = k.occurrences
+            for uid, file_id, lineno in zip(occurrences[0::4], occurrences[1::4], occurrences[2::4]):
+                i = user_indices.get(uid)
+                if i is None:
+                    i = user_indices[uid] = len(user_ids)
+                    user_ids.append(uid)
+                lines = user_lines.get(i)
+                if lines is None:
+                    user_lines[i] = lines = []
+                if lineno >= 0:  # -1 for a missing position
+                    last_line = lineno + last_line_offset
+                    lines.append((file_id, lineno, last_line))
+                    if file_last_lines.get(file_id, 0) < last_line:
+                        file_last_lines[file_id] = last_line
+            segment_users.append(sorted(user_lines))
+            segment_lines.append(user_lines)
+
+        file_line_counts = {}  # file id -> cumulative number of code lines (see _count_code_lines)
+        for file_id, last_line in file_last_lines.items():
+            code = self._file_code_map.get(file_id)
+            if code is None:  # see discard_code, assume every line up to the last shared one is code
+                file_line_counts[file_id] = list(range(last_line + 1))
+            else:
+                file_line_counts[file_id] = _count_code_lines(code)
+
+        if np is not None:
+            pair_coverages = _get_pair_coverages_numpy(segment_users, segment_lines, file_line_counts, len(user_ids))
+        else:
+            pair_coverages = _get_pair_coverages(segment_users, segment_lines, file_line_counts)
+        results = [(user_ids[i], user_ids[j], shared_lines, min(1.0, similarity))
+                   for i, j, shared_lines, similarity in pair_coverages]
+        results.sort(key=lambda x: (-x[3], -x[2], x[0], x[1]))
         return results
 
     @staticmethod
@@ -290,38 +919,309 @@ class CodeSegmentIndex:
                                  occ_users.items()})
 
     def pretty_print_result(self, result, file=sys.stdout):
+        file.write(self.format_result(result))
+
+    def format_result(self, result: Tuple[CodeSegment, Dict[int, List[CodeOccurrence]]],
+                      other_index: 'CodeSegmentIndex' = None) -> str:
         segment, occ_users = result
-        print('%-18s%-22s%-16s%-8s%s' % ('User/Team ID', 'File/Submission ID', 'AST Coverage', 'MD5', 'Location'),
-              file=file)
+        lines = ['%-18s%-22s%-16s%-8s%s' % ('User/Team ID', 'File/Submission ID', 'AST Coverage', 'MD5', 'Location')]
         for uid, occ_user_items in occ_users.items():
-            print(uid, file=file)
+            lines.append(str(uid))
             for occ in occ_user_items:
                 md5 = None
                 coverage = None
                 file_info = self._file_info_map.get(occ.file_id)
+                if file_info is None and other_index is not None:
+                    file_info = other_index.get_file_info(occ.file_id)
                 if file_info:
                     md5 = file_info.md5
                     coverage = '%.f%%' % (segment.total_nodes / file_info.ast_total_nodes * 100)
                 md5_short = md5[:6] if md5 else None
-                print('%-18s%-22s%-16s%-8sLine %s, Col %s' % ('', occ.file_id, coverage, md5_short, occ.lineno,
-                                                              occ.col_offset),
-                      file=file)
-        print('AST Nodes: %d, Height: %d' % (segment.total_nodes, segment.height), file=file)
-        print(astunparse.unparse(segment.node), file=file)
+                lines.append('%-18s%-22s%-16s%-8sLine %s, Col %s' % ('', occ.file_id, coverage, md5_short, occ.lineno,
+                                                                     occ.col_offset))
+        lines.append('AST Nodes: %d, Height: %d' % (segment.total_nodes, segment.height))
+        if segment.node is not None:
+            lines.append(_unparse_code(segment.node))
+        else:  # the code of all the occurrences has been removed
+            lines.append('(code not available)')
+        return '\n'.join(lines) + '\n'
 
     def pretty_print_results(self, results, file=sys.stdout):
-        print('Total Results: %d' % len(results), file=file)
-        for i, r in enumerate(results):
-            print('--------------------------------------- #%-2s ---------------------------------------'
-                  % (i + 1), file=file)
-            self.pretty_print_result(r, file=file)
+        for chunk in self.iter_pretty_print_results(results):
+            file.write(chunk)
+
+    def iter_pretty_print_results(self, results: List[Tuple[CodeSegment, Dict[int, List[CodeOccurrence]]]],
+                                  offset: int = 0, limit: int = None) -> Iterator[str]:
+        """
+        Generate the report of the results piece by piece: the header first, then one block per result, so that a
+        large report can be streamed. Only the results in [offset, offset + limit) are printed, the blocks are still
+        numbered by their positions in all the results.
+        """
+        yield 'Total Results: %d\n' % len(results)
+        end = len(results) if limit is None else min(len(results), offset + limit)
+        file_nodes_cache = {}
+        for i in range(offset, end):
+            yield self.format_result_block(i, results[i], file_nodes_cache)
+
+    def format_result_block(self, i: int, result: Tuple[CodeSegment, Dict[int, List[CodeOccurrence]]],
+                            file_nodes_cache: dict, other_index: 'CodeSegmentIndex' = None) -> str:
+        header = '--------------------------------------- #%-2s ---------------------------------------\n' % (i + 1)
+        return header + self.format_result(self._resolve_result(result, file_nodes_cache), other_index)
+
+
+def _extract_file_segments(args):
+    """
+    Worker function for processing files in parallel. Errors are returned instead of raised so that a broken file does
+    not abort the whole batch.
+    """
+    user_id, file_id, file_path, file_md5, min_index_height, max_split_list_length, compact_keys = args
+    index = CodeSegmentIndex(min_index_height=min_index_height, max_split_list_length=max_split_list_length,
+                             compact_keys=compact_keys)
+    try:
+        return index._extract_file(user_id, file_id, file_path, file_md5)
+    except FILE_ERRORS as e:
+        return e
+
+
+def _unparse_code(node: ast.AST) -> str:
+    try:
+        return astunparse.unparse(node)
+    except RecursionError:  # astunparse is recursive, unlike the traversal of the index
+        logger.warning('Code too deeply nested to print: %s', type(node).__name__)
+        return '(code too deeply nested to print)\n'
+
+
+_process_pool_context = None
+
+
+def _get_process_pool_context():
+    # The servers are multi-threaded, and a child forked while another thread holds a lock (e.g. of logging) may
+    # deadlock, so the worker processes are forked from a single-threaded fork server instead (or spawned on the
+    # platforms without it). The fork server preloads the main module and this module once, so that the workers start
+    # quickly. As with spawn, the main module must not start the work on import (i.e. guard it by __name__).
+    global _process_pool_context
+    if _process_pool_context is None:
+        if 'forkserver' in multiprocessing.get_all_start_methods():
+            context = multiprocessing.get_context('forkserver')
+            context.set_forkserver_preload(['__main__', __name__])
+        else:
+            context = multiprocessing.get_context('spawn')
+        _process_pool_context = context
+    return _process_pool_context
 
 
-def test_process_submissions(task_id: int, requirement_id: int, min_index_height: int):
+def _count_code_lines(code: str) -> List[int]:
+    """
+    Get the cumulative number of code lines (neither blank nor comment), i.e. the element at index n is the number of
+    code lines among the first n lines.
+    """
+    line_counts = [0]
+    # as the line numbers of ast, unlike str.splitlines which also splits on e.g. \x0c or \u2028
+    for line in code.replace('\r\n', '\n').replace('\r', '\n').split('\n'):
+        line = line.strip()
+        line_counts.append(line_counts[-1] + (1 if line and not line.startswith('#') else 0))
+    return line_counts
+
+
+def _count_covered_lines(lines: List[Tuple[int, int]], line_counts: List[int]) -> int:
+    # number of code lines covered by the union of the (first line, last line) ranges
+    covered_lines = 0
+    covered_end = 0
+    max_line = len(line_counts) - 1
+    for first_line, last_line in sorted(lines):
+        last_line = min(last_line, max_line)
+        if last_line <= covered_end:
+            continue
+        first_line = max(first_line, covered_end + 1)
+        covered_lines += line_counts[last_line] - line_counts[first_line - 1]
+        covered_end = last_line
+    return covered_lines
+
+
+def _get_pair_coverages(segment_users: List[List[int]], segment_lines: List[Dict[int, List[Tuple[int, int, int]]]],
+                        file_line_counts: Dict[int, List[int]]) -> Iterable[Tuple[int, int, int, float]]:
+    # pure python fallback of _get_pair_coverages_numpy
+    pair_segments = {}
+    for segment_idx, users in enumerate(segment_users):
+        for a in range(len(users)):
+            for b in range(a + 1, len(users)):
+                segments = pair_segments.get((users[a], users[b]))
+                if segments is None:
+                    pair_segments[(users[a], users[b])] = [segment_idx]
+                else:
+                    segments.append(segment_idx)
+    for (i, j), segments in pair_segments.items():
+        best_similarity = 0.0
+        best_shared_lines = 0
+        for user in (i, j):
+            file_lines = {}
+            for segment_idx in segments:
+                for file_id, first_line, last_line in segment_lines[segment_idx][user]:
+                    file_lines.setdefault(file_id, []).append((first_line, last_line))
+            for file_id, lines in file_lines.items():
+                line_counts = file_line_counts[file_id]
+                shared_lines = _count_covered_lines(lines, line_counts)
+                similarity = shared_lines / line_counts[-1] if line_counts[-1] else 0.0
+                if (similarity, shared_lines) > (best_similarity, best_shared_lines):
+                    best_similarity = similarity
+                    best_shared_lines = shared_lines
+        yield i, j, best_shared_lines, best_similarity
+
+
+def _get_pair_coverages_numpy(segment_users: List[List[int]],
+                              segment_lines: List[Dict[int, List[Tuple[int, int, int]]]],
+                              file_line_counts: Dict[int, List[int]], num_users: int) \
+        -> Iterable[Tuple[int, int, int, float]]:
+    """
+    Accumulate the covered lines of each pair of users in sparse (coordinate) arrays. The segments with the same number
+    of users are expanded into (pair, segment, user) entries at once, which are joined with the occurrences of the
+    segments into (pair, file, first line, last line) ranges. The union of the ranges of each (pair, file) is measured
+    after sorting them, by comparing each range with the running max of the previous ends.
+    """
+    groups = {}  # number of users -> (users of the segments, indices of the segments)
+    for segment_idx, users in enumerate(segment_users):
+        group = groups.get(len(users))
+        if group is None:
+            groups[len(users)] = group = ([], [])
+        group[0].append(users)
+        group[1].append(segment_idx)
+    pair_keys = []  # linear index of the pair
+    entry_keys = []  # linear index of (segment, user), for each user of the pair
+    for occ_users, (users_list, segment_indices) in groups.items():
+        users = np.array(users_list, dtype=np.int64)  # the rows are sorted
+        rows, cols = np.triu_indices(occ_users, 1)
+        segment_keys = np.array(segment_indices, dtype=np.int64)[:, None] * num_users
+        keys = (users[:, rows] * num_users + users[:, cols]).ravel()
+        pair_keys += [keys, keys]
+        entry_keys += [(segment_keys + users[:, rows]).ravel(), (segment_keys + users[:, cols]).ravel()]
+    if not pair_keys:
+        return []
+    pair_keys = np.concatenate(pair_keys)
+    entry_keys = np.concatenate(entry_keys)
+    unique_pair_keys = np.unique(pair_keys)
+
+    # the occurrences of the segments, sorted by (segment, user)
+    file_indices = {}
+    file_bases = []  # offset of the cumulative line counts of each file in all_line_counts
+    all_line_counts = []
+    for file_id, line_counts in file_line_counts.items():
+        file_indices[file_id] = len(file_bases)
+        file_bases.append(len(all_line_counts))
+        all_line_counts += line_counts
+    file_bases = np.array(file_bases, dtype=np.int64)
+    all_line_counts = np.array(all_line_counts, dtype=np.int64)
+    file_max_lines = np.array([len(line_counts) - 1 for line_counts in file_line_counts.values()], dtype=np.int64)
+    occ_keys = []
+    occ_files = []
+    occ_first_lines = []
+    occ_last_lines = []
+    for segment_idx, user_lines in enumerate(segment_lines):
+        for user, lines in user_lines.items():
+            key = segment_idx * num_users + user
+            for file_id, first_line, last_line in lines:
+                occ_keys.append(key)
+                occ_files.append(file_indices[file_id])
+                occ_first_lines.append(first_line)
+                occ_last_lines.append(last_line)
+    occ_keys = np.array(occ_keys, dtype=np.int64)
+    order = np.argsort(occ_keys, kind='stable')
+    occ_keys = occ_keys[order]
+
+    # join the entries with the occurrences
+    starts = np.searchsorted(occ_keys, entry_keys, 'left')
+    counts = np.searchsorted(occ_keys, entry_keys, 'right') - starts
+    entry_indices = np.repeat(np.arange(len(entry_keys)), counts)
+    occ_indices = order[starts[entry_indices] + np.arange(len(entry_indices)) - np.repeat(np.cumsum(counts) - counts,
+                                                                                         counts)]
+    shared_lines = np.zeros(len(unique_pair_keys), dtype=np.int64)
+    similarities = np.zeros(len(unique_pair_keys))
+    if len(occ_indices):
+        pairs = pair_keys[entry_indices]
+        files = np.array(occ_files, dtype=np.int64)[occ_indices]
+        first_lines = np.array(occ_first_lines, dtype=np.int64)[occ_indices]
+        last_lines = np.minimum(np.array(occ_last_lines, dtype=np.int64)[occ_indices], file_max_lines[files])
+
+        # the union of the ranges of each (pair, file) group
+        order = np.lexsort((first_lines, files, pairs))
+        pairs = pairs[order]
+        files = files[order]
+        first_lines = first_lines[order]
+        last_lines = last_lines[order]
+        new_groups = np.empty(len(order), dtype=bool)
+        new_groups[0] = True
+        new_groups[1:] = (pairs[1:] != pairs[:-1]) | (files[1:] != files[:-1])
+        group_ids = np.cumsum(new_groups) - 1
+        group_offsets = group_ids * (int(file_max_lines.max()) + 1)  # so that the running max restarts in each group
+        covered_ends = np.empty(len(order), dtype=np.int64)
+        covered_ends[0] = 0
+        covered_ends[1:] = np.maximum.accumulate(last_lines + group_offsets)[:-1]
+        covered_ends = np.maximum(covered_ends, group_offsets) - group_offsets
+        first_lines = np.maximum(first_lines, covered_ends + 1)
+        bases = file_bases[files]
+        covered_lines = np.where(last_lines > covered_ends,
+                                 all_line_counts[bases + last_lines] - all_line_counts[bases + first_lines - 1], 0)
+
+        # the best file of each pair, by (similarity, shared lines)
+        group_starts = np.flatnonzero(new_groups)
+        group_pairs = pairs[group_starts]
+        group_files = files[group_starts]
+        group_shared_lines = np.bincount(group_ids, weights=covered_lines).astype(np.int64)
+        group_code_lines = all_line_counts[file_bases[group_files] + file_max_lines[group_files]]
+        group_similarities = np.where(group_code_lines > 0, group_shared_lines / np.maximum(group_code_lines, 1), 0.0)
+        order = np.lexsort((-group_shared_lines, -group_similarities, group_pairs))
+        best = np.empty(len(order), dtype=bool)
+        best[0] = True
+        best[1:] = group_pairs[order[1:]] != group_pairs[order[:-1]]
+        best = order[best]
+        best_indices = np.searchsorted(unique_pair_keys, group_pairs[best])
+        shared_lines[best_indices] = group_shared_lines[best]
+        similarities[best_indices] = group_similarities[best]
+    return zip((unique_pair_keys // num_users).tolist(), (unique_pair_keys % num_users).tolist(),
+               shared_lines.tolist(), similarities.tolist())
+
+
+def get_default_max_occ_users(num_users: int) -> int:
+    """
+    Get the default max_occ_users of the all-pairs similarities of num_users users.
+    """
+    return max(SIMILARITY_MIN_MAX_OCC_USERS, int(num_users * SIMILARITY_MAX_OCC_USERS_RATIO))
+
+
+def get_similarity_clusters(similarities: Iterable[Tuple[int, int, int, float]], threshold: float) -> List[List[int]]:
+    """
+    Group the users into clusters (connected components) by the pairs with similarity >= threshold. Returns the clusters
+    sorted by size (descending), each as a sorted list of user ids.
+    """
+    parents = {}
+
+    def find(x):
+        root = x
+        while parents[root] != root:
+            root = parents[root]
+        while parents[x] != root:  # path compression
+            parents[x], x = root, parents[x]
+        return root
+
+    for uid, other_uid, _, similarity in similarities:
+        if similarity < threshold:
+            continue
+        parents.setdefault(uid, uid)
+        parents.setdefault(other_uid, other_uid)
+        root, other_root = find(uid), find(other_uid)
+        if root != other_root:
+            parents[other_root] = root
+
+    clusters = {}
+    for uid in parents:
+        clusters.setdefault(find(uid), []).append(uid)
+    return sorted((sorted(cluster) for cluster in clusters.values()), key=lambda c: (-len(c), c[0]))
+
+
+def test_process_submissions(task_id: int, requirement_id: int, min_index_height: int, compact_keys: bool = True):
     from models import SubmissionFile, db, Submission
     from server import app
     with app.test_request_context():
-        index = CodeSegmentIndex(min_index_height=min_index_height)
+        index = CodeSegmentIndex(min_index_height=min_index_height, compact_keys=compact_keys)
         data_folder = app.config['DATA_FOLDER']
         user_set = set()
         valid_file_count = 0
@@ -335,7 +1235,7 @@ def test_process_submissions(task_id: int, requirement_id: int, min_index_height
             user_set.add(uid)
             try:
                 index.process_file(uid, sid, os.path.join(data_folder, path), md5)
-            except SyntaxError:
+            except (SyntaxError, RecursionError, MemoryError):
                 logger.warning('Syntax Error in (uid: %s, sid: %s)' % (uid, sid))
                 syntax_error_count += 1
                 continue
@@ -346,9 +1246,20 @@ def test_process_submissions(task_id: int, requirement_id: int, min_index_height
 
 
 def test():
+    parser = argparse.ArgumentParser(description='Index the submissions of a requirement and print the duplicates')
+    parser.add_argument('task_id', type=int)
+    parser.add_argument('requirement_id', type=int)
+    parser.add_argument('--min-index-height', type=int, default=5)
+    parser.add_argument('--max-occ-users', type=int, default=100)
+    parser.add_argument('--dump-keys', action='store_true',
+                        help='key the segments by the full dump of their AST (for debugging), which keeps the O(n^3) '
+                             'cost of indexing the partial lists of n statements, so not for large corpora')
+    args = parser.parse_args()
+
     logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-    index = test_process_submissions(1, 1, 5)
-    results = index.get_duplicates(max_occ_users=100)
+    index = test_process_submissions(args.task_id, args.requirement_id, args.min_index_height,
+                                     compact_keys=not args.dump_keys)
+    results = index.get_duplicates(max_occ_users=args.max_occ_users)
     index.pretty_print_results(results)
 
 
@@ -0,0 +1,26 @@
+import os
+from typing import Optional, Union
+
+from anti_plagiarism.code_analysis import CodeSegmentIndex
+from anti_plagiarism.fingerprint import FingerprintIndex
+
+
+def get_file_ext(file_name: str) -> str:
+    return os.path.splitext(file_name)[1].lower()
+
+
+def is_supported_file(file_name: str) -> bool:
+    file_ext = get_file_ext(file_name)
+    return file_ext == '.py' or FingerprintIndex.is_supported_ext(file_ext)
+
+
+def create_index(file_ext: str) -> Optional[Union[CodeSegmentIndex, FingerprintIndex]]:
+    """
+    Create an empty index for the files with the given extension: an AST index for Python files, or a token
+    fingerprint index for the other supported source files. Returns None if the extension is not supported.
+    """
+    if file_ext == '.py':
+        return CodeSegmentIndex(compact_keys=True)
+    if FingerprintIndex.is_supported_ext(file_ext):
+        return FingerprintIndex(file_ext)
+    return None
@@ -0,0 +1,598 @@
+import logging
+import re
+import sys
+import zlib
+from array import array
+from collections import deque
+from typing import Optional, Tuple, Dict, List, Iterable, Iterator, AbstractSet
+
+from anti_plagiarism.code_analysis import CodeSegment, CodeOccurrence, CodeFileInfo, CodeSegmentIndex, \
+    get_default_max_occ_users
+from utils.upload import md5sum
+
+logger = logging.getLogger(__name__)
+
+# comment syntax of the supported languages
+_C_COMMENT = r'//[^\n]*|/\*.*?\*/'
+_HASH_COMMENT = r'\#[^\n]*'
+_DASH_COMMENT = r'--[^\n]*|/\*.*?\*/'
+_PERCENT_COMMENT = r'%[^\n]*'
+
+_EXT_COMMENTS = {
+    '.c': _C_COMMENT, '.h': _C_COMMENT, '.cc': _C_COMMENT, '.cpp': _C_COMMENT, '.cxx': _C_COMMENT,
+    '.hpp': _C_COMMENT, '.java': _C_COMMENT, '.js': _C_COMMENT, '.jsx': _C_COMMENT, '.ts': _C_COMMENT,
+    '.tsx': _C_COMMENT, '.cs': _C_COMMENT, '.go': _C_COMMENT, '.rs': _C_COMMENT, '.kt': _C_COMMENT,
+    '.scala': _C_COMMENT, '.swift': _C_COMMENT, '.php': _C_COMMENT, '.dart': _C_COMMENT,
+    '.sh': _HASH_COMMENT, '.r': _HASH_COMMENT, '.rb': _HASH_COMMENT, '.pl': _HASH_COMMENT, '.jl': _HASH_COMMENT,
+    '.sql': _DASH_COMMENT, '.hs': _DASH_COMMENT, '.lua': _DASH_COMMENT,
+    '.m': _PERCENT_COMMENT, '.pro': _PERCENT_COMMENT,
+}
+
+# Reserved words of the supported languages, which are kept as they are. The other identifiers are all normalised to
+# the same token, so that renaming variables does not change the fingerprints.
+_KEYWORDS = frozenset('''
+    abstract and as assert async await auto begin bool boolean break byte case catch char class const continue def
+    default defer delete do double elif else elsif end enum except explicit export extends extern false final finally
+    float fn for foreach friend from func function go goto if impl implements import in inline instanceof int interface
+    internal let long loop match mod module mut namespace new nil not null object operator or override package private
+    protected public raise register repeat return select self short signed sizeof static struct super switch template
+    then this throw throws trait true try type typedef typeof union unless unsafe unsigned until use using val var
+    virtual void volatile when where while with yield
+'''.split())
+
+_token_patterns = {}
+_token_codes = {}
+
+# Polynomial rolling hash (modulo the Mersenne prime 2^61 - 1) over the token codes of k-grams
+_ROLLING_HASH_MODULUS = (1 << 61) - 1
+_ROLLING_HASH_BASE = 1000003
+
+
+def _get_token_pattern(comment: str):
+    pattern = _token_patterns.get(comment)
+    if pattern is None:
+        _token_patterns[comment] = pattern = re.compile(r'''
+            (?P<space>\s+)
+            | (?P<comment>%s)
+            | (?P<string>"(?:\\.|[^"\\\n])*"|'(?:\\.|[^'\\\n])*'|`(?:\\.|[^`\\])*`)
+            | (?P<number>\.?\d[\w.]*)
+            | (?P<name>[^\W\d][\w$]*|\$[\w$]*)
+            | (?P<other>.)
+        ''' % comment, re.S | re.X)
+    return pattern
+
+
+def _get_token_code(token: str) -> int:
+    code = _token_codes.get(token)
+    if code is None:
+        _token_codes[token] = code = zlib.crc32(token.encode())  # stable across processes, unlike hash()
+    return code
+
+
+def tokenize(code: str, file_ext: str) -> Tuple[List[int], List[int], List[int]]:
+    """
+    Split the code into normalised tokens, ignoring the white spaces and comments. Returns the codes of the tokens and
+    their line numbers and column offsets.
+    """
+    pattern = _get_token_pattern(_EXT_COMMENTS.get(file_ext, _C_COMMENT))
+    codes = []
+    linenos = []
+    col_offsets = []
+    lineno = 1
+    line_start = 0
+    for m in pattern.finditer(code):
+        kind = m.lastgroup
+        if kind == 'name':
+            token = m.group()
+            if token not in _KEYWORDS:
+                token = 'V'
+        elif kind == 'number':
+            token = 'N'
+        elif kind == 'string':
+            token = 'S'
+        elif kind == 'other':
+            token = m.group()
+        else:
+            token = None
+        start = m.start()
+        if token is not None:
+            codes.append(_get_token_code(token))
+            linenos.append(lineno)
+            col_offsets.append(start - line_start)
+        if kind == 'space' or kind == 'comment' or kind == 'string':  # the tokens that may span lines
+            text = m.group()
+            newlines = text.count('\n')
+            if newlines:
+                lineno += newlines
+                line_start = start + text.rindex('\n') + 1
+    return codes, linenos, col_offsets
+
+
+def winnow(hashes: List[int], window_size: int) -> List[int]:
+    """
+    Select the fingerprints from the k-gram hashes by robust winnowing: the minimum hash (the rightmost one if tied) of
+    every window of consecutive hashes, recorded once per position. Returns the positions of the fingerprints. It
+    guarantees that any match of at least (window size + k - 1) tokens shares a fingerprint.
+    """
+    if not hashes:
+        return []
+    if len(hashes) < window_size:  # short file, take the minimum of the only (partial) window
+        return [min(range(len(hashes)), key=lambda i: (hashes[i], -i))]
+    positions = []
+    window = deque()  # positions in the current window with increasing hashes
+    last = -1
+    for i, h in enumerate(hashes):
+        while window and hashes[window[-1]] >= h:
+            window.pop()
+        window.append(i)
+        if window[0] <= i - window_size:
+            window.popleft()
+        if i >= window_size - 1 and window[0] != last:
+            last = window[0]
+            positions.append(last)
+    return positions
+
+
+class FingerprintMatch(CodeSegment):
+    """
+    The code shared by two files, as a result of `FingerprintIndex.get_duplicates`. The key is the pair of file ids,
+    and `total_nodes` is the number of shared fingerprints. The matched line ranges of the first file are kept for
+    printing the code.
+    """
+    __slots__ = ('regions',)
+
+    def __init__(self, key, total_fingerprints: int, code_lines: int, regions: List[Tuple[int, int]]):
+        super().__init__(key, None, 0, total_fingerprints, code_lines)
+        self.num_users = 2
+        self.regions = regions
+
+    def to_dict(self) -> dict:
+        return dict(regions=self.regions, total_fingerprints=self.total_nodes)
+
+
+class FingerprintIndex:
+    """
+    Language-independent index of the source files, for the requirements that are not Python files.
+
+    The code is split into normalised tokens (identifiers, numbers and strings are replaced by placeholders, white
+    spaces and comments are ignored), the k-grams of the tokens are hashed with a rolling hash, and a subset of the
+    hashes is selected as the fingerprints of the file by winnowing. The fingerprints are kept in an inverted index
+    from each fingerprint to the (user id, file id) pairs of the files that contain it, so that indexing is linear in
+    the size of the code and looking up the files that share code with a file only visits its own fingerprints.
+
+    It provides the same interface as `CodeSegmentIndex` for the store, except that each result of `get_duplicates`
+    is a pair of files sharing code (see `FingerprintMatch`) rather than a shared AST segment. In the file info,
+    `ast_total_nodes` is the number of distinct fingerprints in the file, so that the coverage of a result is the
+    fraction of the fingerprints of the file that are shared.
+    """
+
+    # Rough memory cost (in bytes) of a fingerprint entry, a posting and a fingerprint position of a file.
+    # Only used for estimating the memory usage of an index.
+    _fingerprint_memory_overhead = 160
+    _posting_memory_overhead = 8
+    _position_memory_overhead = 20
+
+    def __init__(self, file_ext: str, kgram_size: int = 10, window_size: int = 6):
+        self.file_ext = file_ext
+        self.kgram_size = kgram_size
+        self.window_size = window_size
+
+        self._index = {}  # fingerprint -> flat (user_id, file_id) pairs of the files with the fingerprint
+        self._file_info_map = {}
+        self._file_code_map = {}
+        # file id -> (user id, fingerprints, line numbers, column offsets, end line numbers) in the order of positions
+        self._file_fingerprint_map = {}
+        self._md5_file_map = {}  # md5 -> (user id, file id) of a processed file with this content
+        self._num_postings = 0
+        self._num_positions = 0
+        self._total_code_size = 0  # kept up to date, so that the stats can be read while the index is being updated
+
+    def _set_code(self, file_id, code: Optional[str]):
+        old_code = self._file_code_map.pop(file_id, None)
+        if old_code is not None:
+            self._total_code_size -= len(old_code)
+        if code is not None:
+            self._file_code_map[file_id] = code
+            self._total_code_size += len(code)
+
+    @staticmethod
+    def is_supported_ext(file_ext: str) -> bool:
+        return file_ext in _EXT_COMMENTS
+
+    def extract_code(self, code: str) -> Tuple[array, array, array, array]:
+        """
+        Get the fingerprints of the code with their line numbers, column offsets and end line numbers.
+        """
+        codes, linenos, col_offsets = tokenize(code, self.file_ext)
+        k = self.kgram_size
+        hashes = []
+        if len(codes) >= k:
+            modulus = _ROLLING_HASH_MODULUS
+            base = _ROLLING_HASH_BASE
+            high_base = pow(base, k - 1, modulus)
+            h = 0
+            for i, c in enumerate(codes):
+                if i >= k:
+                    h = (h - codes[i - k] * high_base) % modulus
+                h = (h * base + c) % modulus
+                if i >= k - 1:
+                    hashes.append(h)
+        positions = winnow(hashes, self.window_size)
+        return (array('q', (hashes[i] for i in positions)), array('i', (linenos[i] for i in positions)),
+                array('i', (col_offsets[i] for i in positions)), array('i', (linenos[i + k - 1] for i in positions)))
+
+    def process_file(self, user_id, file_id, file_path: str, file_md5: str = None) -> CodeFileInfo:
+        file_info = self._check_processed_file(user_id, file_id, file_md5)
+        if file_info is not None:
+            return file_info
+        if not file_md5:  # if no md5 given, compute it now
+            file_md5 = md5sum(file_path)
+        source = self._md5_file_map.get(file_md5)
+        if source is not None:  # identical to a processed file, share its fingerprints
+            _, source_file_id = source
+            _, *fingerprints = self._file_fingerprint_map[source_file_id]
+            return self._add_file_fingerprints(user_id, file_id, self._file_code_map.get(source_file_id), file_md5,
+                                               *fingerprints)
+        return self.add_extracted_file(user_id, file_id, self.extract_file(user_id, file_id, file_path, file_md5))
+
+    def process_files(self, files: Iterable[Tuple[int, int, str, Optional[str]]], workers: int = 1) \
+            -> Iterable[Tuple[int, int, Optional[CodeFileInfo], Optional[Exception]]]:
+        """
+        Process `(user_id, file_id, file_path, file_md5)` tuples and yield `(user_id, file_id, file_info, error)` for
+        each file in the given order. Tokenizing is cheap compared with parsing, so the files are always processed in
+        the calling process and `workers` is ignored.
+        """
+        for user_id, file_id, file_path, file_md5 in files:
+            try:
+                yield user_id, file_id, self.process_file(user_id, file_id, file_path, file_md5), None
+            except IOError as e:
+                yield user_id, file_id, None, e
+
+    def extract_file(self, user_id, file_id, file_path: str, file_md5: str = None) \
+            -> Tuple[str, str, array, array, array, array]:
+        """
+        Read and fingerprint a file without changing the index. The result can be added to the index by
+        `add_extracted_file` later.
+        """
+        code = CodeSegmentIndex._read_code(user_id, file_id, file_path)
+        if not file_md5:  # if no md5 given, compute it now
+            file_md5 = md5sum(file_path)
+        return (code, file_md5) + self.extract_code(code)
+
+    def extract_files(self, files: Iterable[Tuple[int, int, str, Optional[str]]], workers: int = 1) \
+            -> Iterator[Tuple[int, int, Optional[Tuple[str, str, array, array, array, array]], Optional[Exception]]]:
+        """
+        Read and fingerprint many files without changing the index, see `CodeSegmentIndex.extract_files`. The files are
+        always processed in the calling process and `workers` is ignored.
+        """
+        dispatched_md5s = set()
+        for user_id, file_id, file_path, file_md5 in files:
+            file_info = self._file_info_map.get(file_id)
+            if (file_info is not None and file_info.md5 == file_md5) or \
+                    (file_md5 and (file_md5 in self._md5_file_map or file_md5 in dispatched_md5s)):
+                yield user_id, file_id, None, None
+                continue
+            if file_md5:
+                dispatched_md5s.add(file_md5)
+            try:
+                yield user_id, file_id, self.extract_file(user_id, file_id, file_path, file_md5), None
+            except IOError as e:
+                yield user_id, file_id, None, e
+
+    def add_extracted_file(self, user_id, file_id, extracted: Tuple[str, str, array, array, array, array]) \
+            -> CodeFileInfo:
+        file_info = self._check_processed_file(user_id, file_id, extracted[1])
+        if file_info is not None:
+            return file_info
+        return self._add_file_fingerprints(user_id, file_id, *extracted)
+
+    def extract_segment_keys(self, file_path: str) -> frozenset:
+        """
+        Get the fingerprints of a file without changing the index, e.g. to exclude the fingerprints of a template from
+        the results of `get_duplicates`.
+        """
+        fingerprints, _, _, _ = self.extract_code(CodeSegmentIndex._read_code(None, None, file_path))
+        return frozenset(fingerprints)
+
+    def has_identical_file(self, file_md5: str) -> bool:
+        return file_md5 in self._md5_file_map
+
+    def _check_processed_file(self, user_id, file_id, file_md5: Optional[str]) -> Optional[CodeFileInfo]:
+        file_info = self._file_info_map.get(file_id)
+        if file_info is not None:
+            if file_info.md5 == file_md5:
+                logger.info('Skipped processing file as already processed: uid=%s, fid/sid=%s, md5=%s'
+                            % (user_id, file_id, file_md5))
+                return file_info
+            else:
+                logger.info('Removing index for old file: uid=%s, fid/sid=%s, old_md5=%s, new_md5=%s'
+                            % (user_id, file_id, file_info.md5, file_md5))
+                self.remove_code(user_id, file_id)
+        return None
+
+    def _add_file_fingerprints(self, user_id, file_id, code: Optional[str], file_md5: str, fingerprints: array,
+                               linenos: array, col_offsets: array, end_linenos: array) -> CodeFileInfo:
+        if code is not None:
+            self._set_code(file_id, code)
+        self._file_fingerprint_map[file_id] = (user_id, fingerprints, linenos, col_offsets, end_linenos)
+        unique_fingerprints = dict.fromkeys(fingerprints)
+        for fingerprint in unique_fingerprints:
+            postings = self._index.get(fingerprint)
+            if postings is None:
+                self._index[fingerprint] = postings = array('i')
+            postings.extend((user_id, file_id))
+        self._num_postings += len(unique_fingerprints)
+        self._num_positions += len(fingerprints)
+        file_info = CodeFileInfo(md5=file_md5, ast_height=0, ast_total_nodes=len(unique_fingerprints))
+        self._file_info_map[file_id] = file_info
+        self._md5_file_map[file_md5] = (user_id, file_id)
+        return file_info
+
+    def remove_code(self, user_id, file_id):
+        file_info = self._file_info_map.pop(file_id, None)
+        if file_info is not None and self._md5_file_map.get(file_info.md5) == (user_id, file_id):
+            del self._md5_file_map[file_info.md5]
+        file_fingerprints = self._file_fingerprint_map.pop(file_id, None)
+        if file_fingerprints is not None:
+            _, fingerprints, _, _, _ = file_fingerprints
+            for fingerprint in dict.fromkeys(fingerprints):
+                postings = self._index.get(fingerprint)
+                if postings is None:
+                    continue
+                remaining_postings = array('i')
+                for i in range(0, len(postings), 2):
+                    if postings[i + 1] != file_id:
+                        remaining_postings.extend(postings[i:i + 2])
+                self._num_postings -= (len(postings) - len(remaining_postings)) // 2
+                if remaining_postings:
+                    self._index[fingerprint] = remaining_postings
+                else:
+                    del self._index[fingerprint]
+            self._num_positions -= len(fingerprints)
+        self._set_code(file_id, None)
+
+    def get_file_info(self, file_id) -> CodeFileInfo:
+        return self._file_info_map.get(file_id)
+
+    def discard_code(self):
+        """
+        Drop the code kept for printing the results, e.g. for a read-only index that is only queried together with
+        another index (see `other_index` of `get_duplicates`).
+        """
+        self._file_code_map = {}
+        self._total_code_size = 0
+
+    def get_stats(self) -> dict:
+        num_fingerprints = len(self._index)
+        memory = num_fingerprints * self._fingerprint_memory_overhead + \
+            self._num_postings * self._posting_memory_overhead + \
+            self._num_positions * self._position_memory_overhead + self._total_code_size
+        return dict(files=len(self._file_info_map), segments=num_fingerprints, occurrences=self._num_postings,
+                    estimated_memory=memory)
+
+    def get_duplicates(self, min_occ_users: int = 2, max_occ_users: int = None,
+                       include_user_id: int = None, include_user_file_id: int = None, exclude_user_id: int = None,
+                       sort_by: str = 'total_nodes', exclude_segment_keys: AbstractSet = None, limit: int = None,
+                       other_index: 'FingerprintIndex' = None) -> List[Tuple[FingerprintMatch,
+                                                                               Dict[int, List[CodeOccurrence]]]]:
+        """
+        Get the pairs of files (of different users) that share fingerprints, sorted by `sort_by` (descending). If
+        include_user_file_id is given, only the pairs with that file are returned, otherwise all the pairs in the index.
+
+        The fingerprints in exclude_segment_keys (e.g. the template), in the files of exclude_user_id or in more than
+        max_occ_users users (e.g. boilerplate code) are ignored. Without include_user_file_id, each fingerprint expands
+        into all the pairs of its files, so max_occ_users defaults to `get_default_max_occ_users` of the users in the
+        index. Each result has exactly two users, so min_occ_users is only checked for consistency with
+        `CodeSegmentIndex.get_duplicates`.
+
+        If `other_index` is given (e.g. a historical corpus), the pairs of the included file with the files in that
+        index are returned as well. The other index is only read.
+        """
+        if min_occ_users is not None and min_occ_users > 2:
+            return []
+        if include_user_file_id is not None and include_user_id is None:
+            logger.warning('parameter "include_user_file_id" is ignored when "include_user_id" is not provided')
+            include_user_file_id = None
+        if include_user_file_id is None and max_occ_users is None:
+            max_occ_users = get_default_max_occ_users(
+                len({file_fingerprints[0] for file_fingerprints in self._file_fingerprint_map.values()}))
+        other_postings_map = other_index._index if other_index is not None else None
+
+        def _is_counted(postings: array, other_postings: Optional[array]) -> bool:
+            if exclude_user_id is None and max_occ_users is None:
+                return True
+            user_ids = set(postings[0::2])
+            if other_postings is not None:
+                user_ids.update(other_postings[0::2])
+            if exclude_user_id is not None and exclude_user_id in user_ids:
+                return False
+            return max_occ_users is None or len(user_ids) <= max_occ_users
+
+        pair_counts = {}  # (file id, other file id, whether the other file is in other_index) -> shared fingerprints
+        if include_user_file_id is not None:
+            file_fingerprints = self._file_fingerprint_map.get(include_user_file_id)
+            if file_fingerprints is None or file_fingerprints[0] != include_user_id:
+                return []
+            for fingerprint in dict.fromkeys(file_fingerprints[1]):
+                if exclude_segment_keys is not None and fingerprint in exclude_segment_keys:
+                    continue
+                postings = self._index[fingerprint]
+                other_postings = other_postings_map.get(fingerprint) if other_postings_map is not None else None
+                if len(postings) == 2 and other_postings is None:  # only in the included file
+                    continue
+                if not _is_counted(postings, other_postings):
+                    continue
+                for postings_, is_other in ((postings, False), (other_postings, True)):
+                    if postings_ is None:
+                        continue
+                    for i in range(0, len(postings_), 2):
+                        if postings_[i] != include_user_id:
+                            pair = (include_user_file_id, postings_[i + 1], is_other)
+                            pair_counts[pair] = pair_counts.get(pair, 0) + 1
+        else:
+            for fingerprint, postings in self._index.items():
+                if len(postings) < 4:
+                    continue
+                if exclude_segment_keys is not None and fingerprint in exclude_segment_keys:
+                    continue
+                if not _is_counted(postings, None):
+                    continue
+                for i in range(0, len(postings), 2):
+                    for j in range(i + 2, len(postings), 2):
+                        if postings[i] != postings[j]:
+                            pair = (min(postings[i + 1], postings[j + 1]), max(postings[i + 1], postings[j + 1]), False)
+                            pair_counts[pair] = pair_counts.get(pair, 0) + 1
+
+        results = [(file_id, other_file_id, is_other, count)
+                   for (file_id, other_file_id, is_other), count in pair_counts.items()]
+        if sort_by == 'total_nodes':
+            results.sort(key=lambda x: (-x[3], x[0], x[1]))
+            if limit is not None:
+                results = results[:limit]
+
+        excluded = exclude_segment_keys or frozenset()
+
+        def _is_shared(fingerprint) -> bool:
+            if fingerprint in excluded:
+                return False
+            postings = self._index.get(fingerprint)
+            other_postings = other_postings_map.get(fingerprint) if other_postings_map is not None else None
+            return postings is None or _is_counted(postings, other_postings)
+
+        matches = []
+        for file_id, other_file_id, is_other, count in results:
+            user_id, *positions = self._file_fingerprint_map[file_id]
+            other_user_id, *other_positions = (other_index if is_other else self)._file_fingerprint_map[other_file_id]
+            shared = set(positions[0]).intersection(other_positions[0])
+            shared = {fingerprint for fingerprint in shared if _is_shared(fingerprint)}
+            regions = self._get_matched_regions(shared, *positions)
+            other_regions = self._get_matched_regions(shared, *other_positions)
+            code_lines = sum(end - start + 1 for start, end, _ in regions)
+            match = FingerprintMatch((file_id, other_file_id), count, code_lines,
+                                     [(start, end) for start, end, _ in regions])
+            occ_users = {user_id: [CodeOccurrence(user_id, file_id, start, col_offset)
+                                   for start, _, col_offset in regions]}
+            other_occurrences = [CodeOccurrence(other_user_id, other_file_id, start, col_offset)
+                                 for start, _, col_offset in other_regions]
+            occ_users.setdefault(other_user_id, []).extend(other_occurrences)
+            matches.append((match, occ_users))
+        if sort_by != 'total_nodes':
+            matches.sort(key=lambda x: getattr(x[0], sort_by), reverse=True)
+            if limit is not None:
+                matches = matches[:limit]
+        return matches
+
+    @staticmethod
+    def _get_matched_regions(shared: set, fingerprints: array, linenos: array, col_offsets: array,
+                             end_linenos: array) -> List[Tuple[int, int, int]]:
+        # merge the overlapping or adjacent lines of the shared fingerprints into (start line, end line, column offset)
+        regions = []
+        for fingerprint, start, col_offset, end in zip(fingerprints, linenos, col_offsets, end_linenos):
+            if fingerprint not in shared:
+                continue
+            if regions and start <= regions[-1][1] + 1:
+                if end > regions[-1][1]:
+                    regions[-1] = (regions[-1][0], end, regions[-1][2])
+            else:
+                regions.append((start, end, col_offset))
+        return regions
+
+    def get_user_similarities(self, min_code_lines: int = None, max_occ_users: int = None,
+                              exclude_user_id: int = None, exclude_segment_keys: AbstractSet = None) \
+            -> List[Tuple[int, int, int, float]]:
+        """
+        Compute the similarity of every pair of users that share code in one pass over the index.
+
+        Returns (user_id, other_user_id, shared_fingerprints, similarity) tuples sorted by similarity (descending),
+        where similarity is the number of shared fingerprints divided by the number of fingerprints of the smaller
+        user. min_code_lines is ignored, the other filters are the same as `CodeSegmentIndex.get_user_similarities`.
+        """
+        user_sizes = {}
+        for user_id, fingerprints, _, _, _ in self._file_fingerprint_map.values():
+            user_sizes.setdefault(user_id, set()).update(fingerprints)
+        user_sizes = {user_id: len(fingerprints) for user_id, fingerprints in user_sizes.items()}
+
+        candidates = []
+        candidate_user_ids = set()
+        for fingerprint, postings in self._index.items():
+            if len(postings) < 4:
+                continue
+            if exclude_segment_keys is not None and fingerprint in exclude_segment_keys:
+                continue
+            user_ids = sorted(set(postings[0::2]))
+            if len(user_ids) < 2:
+                continue
+            if exclude_user_id is not None and exclude_user_id in user_ids:
+                continue
+            candidates.append(user_ids)
+            candidate_user_ids.update(user_ids)
+        if max_occ_users is None:
+            max_occ_users = get_default_max_occ_users(len(candidate_user_ids))
+
+        pair_weights = {}
+        for user_ids in candidates:
+            if len(user_ids) > max_occ_users:
+                continue
+            for a in range(len(user_ids)):
+                for b in range(a + 1, len(user_ids)):
+                    pair = (user_ids[a], user_ids[b])
+                    pair_weights[pair] = pair_weights.get(pair, 0) + 1
+
+        results = []
+        for (uid, other_uid), weight in pair_weights.items():
+            size = min(user_sizes[uid], user_sizes[other_uid])
+            similarity = min(1.0, weight / size) if size else 0.0
+            results.append((uid, other_uid, weight, similarity))
+        results.sort(key=lambda x: (-x[3], -x[2], x[0], x[1]))
+        return results
+
+    def format_result(self, result: Tuple[FingerprintMatch, Dict[int, List[CodeOccurrence]]],
+                      other_index: 'FingerprintIndex' = None) -> str:
+        match, occ_users = result
+        lines = ['%-18s%-22s%-16s%-8s%s' % ('User/Team ID', 'File/Submission ID', 'Coverage', 'MD5', 'Location')]
+        for uid, occ_user_items in occ_users.items():
+            lines.append(str(uid))
+            for occ in occ_user_items:
+                md5 = None
+                coverage = None
+                file_info = self._file_info_map.get(occ.file_id)
+                if file_info is None and other_index is not None:
+                    file_info = other_index.get_file_info(occ.file_id)
+                if file_info:
+                    md5 = file_info.md5
+                    if file_info.ast_total_nodes:
+                        coverage = '%.f%%' % (match.total_nodes / file_info.ast_total_nodes * 100)
+                md5_short = md5[:6] if md5 else None
+                lines.append('%-18s%-22s%-16s%-8sLine %s, Col %s' % ('', occ.file_id, coverage, md5_short, occ.lineno,
+                                                                     occ.col_offset))
+        lines.append('Shared Fingerprints: %d, Lines: %d' % (match.total_nodes, match.code_lines))
+        code = self._file_code_map.get(match.key[0])
+        if code is None:
+            lines.append('(code not available)')
+        else:
+            code_lines = code.splitlines()
+            for i, (start, end) in enumerate(match.regions):
+                if i:
+                    lines.append('...')
+                lines.extend(code_lines[start - 1:end])
+        return '\n'.join(lines) + '\n'
+
+    def pretty_print_results(self, results, file=sys.stdout):
+        for chunk in self.iter_pretty_print_results(results):
+            file.write(chunk)
+
+    def iter_pretty_print_results(self, results: List[Tuple[FingerprintMatch, Dict[int, List[CodeOccurrence]]]],
+                                  offset: int = 0, limit: int = None) -> Iterator[str]:
+        """
+        Generate the report of the results piece by piece, see `CodeSegmentIndex.iter_pretty_print_results`.
+        """
+        yield 'Total Results: %d\n' % len(results)
+        end = len(results) if limit is None else min(len(results), offset + limit)
+        for i in range(offset, end):
+            yield self.format_result_block(i, results[i], None)
+
+    def format_result_block(self, i: int, result: Tuple[FingerprintMatch, Dict[int, List[CodeOccurrence]]],
+                            file_nodes_cache: Optional[dict], other_index: 'FingerprintIndex' = None) -> str:
+        # no nodes to recover, file_nodes_cache is only accepted for compatibility with CodeSegmentIndex
+        header = '--------------------------------------- #%-2s ---------------------------------------\n' % (i + 1)
+        return header + self.format_result(result, other_index)
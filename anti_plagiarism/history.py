@@ -0,0 +1,189 @@
+import argparse
+import logging
+import os
+import pickle
+from threading import Lock
+from typing import List, Optional, Dict, Union
+
+from anti_plagiarism.code_analysis import CodeSegmentIndex
+from anti_plagiarism.engines import create_index, get_file_ext, is_supported_file
+from anti_plagiarism.fingerprint import FingerprintIndex
+from utils.file import FileUtils
+
+logger = logging.getLogger(__name__)
+
+# Increase this version whenever the pickled structure of the index changes (see store.SNAPSHOT_VERSION), so that stale
+# corpora are ignored and have to be rebuilt.
+CORPUS_VERSION = 2
+
+
+class HistoricalCorpus:
+    """
+    Read-only index of the submissions of a logical assignment (e.g. "comp9021-ass1") in previous terms.
+
+    The corpus is built offline from the files of the past requirements of the assignment and saved to
+    `<folder>/<name>.corpus`. It is loaded lazily on the first query and never changed afterwards, so it can be shared
+    by the stores of all the requirements linked to the assignment and queried without any lock. The live index of a
+    store is queried together with the corpus instead of being merged with it, so that the old files are not indexed
+    again on every cold start.
+
+    The user/team ids and submission ids of the old files are kept as they are, since they are unique across terms.
+    """
+
+    def __init__(self, name: str, folder: str):
+        self.name = name
+        self.folder = folder
+
+        self._lock = Lock()  # guards the loading
+        self._loaded = False
+        self._index = None
+        self.requirement_ids = []
+
+    def get_path(self) -> str:
+        return os.path.join(self.folder, '%s.corpus' % self.name)
+
+    def get_index(self) -> Optional[Union[CodeSegmentIndex, FingerprintIndex]]:
+        """
+        Get the index of the corpus, loading it on the first call. Returns None if the corpus is not available.
+        """
+        if self._loaded:
+            return self._index
+        with self._lock:
+            if not self._loaded:
+                self._index = self._load()
+                self._loaded = True
+        return self._index
+
+    def get_stats(self) -> dict:
+        """
+        Get the size of the corpus, without loading it.
+        """
+        index = self._index if self._loaded else None
+        return dict(name=self.name, loaded=self._loaded, requirement_ids=self.requirement_ids,
+                    index=index.get_stats() if index is not None else None)
+
+    def _load(self) -> Optional[Union[CodeSegmentIndex, FingerprintIndex]]:
+        path = self.get_path()
+        if not os.path.isfile(path):
+            logger.warning('Historical corpus %s not found: %s' % (self.name, path))
+            return None
+        if not FileUtils.is_private_folder(self.folder):
+            logger.warning('Ignored historical corpus %s: %s is not private to the current user' % (self.name,
+                                                                                                   self.folder))
+            return None
+        try:
+            with open(path, 'rb') as f:
+                corpus = pickle.load(f)
+        except (IOError, EOFError, pickle.UnpicklingError, AttributeError, ImportError):
+            logger.warning('Failed to load historical corpus %s' % self.name, exc_info=True)
+            return None
+        if corpus.get('version') != CORPUS_VERSION:
+            logger.warning('Ignored historical corpus %s: version mismatch, please rebuild it' % self.name)
+            return None
+        self.requirement_ids = corpus['requirement_ids']
+        index = corpus['index']
+        logger.info('Loaded historical corpus %s. requirements: %s, %s' % (self.name, self.requirement_ids,
+                                                                         index.get_stats()))
+        return index
+
+    def build(self, requirement_files: Dict[int, List[tuple]], data_folder: str, workers: Optional[int] = 1,
+              file_ext: str = '.py'):
+        """
+        Build the corpus from the (submission id, user/team id, file) tuples of the past requirements and save it.
+        The index is created in the same way as the live indices of the stores, so that their segment keys match.
+        """
+        index = create_index(file_ext)
+        file_tuples = [t for tuples in requirement_files.values() for t in tuples]
+        error_count = 0
+        for _, _, _, error in index.process_files(((uid, sid, os.path.join(data_folder, file.path), file.md5)
+                                                   for sid, uid, file in file_tuples), workers=workers):
+            if error is not None:
+                error_count += 1
+        index.discard_code()  # the code of the results is always recovered from the live file
+
+        if not os.path.isdir(self.folder):
+            os.makedirs(self.folder, mode=0o700)
+        path = self.get_path()
+        tmp_path = '%s.%d.tmp' % (path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(dict(version=CORPUS_VERSION, name=self.name, requirement_ids=sorted(requirement_files),
+                             index=index), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+        logger.info('Built historical corpus %s. files: %d, errors: %d, %s' % (self.name, len(file_tuples),
+                                                                             error_count, index.get_stats()))
+
+        with self._lock:
+            self.requirement_ids = sorted(requirement_files)
+            self._index = index
+            self._loaded = True
+
+
+_corpora = {}
+_corpora_lock = Lock()
+
+
+def get_corpus(name: str, folder: str) -> HistoricalCorpus:
+    """
+    Get the shared corpus instance of a logical assignment.
+    """
+    with _corpora_lock:
+        corpus = _corpora.get((folder, name))
+        if corpus is None:
+            _corpora[(folder, name)] = corpus = HistoricalCorpus(name, folder)
+        return corpus
+
+
+def get_linked_corpus(requirement_id: int, ap_config: dict, data_folder: str) -> Optional[HistoricalCorpus]:
+    """
+    Get the corpus linked to a requirement by the "history_links" (requirement id -> assignment name) of the
+    anti-plagiarism config, or None if the requirement is not linked. The "history_folder" is relative to the data
+    folder.
+    """
+    folder = ap_config.get('history_folder')
+    name = (ap_config.get('history_links') or {}).get(str(requirement_id))
+    if not folder or not name:
+        return None
+    return get_corpus(name, os.path.join(data_folder, folder))
+
+
+def main():
+    from server import app
+    from services.submission import SubmissionService
+    from services.task import TaskService
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description='Build the historical anti-plagiarism corpus of a logical assignment')
+    parser.add_argument('name', help='name of the logical assignment, e.g. comp9021-ass1')
+    parser.add_argument('requirement_ids', metavar='rid', type=int, nargs='+',
+                        help='ids of the file requirements of the assignment in the previous terms')
+    parser.add_argument('--workers', type=int, default=None, help='number of worker processes (default: CPU cores)')
+    args = parser.parse_args()
+
+    ap_config = app.config.get('ANTI_PLAGIARISM') or {}
+    folder = ap_config.get('history_folder')
+    if not folder:
+        parser.error('history_folder is not configured')
+
+    requirement_files = {}
+    file_exts = set()
+    with app.test_request_context():
+        for requirement_id in args.requirement_ids:
+            requirement = TaskService.get_file_requirement(requirement_id)
+            if requirement is None:
+                parser.error('requirement %d not found' % requirement_id)
+            if not is_supported_file(requirement.name):
+                parser.error('file type of requirement %d not supported' % requirement_id)
+            file_exts.add(get_file_ext(requirement.name))
+            if requirement.task.is_team_task:
+                requirement_files[requirement_id] = SubmissionService.get_team_files(requirement_id)
+            else:
+                requirement_files[requirement_id] = SubmissionService.get_files(requirement_id)
+    if len(file_exts) > 1:
+        parser.error('requirements have different file types: %s' % ', '.join(sorted(file_exts)))
+    data_folder = app.config['DATA_FOLDER']
+    HistoricalCorpus(args.name, os.path.join(data_folder, folder)).build(requirement_files, data_folder, args.workers,
+                                                                         file_exts.pop())
+
+
+if __name__ == '__main__':
+    main()
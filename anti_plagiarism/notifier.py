@@ -0,0 +1,46 @@
+import logging
+from threading import Thread
+from typing import List
+
+import requests
+
+logger = logging.getLogger(__name__)
+
+
+def notify_new_files(server_url: str, requirement_ids: List[int], timeout: float = 5):
+    """
+    Ask the anti-plagiarism server to index the new files of the requirements in the background. The requests are sent
+    from a daemon thread, so that the caller (e.g. a submission request) is never blocked or failed by the server.
+    """
+    if not server_url or not requirement_ids:
+        return
+    Thread(target=_notify, args=(server_url, requirement_ids, timeout), daemon=True).start()
+
+
+def request_prewarm(server_url: str, requirement_ids: List[int], timeout: float = 5) -> bool:
+    """
+    Ask the anti-plagiarism server to build the stores of the requirements in the background at a low priority, e.g.
+    near the deadlines, so that the first checks hit warm indices. The requests are sent synchronously, and whether the
+    server accepted all of them is returned, so that the caller (e.g. the period worker) can retry later.
+    """
+    if not server_url:
+        return False
+    return _notify(server_url, requirement_ids, timeout, True)
+
+
+def _notify(server_url: str, requirement_ids: List[int], timeout: float, prewarm: bool = False) -> bool:
+    accepted = True
+    for requirement_id in requirement_ids:
+        params = dict(rid=requirement_id)
+        if prewarm:
+            params['prewarm'] = 'true'
+        try:
+            resp = requests.post('%s/api/index' % server_url, params=params, timeout=timeout)
+            if resp.status_code // 100 != 2:
+                logger.warning('Failed to notify anti-plagiarism server (rid=%d): [%d] %s' %
+                               (requirement_id, resp.status_code, resp.content))
+                accepted = False
+        except requests.RequestException as e:
+            logger.warning('Failed to notify anti-plagiarism server (rid=%d): %s' % (requirement_id, e))
+            accepted = False
+    return accepted
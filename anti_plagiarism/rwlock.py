@@ -0,0 +1,101 @@
+import time
+from contextlib import contextmanager
+from threading import Condition, Lock
+
+
+class ReadWriteLock:
+    """
+    Readers-writer lock that allows many readers or a single writer at a time.
+
+    Waiting writers are preferred over new readers, so that a steady stream of queries cannot starve the indexing.
+    In turn, the readers that waited for a writer are let in before the next writer, so that a series of short writes
+    (e.g. the chunks of an update) cannot starve the queries either.
+
+    The lock is not reentrant, and a reader must not try to acquire the write lock.
+
+    The number of acquisitions and the time spent waiting for the lock are counted for monitoring.
+    """
+
+    def __init__(self):
+        self._cond = Condition(Lock())
+        self._readers = 0
+        self._writing = False
+        self._waiting_writers = 0
+        self._waiting_readers = 0
+        self._read_turn = 0  # number of waiting readers to let in before the next writer
+
+        self._read_count = 0
+        self._write_count = 0
+        self._read_wait_time = 0.0
+        self._write_wait_time = 0.0
+        self._max_read_wait_time = 0.0
+        self._max_write_wait_time = 0.0
+
+    def acquire_read(self):
+        with self._cond:
+            if self._writing or self._waiting_writers:
+                start_time = time.perf_counter()
+                self._waiting_readers += 1
+                try:
+                    while self._writing or (self._waiting_writers and not self._read_turn):
+                        self._cond.wait()
+                finally:
+                    self._waiting_readers -= 1
+                    if self._read_turn:
+                        self._read_turn -= 1
+                wait_time = time.perf_counter() - start_time
+                self._read_wait_time += wait_time
+                self._max_read_wait_time = max(self._max_read_wait_time, wait_time)
+            self._readers += 1
+            self._read_count += 1
+
+    def release_read(self):
+        with self._cond:
+            self._readers -= 1
+            if not self._readers:
+                self._cond.notify_all()
+
+    def acquire_write(self):
+        with self._cond:
+            if self._writing or self._readers or self._read_turn:
+                start_time = time.perf_counter()
+                self._waiting_writers += 1
+                try:
+                    while self._writing or self._readers or self._read_turn:
+                        self._cond.wait()
+                finally:
+                    self._waiting_writers -= 1
+                wait_time = time.perf_counter() - start_time
+                self._write_wait_time += wait_time
+                self._max_write_wait_time = max(self._max_write_wait_time, wait_time)
+            self._writing = True
+            self._write_count += 1
+
+    def release_write(self):
+        with self._cond:
+            self._writing = False
+            self._read_turn = self._waiting_readers
+            self._cond.notify_all()
+
+    def get_stats(self) -> dict:
+        with self._cond:
+            return dict(readers=self._readers, writing=self._writing, waiting_writers=self._waiting_writers,
+                        read_count=self._read_count, write_count=self._write_count,
+                        read_wait_time=self._read_wait_time, write_wait_time=self._write_wait_time,
+                        max_read_wait_time=self._max_read_wait_time, max_write_wait_time=self._max_write_wait_time)
+
+    @contextmanager
+    def read(self):
+        self.acquire_read()
+        try:
+            yield
+        finally:
+            self.release_read()
+
+    @contextmanager
+    def write(self):
+        self.acquire_write()
+        try:
+            yield
+        finally:
+            self.release_write()
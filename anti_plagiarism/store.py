@@ -1,109 +1,484 @@
 import logging
 import os
+import pickle
 import sys
-from threading import Lock
-from typing import List, Tuple, Dict
+import time
+from contextlib import contextmanager
+from threading import Lock, Thread
+from typing import List, Tuple, Dict, Optional, Iterator
 
-from anti_plagiarism.code_analysis import CodeSegmentIndex, CodeFileInfo, CodeSegment, CodeOccurrence
+from anti_plagiarism.code_analysis import CodeSegmentIndex, CodeFileInfo, CodeSegment, CodeOccurrence, FILE_ERRORS
+from anti_plagiarism.engines import create_index
+from anti_plagiarism.history import HistoricalCorpus
+from anti_plagiarism.rwlock import ReadWriteLock
+from anti_plagiarism.timing import TimingStats
 from models import SubmissionFile
 from services.submission import SubmissionService
+from utils.file import FileUtils
 
 logger = logging.getLogger(__name__)
 
+# Increase this version whenever the pickled structure of the index changes, so that stale snapshots are ignored.
+SNAPSHOT_VERSION = 10
+
+# Incremental updates smaller than this are indexed in the current process, which is cheaper than starting workers.
+PARALLEL_UPDATE_MIN_FILES = 50
+
+# Parsed files are added to the live index in chunks of this size, so that each write lock is only held briefly.
+MERGE_CHUNK_FILES = 5
+
 
 class Store:
     """
     Thread-safe in-memory index store for a requirement.
+
+    The full index is built by `build_workers` worker processes in parallel (serially if it is 1, or by as many
+    processes as CPU cores if it is None).
+
+    If a snapshot folder is given (relative to the data folder), the index is saved to disk by a background thread
+    after it is built and after every `snapshot_save_interval` newly indexed files, and when the store is evicted or
+    the server shuts down. On a cold start, the snapshot is loaded and only the files submitted after the snapshot was
+    taken are indexed. Snapshots are only loaded from a folder that is private to the current user.
+
+    The store keeps a high-water mark of the indexed file ids. On every access, all the files submitted since the last
+    access are pulled in one query and indexed, so that no peer submission is missed.
+
+    Queries share a read lock, so they can run in parallel. Updates are serialized by a separate update lock, under
+    which the new files are pulled and parsed while the queries go on. Only adding a chunk of parsed files to the live
+    index takes the write lock. A new index (e.g. on a cold start) is built without any lock, since the queries cannot
+    see it yet, and then swapped in.
+
+    Templates are never added to the index. Instead, the segment keys of each template are extracted once and cached
+    by the template md5, and the segments in the template are excluded from the results of each query.
+
+    Python files are indexed by their AST segments (`CodeSegmentIndex`), while the other supported source files are
+    indexed by their token fingerprints (`FingerprintIndex`), depending on `file_ext`. Both have the same interface.
+
+    If a historical corpus (the submissions of the same assignment in previous terms) is linked, the duplicates of a
+    submission are also looked up in the corpus, which is loaded lazily on the first query.
+
+    The durations of the builds, updates and queries, and the time spent waiting for the locks, are logged and counted
+    in `timings` for monitoring, see `get_stats`.
     """
 
-    def __init__(self, requirement_id: int, is_team_task: bool, data_folder: str):
+    def __init__(self, requirement_id: int, is_team_task: bool, data_folder: str, snapshot_folder: str = None,
+                 snapshot_save_interval: int = 20, build_workers: Optional[int] = 1,
+                 history: HistoricalCorpus = None, file_ext: str = '.py'):
         self.requirement_id = requirement_id
         self.is_team_task = is_team_task
+        self.file_ext = file_ext
         self.data_folder = data_folder
+        self.build_workers = build_workers
+        self.snapshot_folder = os.path.join(data_folder, snapshot_folder) if snapshot_folder else None
+        self.snapshot_save_interval = snapshot_save_interval
+        self.history = history
 
-        self._template_path = None
-        self._template_md5 = None
-        self._template_uid = -1
-        self._template_sid = -1
+        self._template_segment_keys = {}  # template md5 (or path) -> keys of the segments in the template
 
-        self._lock = Lock()
+        self._lock = ReadWriteLock()  # guards the content of the index
+        self._update_lock = Lock()  # serializes the updates, guards the file ids and the snapshot
         self._indexed_file_ids = set()
+        self._max_file_id = 0  # high-water mark of the indexed file ids
         self._index = None
+        self._unsaved_file_count = 0
+        self._removed_checked_at = None  # time (monotonic) of the last check of the removed files, see `update`
+        self._snapshot_lock = Lock()  # guards the background snapshot thread
+        self._snapshot_thread = None
+
+        self.timings = TimingStats()
+
+    @contextmanager
+    def _acquire_update_lock(self):
+        start_time = time.perf_counter()
+        with self._update_lock:
+            self.timings.add('update_lock_wait', time.perf_counter() - start_time)
+            yield
 
     def add_file(self, sid: int, uid: int, file: SubmissionFile):
-        with self._lock:
-            if self._index is None:  # cold start
-                self._index = self._build_full_index()  # should include the current submission
-            else:  # assume this submission is the only submission that has not been indexed
-                if file.id in self._indexed_file_ids:
-                    return
+        self.add_files([(sid, uid, file)])
+
+    def add_files(self, file_tuples: List[Tuple[int, int, SubmissionFile]]):
+        """
+        Make sure the given files are indexed, together with all the files submitted since the last access. If the files
+        are already indexed while another update (or a snapshot) holds the update lock, the index is used as it is
+        instead of waiting for the lock, since the new files of the peers are also indexed by that update or the next.
+        """
+        with self.timings.measure('add_file', requirement_id=self.requirement_id, files=len(file_tuples)):
+            if self._update_lock.acquire(blocking=False):
                 try:
-                    self._index.process_file(uid, sid, os.path.join(self.data_folder, file.path), file.md5)
-                except SyntaxError:
-                    logger.debug('Syntax Error in (uid: %s, sid: %s)' % (uid, sid))
-                except IOError:
-                    logger.warning('IO Error in (uid: %s, sid: %s)' % (uid, sid), exc_info=True)
-                self._indexed_file_ids.add(file.id)  # mark it as indexed even error occurred
+                    self._add_files(file_tuples)
+                finally:
+                    self._update_lock.release()
+                return
+            indexed_file_ids = self._indexed_file_ids  # replaced (not cleared) by a rebuild
+            if self._index is not None and all(file.id in indexed_file_ids for _, _, file in file_tuples):
+                return
+            with self._acquire_update_lock():
+                self._add_files(file_tuples)
+
+    def _add_files(self, file_tuples: List[Tuple[int, int, SubmissionFile]]):
+        # assume update lock has been acquired
+        self._update()  # should include the given submissions
+            # e.g. committed after a newer file was pulled
+        missing_file_tuples = [(sid, uid, file) for sid, uid, file in file_tuples
+                               if file.id not in self._indexed_file_ids]
+        if missing_file_tuples:
+            self._index_files(self._index, missing_file_tuples, 1)
+        if self._unsaved_file_count >= self.snapshot_save_interval:
+            self.save_snapshot(background=True)
+
+    def update(self, check_removed: bool = False, check_removed_interval: float = None):
+        """
+        Index all the files submitted since the last access, e.g. in the background before they are checked.
+
+        If check_removed is True, the ids of all the current files are compared with the indexed ones, and the index is
+        rebuilt if any indexed file has been removed (e.g. the submission is cleared), so that the index matches the
+        current corpus exactly. Since that pulls all the file ids, a check_removed_interval (in seconds) can be given to
+        skip the check if the files were checked (or the index was built) more recently, unless `invalidate` has been
+        called since.
+        """
+        with self._acquire_update_lock():
+            if check_removed and check_removed_interval is not None and self._removed_checked_at is not None \
+                    and time.monotonic() - self._removed_checked_at < check_removed_interval:
+                check_removed = False
+            if check_removed and self._index is not None:
+                self._removed_checked_at = time.monotonic()
+                file_ids = {file.id for _, _, file in self._get_file_tuples()}
+                if not self._indexed_file_ids.issubset(file_ids):
+                    logger.info('Rebuilding index for requirement %d: indexed files removed' % self.requirement_id)
+                    self._update(rebuild=True)  # the old index is queried until the new one is swapped in
+                    return
+            self._update()
+            if self._unsaved_file_count >= self.snapshot_save_interval:
+                self.save_snapshot(background=True)
+
+    def invalidate(self):
+        """
+        Make the next `update` with check_removed check the removed files regardless of its interval, e.g. after some
+        submissions are cleared.
+        """
+        self._removed_checked_at = None
+
+    def _update(self, rebuild: bool = False):
+        # assume update lock has been acquired
+        if self._index is None or rebuild:  # cold start
+            self._removed_checked_at = time.monotonic()  # a full build only includes the current files
+            with self.timings.measure('build_full_index', requirement_id=self.requirement_id):
+                index = self._build_full_index(use_snapshot=not rebuild)
+            with self._lock.write():
+                self._index = index
+            if self._unsaved_file_count:
+                self.save_snapshot(background=True)
+            return
+
+        file_tuples = self._get_file_tuples(self._max_file_id)
+        if not file_tuples:
+            return
+        workers = self.build_workers if len(file_tuples) >= PARALLEL_UPDATE_MIN_FILES else 1
+        user_count, valid_file_count, syntax_error_count, io_error_count = \
+            self._index_files(self._index, file_tuples, workers)
+        self._max_file_id = max([self._max_file_id] + [file.id for _, _, file in file_tuples])
+        logger.info('Updated index for requirement %d. new users/teams: %d, valid files: %d, syntax errors: %d, '
+                    'io errors: %d' % (self.requirement_id, user_count, valid_file_count, syntax_error_count,
+                                       io_error_count))
 
     def get_duplicates(self, sid: int, uid: int, limit: int = 100, template_path: str = None,
                        template_md5: str = None) -> List[Tuple[CodeSegment, Dict[int, List[CodeOccurrence]]]]:
-        with self._lock:
-            if template_path:  # enable template
-                if not self._template_path or (self._template_path != template_path
-                                               or self._template_md5 != template_md5):  # need to index the template
-                    if self._template_path:  # need to remove old template from index
-                        self._index.remove_code(self._template_uid, self._template_sid)
-                    try:
-                        self._index.process_file(self._template_uid, self._template_sid,
-                                                 os.path.join(self.data_folder, template_path), template_md5)
-                    except SyntaxError:
-                        logger.warning('Syntax Error in template file: %s' % template_path)
-                    except IOError:
-                        logger.warning('IO Error in template file: %s' % template_path, exc_info=True)
-                    self._template_path = template_path
-                    self._template_md5 = template_md5
-            else:  # disable template
-                if self._template_path is not None:  # need to remove old template from index
-                    self._index.remove_code(self._template_uid, self._template_sid)
-                    self._template_path = None
-                    self._template_md5 = None
-
-        exclude_user_id = self._template_uid if template_path else None
-        return self._index.get_duplicates(sort_by='total_nodes', include_user_id=uid, include_user_file_id=sid,
-                                          exclude_user_id=exclude_user_id)[:limit]
+        exclude_segment_keys = self._get_template_segment_keys(template_path, template_md5)
+        history_index = self._get_history_index()
+        with self.timings.measure('get_duplicates', requirement_id=self.requirement_id, sid=sid), self._lock.read():
+            return self._index.get_duplicates(sort_by='total_nodes', include_user_id=uid, include_user_file_id=sid,
+                                              exclude_segment_keys=exclude_segment_keys, limit=limit,
+                                              other_index=history_index)
+
+    def iter_duplicates(self, sid_uids: List[Tuple[int, int]], limit: int = 100, template_path: str = None,
+                        template_md5: str = None) \
+            -> Iterator[Tuple[int, int, List[Tuple[CodeSegment, Dict[int, List[CodeOccurrence]]]]]]:
+        """
+        Get the duplicates of many submissions, yielding (sid, uid, duplicates) in the given order. The read lock is
+        only held while each submission is queried, so a slow consumer does not block the updates.
+        """
+        for sid, uid in sid_uids:
+            yield sid, uid, self.get_duplicates(sid, uid, limit, template_path, template_md5)
+
+    def get_top_duplicates(self, limit: int = 100) -> List[Tuple[CodeSegment, Dict[int, List[CodeOccurrence]]]]:
+        """
+        Get the largest duplicates among all the users/teams.
+        """
+        with self._lock.read():
+            return self._index.get_duplicates(sort_by='total_nodes', limit=limit)
+
+    def get_similarities(self, template_path: str = None, template_md5: str = None, max_occ_users: int = None) \
+            -> List[Tuple[int, int, int, float]]:
+        """
+        Get (uid, other_uid, shared, similarity) of all the pairs of users/teams that share code, ignoring the
+        code in the template (if given). shared is the number of shared code lines or fingerprints, see
+        `get_user_similarities` of the index.
+        """
+        self.update()
+        exclude_segment_keys = self._get_template_segment_keys(template_path, template_md5)
+        with self._lock.read():
+            return self._index.get_user_similarities(max_occ_users=max_occ_users,
+                                                     exclude_segment_keys=exclude_segment_keys)
+
+    def _get_template_segment_keys(self, template_path: Optional[str], template_md5: Optional[str]) \
+            -> Optional[frozenset]:
+        if not template_path:
+            return None
+        cache_key = template_md5 or template_path
+        segment_keys = self._template_segment_keys.get(cache_key)
+        if segment_keys is None:
+            # the keys do not depend on the content of the index, so no lock is needed (at worst, a template is
+            # extracted twice by concurrent queries)
+            try:
+                segment_keys = self._index.extract_segment_keys(os.path.join(self.data_folder, template_path))
+            except (SyntaxError, RecursionError, MemoryError):
+                logger.warning('Syntax Error in template file: %s' % template_path)
+                segment_keys = frozenset()
+            except IOError:
+                logger.warning('IO Error in template file: %s' % template_path, exc_info=True)
+                segment_keys = frozenset()
+            self._template_segment_keys[cache_key] = segment_keys
+        return segment_keys
 
     def get_file_info(self, sid: int) -> CodeFileInfo:
-        return self._index.get_file_info(sid)
+        file_info = self._index.get_file_info(sid)
+        if file_info is None:
+            history_index = self._get_history_index()
+            if history_index is not None:
+                file_info = history_index.get_file_info(sid)
+        return file_info
+
+    def is_historical_file(self, sid: int) -> bool:
+        history_index = self._get_history_index()
+        return history_index is not None and self._index.get_file_info(sid) is None and \
+            history_index.get_file_info(sid) is not None
+
+    def _get_history_index(self) -> Optional[CodeSegmentIndex]:
+        # the corpus is read-only, so it can be queried without the locks of the store
+        if self.history is None:
+            return None
+        history_index = self.history.get_index()
+        if history_index is not None and type(history_index) is not type(self._index):
+            return None  # built for another type of files
+        return history_index
 
     def pretty_print_results(self, results, file=sys.stdout):
-        return self._index.pretty_print_results(results, file)
+        for chunk in self.iter_pretty_print_results(results):
+            file.write(chunk)
+
+    def iter_pretty_print_results(self, results: List[Tuple[CodeSegment, Dict[int, List[CodeOccurrence]]]],
+                                  offset: int = 0, limit: int = None) -> Iterator[str]:
+        """
+        Generate the report of the results piece by piece, see `CodeSegmentIndex.iter_pretty_print_results`. The read
+        lock is only held while a block is formatted (the nodes of the results are recovered from the index), not
+        while the consumer of the generator is waiting, e.g. for a slow client.
+        """
+        index = self._index
+        history_index = self._get_history_index()
+        yield 'Total Results: %d\n' % len(results)
+        end = len(results) if limit is None else min(len(results), offset + limit)
+        file_nodes_cache = {}
+        for i in range(offset, end):
+            with self._lock.read():
+                block = index.format_result_block(i, results[i], file_nodes_cache, history_index)
+            yield block
+
+    def get_estimated_memory(self) -> int:
+        index = self._index
+        if index is None:
+            return 0
+        return index.get_stats()['estimated_memory']
+
+    def get_stats(self) -> dict:
+        """
+        Get the size of the index, the durations of the operations and the lock statistics of the store.
+        """
+        with self._lock.read():
+            index_stats = self._index.get_stats() if self._index is not None else None
+        return dict(requirement_id=self.requirement_id, is_team_task=self.is_team_task, file_ext=self.file_ext,
+                    indexed_files=len(self._indexed_file_ids), max_file_id=self._max_file_id,
+                    unsaved_files=self._unsaved_file_count, index=index_stats,
+                    history=self.history.get_stats() if self.history is not None else None,
+                    timings=self.timings.to_dict(), lock=self._lock.get_stats())
+
+    def save_snapshot(self, background: bool = False):
+        """
+        Save the index if any file has been indexed since the last snapshot. If background is True, it is saved by a
+        background thread (unless one is already running), so that the caller does not wait for the pickling. The
+        pickling holds the update lock, so it blocks the updates that index new files, but neither the queries nor the
+        checks of the files that are already indexed (see `add_files`).
+        """
+        if not self.snapshot_folder:
+            return
+        if background:
+            with self._snapshot_lock:
+                if self._snapshot_thread is None or not self._snapshot_thread.is_alive():
+                    self._snapshot_thread = Thread(target=self.save_snapshot, daemon=True,
+                                                   name='snapshot-%d' % self.requirement_id)
+                    self._snapshot_thread.start()
+            return
+        with self._acquire_update_lock():
+            if self._index is not None and self._unsaved_file_count:
+                with self.timings.measure('save_snapshot', requirement_id=self.requirement_id):
+                    self._save_snapshot()
+
+    def _get_snapshot_path(self) -> str:
+        return os.path.join(self.snapshot_folder, 'requirement_%d.snapshot' % self.requirement_id)
+
+    def _save_snapshot(self):
+        # assume update lock has been acquired
+        if not os.path.isdir(self.snapshot_folder):
+            os.makedirs(self.snapshot_folder, mode=0o700)
+        path = self._get_snapshot_path()
+        tmp_path = '%s.%d.tmp' % (path, os.getpid())
+        try:
+            with open(tmp_path, 'wb') as f:  # the index is only changed under the update lock
+                snapshot = dict(version=SNAPSHOT_VERSION, requirement_id=self.requirement_id,
+                                is_team_task=self.is_team_task, file_ext=self.file_ext,
+                                indexed_file_ids=self._indexed_file_ids,
+                                index=self._index)
+                pickle.dump(snapshot, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, path)  # atomic, so that a half-written snapshot is never loaded
+        except (IOError, pickle.PicklingError, RecursionError):
+            logger.warning('Failed to save snapshot for requirement %d' % self.requirement_id, exc_info=True)
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return
+        self._unsaved_file_count = 0
+        logger.info('Saved snapshot for requirement %d. indexed files: %d' %
+                    (self.requirement_id, len(self._indexed_file_ids)))
 
-    def _build_full_index(self) -> CodeSegmentIndex:
-        index = CodeSegmentIndex()
+    def _load_snapshot(self, file_ids: set):
+        # assume update lock has been acquired
+        path = self._get_snapshot_path()
+        if not os.path.isfile(path):
+            return None
+        if not FileUtils.is_private_folder(self.snapshot_folder):
+            logger.warning('Ignored snapshot for requirement %d: %s is not private to the current user' %
+                           (self.requirement_id, self.snapshot_folder))
+            return None
+        try:
+            with open(path, 'rb') as f:
+                snapshot = pickle.load(f)
+        except (IOError, EOFError, pickle.UnpicklingError, AttributeError, ImportError):
+            logger.warning('Failed to load snapshot for requirement %d' % self.requirement_id, exc_info=True)
+            return None
+        if snapshot.get('version') != SNAPSHOT_VERSION:
+            logger.info('Ignored snapshot for requirement %d: version mismatch' % self.requirement_id)
+            return None
+        if snapshot.get('requirement_id') != self.requirement_id or snapshot.get('is_team_task') != self.is_team_task \
+                or snapshot.get('file_ext') != self.file_ext:
+            logger.info('Ignored snapshot for requirement %d: store mismatch' % self.requirement_id)
+            return None
+        indexed_file_ids = snapshot['indexed_file_ids']
+        if not indexed_file_ids.issubset(file_ids):  # some files have been removed since the snapshot was taken
+            logger.info('Ignored snapshot for requirement %d: indexed files removed' % self.requirement_id)
+            return None
+        self._indexed_file_ids = indexed_file_ids
+        self._max_file_id = max(indexed_file_ids, default=0)
+        logger.info('Loaded snapshot for requirement %d. indexed files: %d' %
+                    (self.requirement_id, len(indexed_file_ids)))
+        return snapshot['index']
 
+    def _get_file_tuples(self, min_file_id: int = None) -> List[Tuple[int, int, SubmissionFile]]:
         if self.is_team_task:
             # treat a team as a single 'user' in this module
-            file_tuples = SubmissionService.get_team_files(self.requirement_id)
-        else:
-            file_tuples = SubmissionService.get_files(self.requirement_id)
+            return SubmissionService.get_team_files(self.requirement_id, min_file_id)
+        return SubmissionService.get_files(self.requirement_id, min_file_id)
 
+    def _build_full_index(self, use_snapshot: bool = True) -> CodeSegmentIndex:
+        file_tuples = self._get_file_tuples()
+
+        index = None
+        if self.snapshot_folder and use_snapshot:
+            index = self._load_snapshot({file.id for _, _, file in file_tuples})
+        if index is None:
+            index = create_index(self.file_ext)
+            self._indexed_file_ids = set()
+            self._max_file_id = 0
+        snapshot_file_count = len(self._indexed_file_ids)
+
+        user_count, valid_file_count, syntax_error_count, io_error_count = \
+            self._index_files(index, file_tuples, self.build_workers)
+        self._max_file_id = max([self._max_file_id] + [file.id for _, _, file in file_tuples])
+        logger.info('Built full index for requirement %d. snapshot files: %d, '
+                    'new users/teams: %d, valid files: %d, syntax errors: %d, io errors: %d' %
+                    (self.requirement_id, snapshot_file_count, user_count, valid_file_count, syntax_error_count,
+                     io_error_count))
+        return index
+
+    def _index_files(self, index: CodeSegmentIndex, file_tuples: List[Tuple[int, int, SubmissionFile]],
+                     workers: Optional[int]) -> Tuple[int, int, int, int]:
+        """
+        Index the files that are not indexed yet.
+        Returns the numbers of (new users/teams, valid files, syntax errors, io errors).
+        """
+        # assume update lock has been acquired
+        # skip the files that are already indexed, e.g. in the snapshot
+        new_file_tuples = [(sid, uid, file) for sid, uid, file in file_tuples if file.id not in self._indexed_file_ids]
         user_set = set()
         valid_file_count = 0
         syntax_error_count = 0
         io_error_count = 0
-        for sid, uid, file in file_tuples:
+        if index is self._index:
+            results = self._process_files_concurrently(new_file_tuples, workers)
+        else:  # a new index that the queries cannot see yet, so no lock is needed
+            results = index.process_files(((uid, sid, os.path.join(self.data_folder, file.path), file.md5)
+                                           for sid, uid, file in new_file_tuples), workers=workers)
+        for (sid, uid, file), (_, _, _, error) in zip(new_file_tuples, results):
             user_set.add(uid)
-            try:
-                index.process_file(uid, sid, os.path.join(self.data_folder, file.path), file.md5)
+            if error is None:
                 valid_file_count += 1
-            except SyntaxError:
+            elif isinstance(error, SyntaxError):
                 logger.debug('Syntax Error in (uid: %s, sid: %s)' % (uid, sid))
                 syntax_error_count += 1
-            except IOError:
-                logger.warning('IO Error in (uid: %s, sid: %s)' % (uid, sid), exc_info=True)
+            elif isinstance(error, (RecursionError, MemoryError)):  # too deeply nested or too large to parse
+                logger.warning('Cannot parse (uid: %s, sid: %s): %r' % (uid, sid, error))
+                syntax_error_count += 1
+            else:
+                logger.warning('IO Error in (uid: %s, sid: %s): %s' % (uid, sid, error))
                 io_error_count += 1
             self._indexed_file_ids.add(file.id)  # mark it as indexed even error occurred
-        logger.info('Built full index for requirement %d. '
-                    'users/teams: %d, valid files: %d, syntax errors: %d, io errors: %d' %
-                    (self.requirement_id, len(user_set), valid_file_count, syntax_error_count, io_error_count))
-        return index
+            self._unsaved_file_count += 1
+        return len(user_set), valid_file_count, syntax_error_count, io_error_count
+
+    def _process_files_concurrently(self, file_tuples: List[Tuple[int, int, SubmissionFile]], workers: Optional[int]) \
+            -> Iterator[Tuple[int, int, Optional[CodeFileInfo], Optional[Exception]]]:
+        """
+        Parse the files (by `workers` processes) while the queries go on, and only take the write lock to add each
+        chunk of parsed files to the live index. Yields the same tuples as `CodeSegmentIndex.process_files`.
+        """
+        # assume update lock has been acquired
+        index = self._index
+        extracted_files = index.extract_files(((uid, sid, os.path.join(self.data_folder, file.path), file.md5)
+                                               for sid, uid, file in file_tuples), workers=workers)
+        chunk = []
+        for (sid, uid, file), (_, _, extracted, error) in zip(file_tuples, extracted_files):
+            chunk.append((sid, uid, file, extracted, error))
+            if len(chunk) >= MERGE_CHUNK_FILES:
+                yield from self._add_extracted_files(index, chunk)
+                chunk = []
+        yield from self._add_extracted_files(index, chunk)
+
+    def _add_extracted_files(self, index: CodeSegmentIndex, chunk: List[tuple]) \
+            -> List[Tuple[int, int, Optional[CodeFileInfo], Optional[Exception]]]:
+        # assume update lock has been acquired
+        results = []
+        if not chunk:
+            return results
+        with self._lock.write():
+            for sid, uid, file, extracted, error in chunk:
+                if error is not None:
+                    results.append((uid, sid, None, error))
+                    continue
+                try:
+                    if extracted is not None:
+                        file_info = index.add_extracted_file(uid, sid, extracted)
+                    else:  # already indexed or identical to an indexed file, which is copied instead
+                        file_info = index.process_file(uid, sid, os.path.join(self.data_folder, file.path), file.md5)
+                except FILE_ERRORS as e:
+                    results.append((uid, sid, None, e))
+                else:
+                    results.append((uid, sid, file_info, None))
+        return results  # the results are only yielded after the write lock is released
@@ -0,0 +1,149 @@
+import logging
+from collections import OrderedDict
+from threading import Lock
+from typing import Callable, List, Optional
+
+from anti_plagiarism.engines import get_file_ext
+from anti_plagiarism.history import get_linked_corpus
+from anti_plagiarism.store import Store
+from models import FileRequirement
+
+logger = logging.getLogger(__name__)
+
+
+class StoreCache:
+    """
+    Thread-safe LRU cache of stores, bounded by the number of stores and (optionally) their estimated memory usage.
+
+    The internal lock only guards the cache entries. A missing store is created outside of it under a lock of its
+    requirement, so that it is only created once while the other requirements are still served. Building and querying
+    an index is protected by the lock of each store, so checks for different requirements can run in parallel.
+    """
+
+    def __init__(self, max_stores: int = 4, max_memory: int = None):
+        self.max_stores = max_stores
+        self.max_memory = max_memory
+
+        self._lock = Lock()
+        self._stores = OrderedDict()
+        self._create_locks = {}  # requirement id -> lock of creating its store
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, requirement_id: int, create_store: Callable[[], Store]) -> Store:
+        with self._lock:
+            store = self._get_cached(requirement_id)
+            if store is not None:
+                return store
+            create_lock = self._create_locks.get(requirement_id)
+            if create_lock is None:
+                self._create_locks[requirement_id] = create_lock = Lock()
+        with create_lock:
+            with self._lock:
+                store = self._get_cached(requirement_id)  # created by another thread in the meantime
+                if store is not None:
+                    return store
+            store = create_store()  # e.g. loading the historical corpus, without blocking the other requirements
+            with self._lock:
+                cached_store = self._get_cached(requirement_id)
+                if cached_store is not None:  # only if evicted and created again while creating this one
+                    return cached_store
+                self.misses += 1
+                self._stores[requirement_id] = store
+                if self._create_locks.get(requirement_id) is create_lock:
+                    del self._create_locks[requirement_id]
+                evicted = self._evict()
+        self._save_evicted(evicted)
+        return store
+
+    def peek(self, requirement_id: int) -> Optional[Store]:
+        """
+        Get the cached store of a requirement without creating it or counting it as used. Returns None if the store is
+        not cached.
+        """
+        with self._lock:
+            return self._stores.get(requirement_id)
+
+    def trim(self):
+        """
+        Evict the least recently used stores until the cache is within its bounds again. Should be called after a store
+        has (re-)built its index, since the memory usage of a new store is unknown until then.
+        """
+        with self._lock:
+            evicted = self._evict()
+        self._save_evicted(evicted)
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            stores = list(self._stores.values())
+            stats = dict(stores=len(stores), max_stores=self.max_stores, max_memory=self.max_memory,
+                         hits=self.hits, misses=self.misses, evictions=self.evictions)
+        stats['estimated_memory'] = sum(store.get_estimated_memory() for store in stores)
+        return stats
+
+    def save_snapshots(self):
+        """
+        Save the snapshots of all the cached stores, e.g. when the server shuts down.
+        """
+        with self._lock:
+            stores = list(self._stores.values())
+        for store in stores:
+            store.save_snapshot()  # no-op if snapshot is not enabled
+
+    def get_store_stats(self) -> List[dict]:
+        """
+        Get the statistics of each cached store, see `Store.get_stats`.
+        """
+        with self._lock:
+            stores = list(self._stores.values())
+        return [store.get_stats() for store in stores]
+
+    def _get_cached(self, requirement_id: int) -> Optional[Store]:
+        # assume lock has been acquired
+        store = self._stores.get(requirement_id)
+        if store is not None:
+            self._stores.move_to_end(requirement_id)
+            self.hits += 1
+        return store
+
+    def _evict(self) -> List[Store]:
+        # assume lock has been acquired
+        evicted = []
+        while len(self._stores) > 1:  # always keep the most recently used store
+            if len(self._stores) <= self.max_stores and (
+                    self.max_memory is None
+                    or sum(store.get_estimated_memory() for store in self._stores.values()) <= self.max_memory):
+                break
+            _, store = self._stores.popitem(last=False)
+            evicted.append(store)
+            self.evictions += 1
+            logger.info('Evicted store for requirement %d' % store.requirement_id)
+        return evicted
+
+    @staticmethod
+    def _save_evicted(evicted: List[Store]):
+        for store in evicted:
+            store.save_snapshot(background=True)  # no-op if snapshot is not enabled
+
+
+def create_store_cache(ap_config: dict, prefix: str = '', default_max_stores: int = 4) -> StoreCache:
+    """
+    Create a store cache bounded by "<prefix>max_stores" and "<prefix>max_store_memory_mb" of the anti-plagiarism
+    config, e.g. prefix "web_" for the smaller caches of the web workers.
+    """
+    max_memory_mb = ap_config.get(prefix + 'max_store_memory_mb')
+    return StoreCache(max_stores=ap_config.get(prefix + 'max_stores', default_max_stores),
+                      max_memory=max_memory_mb * 1024 * 1024 if max_memory_mb else None)
+
+
+def create_store(requirement: FileRequirement, ap_config: dict, data_folder: str, build_workers: Optional[int] = 1) \
+        -> Store:
+    """
+    Create the store of a file requirement, with the snapshot folder and the historical corpus of the anti-plagiarism
+    config.
+    """
+    return Store(requirement.id, requirement.task.is_team_task, data_folder, ap_config.get('snapshot_folder'),
+                 build_workers=build_workers, history=get_linked_corpus(requirement.id, ap_config, data_folder),
+                 file_ext=get_file_ext(requirement.name))
@@ -0,0 +1,49 @@
+import logging
+import time
+from contextlib import contextmanager
+from threading import Lock
+
+# a separate logger, so that the level of the timing logs can be configured independently
+logger = logging.getLogger(__name__)
+
+
+class TimingStats:
+    """
+    Thread-safe count, total, max and last duration (in seconds) of named operations.
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self._stats = {}  # operation -> [count, total, max, last]
+
+    def add(self, operation: str, duration: float):
+        with self._lock:
+            stats = self._stats.get(operation)
+            if stats is None:
+                self._stats[operation] = [1, duration, duration, duration]
+            else:
+                stats[0] += 1
+                stats[1] += duration
+                if duration > stats[2]:
+                    stats[2] = duration
+                stats[3] = duration
+
+    @contextmanager
+    def measure(self, operation: str, **fields):
+        """
+        Measure the duration of the enclosed operation, and log it as a structured line of key=value pairs, e.g.
+        "op=get_duplicates requirement_id=12 sid=345 duration=0.0123".
+        """
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            duration = time.perf_counter() - start_time
+            self.add(operation, duration)
+            logger.info('op=%s %s duration=%.4f' %
+                        (operation, ' '.join('%s=%s' % (k, v) for k, v in fields.items()), duration))
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            return {operation: dict(count=count, total=total, max=max_duration, last=last, mean=total / count)
+                    for operation, (count, total, max_duration, last) in self._stats.items()}
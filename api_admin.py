@@ -682,7 +682,7 @@ def admin_submission_run_auto_test(sid, cid):
         if config is None:
             return jsonify(msg='auto test config not found'), 404
 
-        test, result = SubmissionService.run_auto_test(submission, config)
+        test, result = SubmissionService.run_auto_test(submission, config, AutoTestService.SOURCE_ADMIN)
         db.session.commit()
 
         test_obj = test.to_dict(with_advanced_fields=True)
@@ -802,21 +802,37 @@ def admin_run_auto_test(cid):
                                   .filter(AutoTest.id == last_tids.c.tid, AutoTest.final_state == 'SUCCESS').all())
             submissions = [s for s in submissions if s.id not in successful_sids]
 
-        result_tuples = []
-        for submission in submissions:
-            result_tuples.append(SubmissionService.run_auto_test(submission, config))
+        # insert all the tests at once and commit them before the jobs are published, then publish all the jobs over a
+        # single broker connection
+        work_tuples = SubmissionService.add_auto_tests(list(submissions), config)
         db.session.commit()
+        try:
+            result = SubmissionService.dispatch_auto_tests(config, work_tuples)
+        except Exception:
+            db.session.commit()  # the tests that were not published have been deleted, as they would never run
+            raise
 
-        ret = []
-        for test, result in result_tuples:
-            test_obj = test.to_dict(with_advanced_fields=True)
-            test_obj.update(AutoTestService.result_to_dict(result, with_advanced_fields=True))  # merge temporary result
-            ret.append(test_obj)
-        return jsonify(ret), 200
+        return jsonify(batch_id=result.id, config_id=config.id, total=len(work_tuples)), 200
     except (SubmissionServiceError, AutoTestServiceError) as e:
         return jsonify(msg=e.msg, detail=e.detail), 400
 
 
+@admin_api.route('/auto-test-configs/<int:cid>/batches/<string:batch_id>', methods=['GET'])
+@requires_admin
+def admin_get_auto_test_batch(cid, batch_id):
+    try:
+        config = TaskService.get_auto_test_config(cid)
+        if config is None:
+            return jsonify(msg='auto test config not found'), 404
+
+        progress = AutoTestService.get_batch_progress(config, batch_id)
+        if progress is None:
+            return jsonify(msg='auto test batch not found'), 404
+        return jsonify(progress)
+    except AutoTestServiceError as e:
+        return jsonify(msg=e.msg, detail=e.detail), 400
+
+
 @admin_api.route('/tasks/<int:tid>/final-marks', methods=['POST'])
 @requires_admin
 def do_final_marks(tid):
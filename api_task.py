@@ -8,11 +8,14 @@ import time
 import zipfile
 from datetime import datetime
 from io import StringIO
+from threading import Lock
 from typing import Optional
 
-from flask import Blueprint, jsonify, request, current_app as app, send_from_directory
+from flask import Blueprint, Response, jsonify, request, current_app as app, send_from_directory
 
-from anti_plagiarism.code_analysis import CodeSegmentIndex
+from anti_plagiarism.engines import is_supported_file
+from anti_plagiarism.notifier import notify_new_files
+from anti_plagiarism.store_cache import StoreCache, create_store, create_store_cache
 from auth_connect.oauth import requires_login
 from models import db, SpecialConsideration, UserTeamAssociation
 from services.account import AccountService, AccountServiceError
@@ -30,6 +33,19 @@ from utils.upload import md5sum
 task_api = Blueprint('task_api', __name__)
 logger = logging.getLogger(__name__)
 
+_anti_plagiarism_store_cache = None
+_anti_plagiarism_store_cache_lock = Lock()
+
+
+def _get_anti_plagiarism_store_cache() -> StoreCache:
+    global _anti_plagiarism_store_cache
+    with _anti_plagiarism_store_cache_lock:
+        if _anti_plagiarism_store_cache is None:  # create it lazily, as the config is only available in an app context
+            # every web worker has its own cache, so it is much smaller than the one of the anti-plagiarism server
+            ap_config = app.config.get('ANTI_PLAGIARISM') or {}
+            _anti_plagiarism_store_cache = create_store_cache(ap_config, prefix='web_', default_max_stores=1)
+        return _anti_plagiarism_store_cache
+
 
 class SubmissionStatus:
     def __init__(self, attempts: Optional[int],
@@ -297,41 +313,25 @@ def task_anti_plagiarism(task_id, requirement_id):
             return jsonify(msg='requirement not found'), 404
         if requirement.task_id != task_id:
             return jsonify(msg='requirement does not belong to this task'), 400
-        if not requirement.name.endswith('.py'):
+        if not is_supported_file(requirement.name):
             return jsonify(msg='file type not supported'), 400
 
-        index = CodeSegmentIndex()
-        data_folder = app.config['DATA_FOLDER']
-        user_set = set()
-        valid_file_count = 0
-        syntax_error_count = 0
-        io_error_count = 0
-
-        if task.is_team_task:
-            # If task is a team task, treat a team as a single 'user'.
-            file_tuples = SubmissionService.get_team_files(requirement_id)
-        else:
-            file_tuples = SubmissionService.get_files(requirement_id)
-        for sid, uid, file in file_tuples:
-            user_set.add(uid)
-            try:
-                index.process_file(uid, sid, os.path.join(data_folder, file.path), file.md5)
-            except SyntaxError:
-                logger.debug('Syntax Error in (uid: %s, sid: %s)' % (uid, sid))
-                syntax_error_count += 1
-                continue
-            except IOError:
-                logger.warning('IO Error in (uid: %s, sid: %s)' % (uid, sid), exc_info=True)
-                io_error_count += 1
-                continue
-            valid_file_count += 1
-        logger.info('Processed users/teams: %d, valid files: %d, syntax errors: %d, io errors: %d' %
-                    (len(user_set), valid_file_count, syntax_error_count, io_error_count))
-
-        results = index.get_duplicates()[0:100]  # return top 100 results
-        with StringIO() as buffer:
-            index.pretty_print_results(results, file=buffer)
-            return buffer.getvalue(), {'Content-Type': 'text/plain'}
+        # Reuse the index of the requirement across requests (in this process). The index is updated incrementally with
+        # the new submissions, and rebuilt only if some indexed submissions have been removed, which is checked at most
+        # every web_check_removed_seconds (or after this process cleared some submissions).
+        ap_config = app.config.get('ANTI_PLAGIARISM') or {}
+        store_cache = _get_anti_plagiarism_store_cache()
+        store = store_cache.get(requirement.id, lambda: create_store(requirement, ap_config, app.config['DATA_FOLDER']))
+        store.update(check_removed=True, check_removed_interval=ap_config.get('web_check_removed_seconds', 300))
+        store_cache.trim()
+
+        # page through the top results, 100 results per page by default
+        offset = int(request.args.get('offset', 0))
+        limit = int(request.args.get('limit', 100))
+        if offset < 0 or limit < 0:
+            return jsonify(msg='offset and limit must not be negative'), 400
+        results = store.get_top_duplicates(offset + limit)
+        return Response(store.iter_pretty_print_results(results, offset, limit), content_type='text/plain')
     except (TaskServiceError, TermServiceError, AccountServiceError, SubmissionServiceError) as e:
         return jsonify(msg=e.msg, detail=e.detail), 400
 
@@ -671,6 +671,19 @@ def task_my_submissions(tid):
 
             db.session.commit()
 
+            if submissions_to_clear:  # the files of the cleared submissions have to be removed from the cached indices
+                store_cache = _get_anti_plagiarism_store_cache()
+                for req_id in requirements:
+                    store = store_cache.peek(req_id)
+                    if store is not None:
+                        store.invalidate()
+
+            # queue the new source files for background indexing in the anti-plagiarism server (if configured)
+            ap_server_url = (app.config.get('ANTI_PLAGIARISM') or {}).get('server_url')
+            if ap_server_url:
+                notify_new_files(ap_server_url, [f.requirement_id for f in new_submission.files
+                                                 if is_supported_file(f.requirement.name)])
+
             # start auto test if required
             if task.evaluation_method == 'auto_test':
                 configs_to_run = []
@@ -680,9 +693,9 @@ def task_my_submissions(tid):
                     configs_to_run.append(config)
                 configs_to_run.sort(key=lambda c: c.id)  # sort by id first
                 configs_to_run.sort(key=lambda c: c.priority, reverse=True)  # then by priority (reversed)
-                # TODO how to use global priority control in Celery?
+                # the priorities are also passed to the broker, see AutoTestService.get_dispatch_options
                 for config in configs_to_run:
-                    SubmissionService.run_auto_test(new_submission, config)
+                    SubmissionService.run_auto_test(new_submission, config, AutoTestService.SOURCE_SUBMISSION)
                 db.session.commit()  # have to commit again
 
             # if this is a team task, notify other teammates about this submission
@@ -6,6 +6,8 @@ from datetime import datetime, timedelta
 
 from sqlalchemy import or_
 
+from anti_plagiarism.engines import is_supported_file
+from anti_plagiarism.notifier import request_prewarm
 from models import Task, db
 from server import app
 from services.message_sender import MessageSenderService, MessageSenderServiceError
@@ -44,6 +46,9 @@ def _exec_work():
     notify_open = worker_config['notify_open']
     due_notify_hours = worker_config['due_notify_hours']
     team_join_close_notify_hours = worker_config['team_join_close_notify_hours']
+    ap_config = app.config.get('ANTI_PLAGIARISM') or {}
+    ap_prewarm_hours_before = ap_config.get('prewarm_hours_before_deadline')
+    ap_prewarm_hours_after = ap_config.get('prewarm_hours_after_due', 0)
     with app.test_request_context():
         if notify_open:
             for task in db.session.query(Task) \
@@ -71,6 +76,23 @@ def _exec_work():
                             ) \
                     .all():
                 _process_task_due(task, due_hours)
+        if ap_config.get('server_url') and ap_prewarm_hours_before:
+            # the checks of the tutors usually start right after the due time (or close time)
+            for task in db.session.query(Task) \
+                    .filter(Task.open_time < now,
+                            Task.due_time < now + timedelta(hours=ap_prewarm_hours_before),
+                            Task.due_time > now - timedelta(hours=ap_prewarm_hours_after),
+                            or_(Task.close_time.is_(None), Task.close_time > now),
+                            ) \
+                    .all():
+                _process_task_ap_prewarm(task, 'due', task.due_time, now)
+            for task in db.session.query(Task) \
+                    .filter(Task.open_time < now,
+                            Task.close_time < now + timedelta(hours=ap_prewarm_hours_before),
+                            Task.close_time > now - timedelta(hours=ap_prewarm_hours_after),
+                            ) \
+                    .all():
+                _process_task_ap_prewarm(task, 'close', task.close_time, now)
 
 
 def _process_task_open(task):
@@ -162,6 +184,29 @@ def _process_task_due(task, due_hours):
         logger.exception(e.msg)
 
 
+def _process_task_ap_prewarm(task, deadline_name, deadline, now):
+    # once before the deadline, and once again at (or just after) the deadline in case the store has been evicted since
+    phase = 'before' if now < deadline else 'after'
+    process_name = 'Task Anti-Plagiarism Pre-warm %s %s: %r at %s' % (phase, deadline_name, task, deadline)
+    mark_name = 'task_ap_prewarm_%d_%s_%s_%s.mark' % (task.id, deadline_name, str(deadline).replace(' ', '_'), phase)
+    work_folder = worker_config['work_folder']
+    mark_path = os.path.join(work_folder, mark_name)
+    if os.path.exists(mark_path):
+        logger.info('[Process Skipped] %s. Mark File: %s' % (process_name, mark_name))
+        return
+    logger.info('[Process Started] %s' % process_name)
+    requirement_ids = [req.id for req in task.file_requirements if is_supported_file(req.name)]
+    # the stores are built by the anti-plagiarism server in the background, at a lower priority than indexing the new
+    # submissions. The mark is only written once the server accepted the requests, so that a failure is retried in the
+    # next period.
+    if not request_prewarm(app.config['ANTI_PLAGIARISM']['server_url'], requirement_ids):
+        logger.warning('[Process Failed] %s. Requirements: %s' % (process_name, requirement_ids))
+        return
+    with open(mark_path, 'w'):
+        pass
+    logger.info('[Process Finished] %s. Requirements: %s' % (process_name, requirement_ids))
+
+
 def main():
     logger.info('Staring Period Worker...')
 
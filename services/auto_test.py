@@ -1,7 +1,8 @@
 from collections import defaultdict
-from typing import Optional
+from typing import Optional, List, Tuple
 
-from celery.result import AsyncResult
+from celery.result import AsyncResult, GroupResult
+from flask import current_app as app
 from sqlalchemy import func
 
 from error import BasicError
@@ -16,6 +17,49 @@ class AutoTestServiceError(BasicError):
 class AutoTestService:
     _summary_head_limit = 10
 
+    # sources that trigger the auto tests, from the most to the least latency-sensitive
+    SOURCE_SUBMISSION = 'submission'  # the 'after_submit' tests of a new submission, which the submitter waits for
+    SOURCE_ADMIN = 'admin'  # a test run by an admin on a single submission
+    SOURCE_ADMIN_BATCH = 'admin_batch'  # the tests run by an admin on many submissions at once
+
+    # default scheduling, which can be overridden by AUTO_TEST.scheduling in the config. Each source has its own
+    # (lowest, highest) band of message priorities, which must not overlap.
+    _default_scheduling = dict(max_priority=9,
+                               priorities={SOURCE_SUBMISSION: (6, 9), SOURCE_ADMIN: (3, 5), SOURCE_ADMIN_BATCH: (0, 2)},
+                               batch_queue=None)
+
+    @classmethod
+    def get_dispatch_options(cls, config: AutoTestConfig, source: str) -> dict:
+        """
+        Get the options of `apply_async` to schedule an auto test.
+
+        The message priority is taken from the band of the source, so that the bulk runs of the admins never get ahead
+        of the fresh tests of the students. Within the band, the tests of the configs with higher priorities get higher
+        message priorities (capped at the top of the band). The broker queues must be declared with a max priority
+        (e.g. `task_queue_max_priority` of the workers), otherwise the priority is ignored.
+
+        If `batch_queue` is configured, the tests of the bulk runs are sent to that separate queue instead, so that
+        they can only take the share of the workers that consume it.
+        """
+        if config is None:
+            raise AutoTestServiceError('auto test config is required')
+        auto_test_config = app.config.get('AUTO_TEST') or {}
+        scheduling = dict(cls._default_scheduling, **(auto_test_config.get('scheduling') or {}))
+        priorities = dict(cls._default_scheduling['priorities'], **scheduling['priorities'])
+        band = priorities.get(source)
+        if band is None:
+            raise AutoTestServiceError('unknown auto test source: %s' % source)
+
+        max_priority = scheduling['max_priority']
+        band_low, band_high = band
+        priority = band_low + min(max(config.priority, 0), band_high - band_low)
+        if auto_test_config.get('broker', '').startswith('redis'):
+            priority = max_priority - priority  # 0 is the highest priority in Redis
+        options = dict(priority=priority)
+        if source == cls.SOURCE_ADMIN_BATCH and scheduling['batch_queue']:
+            options['queue'] = scheduling['batch_queue']
+        return options
+
     @staticmethod
     def get(_id: int) -> Optional[AutoTest]:
         if _id is None:
@@ -40,6 +84,53 @@ class AutoTestService:
         db.session.add(test)
         return test
 
+    @staticmethod
+    def add_batch(config: AutoTestConfig, work_tuples: List[Tuple[int, str]]):
+        """
+        Insert the auto tests of (submission id, work id) pairs in bulk.
+        """
+        db.session.bulk_insert_mappings(AutoTest, [dict(submission_id=submission_id, config_id=config.id,
+                                                        work_id=work_id)
+                                                   for submission_id, work_id in work_tuples])
+
+    @staticmethod
+    def delete_batch(work_ids: List[str]):
+        db.session.query(AutoTest).filter(AutoTest.work_id.in_(work_ids)).delete(synchronize_session=False)
+
+    @staticmethod
+    def get_batch_progress(config: AutoTestConfig, batch_id: str) -> Optional[dict]:
+        """
+        Get the numbers of the auto tests in a batch by their states. Returns None if the batch is not found (or has
+        expired in the result backend).
+        """
+        if config is None:
+            raise AutoTestServiceError('auto test config is required')
+        if batch_id is None:
+            raise AutoTestServiceError('batch id is required')
+
+        task_entry = bot.task_entries.get(config.type)
+        if task_entry is None:
+            raise AutoTestServiceError('task entry not found for config type: %s' % config.type)
+        result = GroupResult.restore(batch_id, app=task_entry.app)
+        if result is None:
+            return None
+
+        # the states are counted from the tests in the database, which are updated by the workers
+        work_ids = [r.id for r in result.results]
+        states = defaultdict(int)
+        for final_state, started, count in db.session.query(AutoTest.final_state, AutoTest.started_at.isnot(None),
+                                                            func.count()) \
+                .filter(AutoTest.work_id.in_(work_ids)) \
+                .group_by(AutoTest.final_state, AutoTest.started_at.isnot(None)):
+            if final_state is not None:
+                states[final_state] += count
+            elif started:
+                states['STARTED'] += count
+            else:
+                states['PENDING'] += count
+        finished = sum(count for state, count in states.items() if state not in ('PENDING', 'STARTED'))
+        return dict(batch_id=batch_id, config_id=config.id, total=len(work_ids), finished=finished, states=states)
+
     @staticmethod
     def add_output_file(test: AutoTest, path: str, save_path: str) -> AutoTestOutputFile:
         if db.session.query(func.count()). \
@@ -107,7 +198,8 @@ class AutoTestService:
         if test is None:
             raise AutoTestServiceError('auto_test is required')
 
-        # assume all tests with the same config type go into the same task queue (although in fact not necessarily)
+        # assume all tests with the same config type go into the same task queue (although in fact not necessarily,
+        # e.g. the tests of the bulk runs may be sent to the batch queue, or overtaken by the tests of higher priority)
         config = test.config
         return db.session.query(func.count()) \
             .filter(AutoTest.started_at.is_(None),
@@ -7,7 +7,8 @@ from datetime import datetime, timedelta
 from typing import Optional, List, Dict, Tuple
 
 import tzlocal
-from celery.result import AsyncResult
+from celery.result import AsyncResult, GroupResult
+from celery.utils import uuid
 from sqlalchemy import desc, func, or_
 from sqlalchemy.orm import joinedload
 from werkzeug.datastructures import FileStorage
@@ -514,21 +515,33 @@ class SubmissionService:
         return SubmissionFile.query.get(_id)
 
     @staticmethod
-    def get_files(requirement_id: int) -> List[Tuple[int, int, SubmissionFile]]:
-        return db.session.query(Submission.id, Submission.submitter_id, SubmissionFile) \
+    def get_files(requirement_id: int, min_file_id: int = None) -> List[Tuple[int, int, SubmissionFile]]:
+        """
+        Get (submission id, submitter id, file) of the submitted files for a requirement. If min_file_id is given, only
+        the files with larger ids are returned.
+        """
+        query = db.session.query(Submission.id, Submission.submitter_id, SubmissionFile) \
             .filter(SubmissionFile.requirement_id == requirement_id,
-                    Submission.id == SubmissionFile.submission_id) \
-            .all()
+                    Submission.id == SubmissionFile.submission_id)
+        if min_file_id is not None:
+            query = query.filter(SubmissionFile.id > min_file_id)
+        return query.all()
 
     @staticmethod
-    def get_team_files(requirement_id: int) -> List[Tuple[int, int, SubmissionFile]]:
-        return db.session.query(Submission.id, Team.id, SubmissionFile) \
+    def get_team_files(requirement_id: int, min_file_id: int = None) -> List[Tuple[int, int, SubmissionFile]]:
+        """
+        Get (submission id, team id, file) of the submitted files for a requirement. If min_file_id is given, only the
+        files with larger ids are returned.
+        """
+        query = db.session.query(Submission.id, Team.id, SubmissionFile) \
             .filter(SubmissionFile.requirement_id == requirement_id,
                     Submission.id == SubmissionFile.submission_id,
                     Submission.submitter_id == UserTeamAssociation.user_id,
                     UserTeamAssociation.team_id == Team.id,
-                    Team.task_id == Submission.task_id) \
-            .all()
+                    Team.task_id == Submission.task_id)
+        if min_file_id is not None:
+            query = query.filter(SubmissionFile.id > min_file_id)
+        return query.all()
 
     @staticmethod
     def add(task: Task, submitter: UserAlias, files: Dict[int, FileStorage], save_paths: Dict[int, str],
@@ -657,7 +670,8 @@ class SubmissionService:
         return file_paths
 
     @staticmethod
-    def run_auto_test(submission: Submission, config: AutoTestConfig) -> Tuple[AutoTest, AsyncResult]:
+    def run_auto_test(submission: Submission, config: AutoTestConfig, source: str = AutoTestService.SOURCE_SUBMISSION) \
+            -> Tuple[AutoTest, AsyncResult]:
         if submission is None:
             raise SubmissionServiceError('submission is required')
         if config is None:
@@ -668,14 +682,72 @@ class SubmissionService:
         if not config.is_enabled:
             raise SubmissionServiceError('auto test config is disabled')
 
-        # TODO how to use priority support in Celery properly?
         task_entry = bot.task_entries.get(config.type)
         if task_entry is None:
             raise SubmissionServiceError('task entry not found for config type: %s' % config.type)
-        result = task_entry.apply_async((submission.id, config.id), countdown=3)  # wait 3 seconds to allow db commit
+        options = AutoTestService.get_dispatch_options(config, source)  # priority (and queue) by the source
+        result = task_entry.apply_async((submission.id, config.id), countdown=3,  # wait 3 seconds to allow db commit
+                                        **options)
         test = AutoTestService.add(submission, config, result.id)
         return test, result
 
+    @staticmethod
+    def add_auto_tests(submissions: List[Submission], config: AutoTestConfig) -> List[Tuple[int, str]]:
+        """
+        Add the auto tests of many submissions (of the same task) at once, without running them. Returns the
+        (submission id, work id) pairs to be passed to `dispatch_auto_tests` after the tests are committed.
+        """
+        if config is None:
+            raise SubmissionServiceError('auto test config is required')
+
+        if config.task.evaluation_method != 'auto_test':
+            raise SubmissionServiceError('evaluation method is not auto testing')
+        if not config.is_enabled:
+            raise SubmissionServiceError('auto test config is disabled')
+        if bot.task_entries.get(config.type) is None:
+            raise SubmissionServiceError('task entry not found for config type: %s' % config.type)
+
+        work_tuples = []
+        for submission in submissions:
+            if submission.task_id != config.task_id:
+                raise SubmissionServiceError('submission does not belong to the task of the auto test config')
+            work_tuples.append((submission.id, uuid()))  # generate the work ids in advance
+        AutoTestService.add_batch(config, work_tuples)
+        return work_tuples
+
+    @staticmethod
+    def dispatch_auto_tests(config: AutoTestConfig, work_tuples: List[Tuple[int, str]]) -> GroupResult:
+        """
+        Run the auto tests added by `add_auto_tests`, publishing all the jobs over a single broker connection. The tests
+        must have been committed, so no countdown is needed. The id of the returned group result is the id of the batch,
+        whose progress can be queried by `AutoTestService.get_batch_progress`.
+
+        If publishing fails, the tests that have not been published are deleted (to be committed by the caller) before
+        the error is re-raised, while the published ones are kept, since their jobs will still run.
+
+        The tests are scheduled as a bulk run, see `AutoTestService.get_dispatch_options`.
+        """
+        if config is None:
+            raise SubmissionServiceError('auto test config is required')
+        task_entry = bot.task_entries.get(config.type)
+        if task_entry is None:
+            raise SubmissionServiceError('task entry not found for config type: %s' % config.type)
+
+        options = AutoTestService.get_dispatch_options(config, AutoTestService.SOURCE_ADMIN_BATCH)
+        results = []
+        try:
+            with task_entry.app.producer_or_acquire() as producer:
+                for submission_id, work_id in work_tuples:
+                    results.append(task_entry.apply_async((submission_id, config.id), task_id=work_id,
+                                                          producer=producer, **options))
+        except Exception:
+            published_work_ids = {r.id for r in results}
+            AutoTestService.delete_batch([work_id for _, work_id in work_tuples if work_id not in published_work_ids])
+            raise
+        result = GroupResult(uuid(), results, app=task_entry.app)
+        result.save()  # so that the batch can be restored by its id
+        return result
+
     @staticmethod
     def get_auto_tests(submission: Submission, joined_load_output_files=False, include_private: bool = False,
                        update_after_timestamp: float = None, timestamp_safe_margin: float = 3.0) \
@@ -1,3 +1,5 @@
+import os
+import stat
 from typing import Tuple
 
 import chardet
@@ -19,3 +21,15 @@ class FileUtils:
                 if det_encoding and det_confidence and det_confidence > cls._CHAR_DET_CONFIDENCE_THRESHOLD:
                     encoding = det_encoding
             return content.decode(encoding), encoding
+
+    @staticmethod
+    def is_private_folder(path: str) -> bool:
+        """
+        Check that a folder is owned by the current user and not writable by the others, e.g. before unpickling the
+        files in it, which could run arbitrary code if they were planted by another user.
+        """
+        try:
+            st = os.stat(path)
+        except OSError:
+            return False
+        return stat.S_ISDIR(st.st_mode) and st.st_uid == os.getuid() and not st.st_mode & (stat.S_IWGRP | stat.S_IWOTH)